@@ -1,131 +1,339 @@
+import click
 import hashlib
 import hmac
-import json
+import itertools
+import logging
 import os
-import requests
-import sentry_sdk
+import re
+import sys
 import time
 
-from flask import g, Flask, request
+from flask import current_app, g, Flask, request
+from flask.cli import with_appcontext
 from functools import wraps
-from sentry_sdk.integrations.flask import FlaskIntegration
-from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
-from types import SimpleNamespace
-from typing import List
-
-from elo import get_leaderboard, PlayerStats
+from typing import List, Mapping, Optional, Set, Tuple
+
+from cache import ExpiringSet, LRUCache, Memo, SingleFlight
+from channel_events import has_pending_changes, publish_channel_changes, ChannelListener
+from deferred import DeferredResponder
+from metrics import span, Counter, Gauge, Histogram, Registry
+from transfer import export_matches, import_matches, FORMATS
+from elo import (
+    get_leaderboard, invalidate_standings, check_standings, delete_checkpoints, rebuild_checkpoints, revert_match,
+    get_rating_timeline, get_replay, format_leaderboard, LeaderboardView, PlayerStats
+)
+from models import Channel, Team
+from slack_api import SlackApiError, SlackClient
+from sqlalchemy.orm import configure_mappers
 from database import (
-    datetime, get_session, get_display_name, get_team, get_channel, get_app_user, insert_match, get_last_match
+    datetime, get_session, get_read_session, get_display_names, get_team, get_app_user, resolve_ids, insert_matches,
+    get_last_match, get_leaderboard_version, get_pool_stats, get_engine, save_installation, remember_signature
 )
 
 
-SENTRY_DSN = os.getenv('SLACK_APP_PONG_SENTRY_DSN')  # should not be configured when test are running
-sentry_sdk.init(
-    dsn=SENTRY_DSN,
-    integrations=[FlaskIntegration(), SqlalchemyIntegration()]
-) if SENTRY_DSN else None
+logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
 
-app.config['DATABASE_URL'] = os.environ['SLACK_APP_PONG_DATABASE_URL']
-app.config['SIGNING_SECRET'] = os.environ['SLACK_APP_PONG_SIGNING_SECRET']
+def load_config(environ: Mapping[str, str]) -> dict:
+    """ Reads the app's config from SLACK_APP_PONG_* variables of the environment.
+    """
+    return {
+        'DATABASE_URL': environ['SLACK_APP_PONG_DATABASE_URL'],
+        'SIGNING_SECRET': environ['SLACK_APP_PONG_SIGNING_SECRET'],
+        # requests signed more than SIGNATURE_MAX_AGE seconds ago (or ahead) are rejected, signatures seen within that
+        # window are remembered to reject replays, SEEN_SIGNATURES_SIZE should exceed the number of requests per window
+        'SIGNATURE_MAX_AGE': int(environ.get('SLACK_APP_PONG_SIGNATURE_MAX_AGE', 300)),
+        'SEEN_SIGNATURES_SIZE': int(environ.get('SLACK_APP_PONG_SEEN_SIGNATURES_SIZE', 100000)),
+        # every SEEN_SIGNATURES_SWEEP_INTERVAL-th signature remembered by a worker deletes the expired seen signatures
+        'SEEN_SIGNATURES_SWEEP_INTERVAL': int(environ.get('SLACK_APP_PONG_SEEN_SIGNATURES_SWEEP_INTERVAL', 100)),
+        # optional read replica for /leaderboard history, standings and name reads, used while it has caught up with the
+        # primary
+        'REPLICA_DATABASE_URL': environ.get('SLACK_APP_PONG_REPLICA_DATABASE_URL'),
+        'DATABASE_POOL_SIZE': int(environ.get('SLACK_APP_PONG_DATABASE_POOL_SIZE', 5)),
+        'DATABASE_MAX_OVERFLOW': int(environ.get('SLACK_APP_PONG_DATABASE_MAX_OVERFLOW', 10)),
+        'DATABASE_POOL_TIMEOUT': int(environ.get('SLACK_APP_PONG_DATABASE_POOL_TIMEOUT', 30)),
+        'DATABASE_POOL_RECYCLE': int(environ.get('SLACK_APP_PONG_DATABASE_POOL_RECYCLE', -1)),
+        'DATABASE_POOL_PRE_PING': environ.get('SLACK_APP_PONG_DATABASE_POOL_PRE_PING', '1') == '1',
+        'ELO_ENGINE': environ.get('SLACK_APP_PONG_ELO_ENGINE', 'python'),  # 'numpy' for long match histories
+        'LEADERBOARD_CACHE_SIZE': int(environ.get('SLACK_APP_PONG_LEADERBOARD_CACHE_SIZE', 256)),
+        # concurrent requests for a leaderboard that isn't cached yet wait up to this many seconds for the one that
+        # computes it, instead of replaying it too (0 disables it)
+        'LEADERBOARD_SINGLE_FLIGHT_TIMEOUT': float(environ.get('SLACK_APP_PONG_LEADERBOARD_SINGLE_FLIGHT_TIMEOUT', 2)),
+        # acknowledge /won and /revert right away and post the leaderboard to the command's response_url later
+        'DEFERRED_RESPONSES': environ.get('SLACK_APP_PONG_DEFERRED_RESPONSES', '0') == '1',
+        'DEFERRED_WORKERS': int(environ.get('SLACK_APP_PONG_DEFERRED_WORKERS', 2)),
+        'DEFERRED_QUEUE_SIZE': int(environ.get('SLACK_APP_PONG_DEFERRED_QUEUE_SIZE', 100)),
+        # requests slower than this are logged with their phase breakdown
+        'SLOW_REQUEST_THRESHOLD': float(environ.get('SLACK_APP_PONG_SLOW_REQUEST_THRESHOLD', 0.5)),
+        # rows shown by /leaderboard, and by /won when WON_LEADERBOARD_SIZE is set (0 posts the whole leaderboard)
+        'LEADERBOARD_PAGE_SIZE': int(environ.get('SLACK_APP_PONG_LEADERBOARD_PAGE_SIZE', 10)),
+        'LEADERBOARD_MAX_SIZE': int(environ.get('SLACK_APP_PONG_LEADERBOARD_MAX_SIZE', 50)),
+        'WON_LEADERBOARD_SIZE': int(environ.get('SLACK_APP_PONG_WON_LEADERBOARD_SIZE', 0)),
+        'WON_MAX_MATCHES': int(environ.get('SLACK_APP_PONG_WON_MAX_MATCHES', 50)),  # reported with one /won
+        # standings are saved every CHECKPOINT_INTERVAL matches (0 disables it), beyond CHECKPOINT_MAX_COUNT per channel
+        # the checkpoints older than the newest half are thinned out, historical leaderboards replay from the nearest
+        'CHECKPOINT_INTERVAL': int(environ.get('SLACK_APP_PONG_CHECKPOINT_INTERVAL', 500)),
+        'CHECKPOINT_MAX_COUNT': int(environ.get('SLACK_APP_PONG_CHECKPOINT_MAX_COUNT', 100)),
+        # listen for channel changes of other workers (LISTEN/NOTIFY on Postgres, polling every
+        # CHANNEL_EVENTS_POLL_INTERVAL seconds otherwise) and memoize leaderboard versions in the meantime instead of
+        # querying them on every request
+        'CHANNEL_EVENTS': environ.get('SLACK_APP_PONG_CHANNEL_EVENTS', '0') == '1',
+        'CHANNEL_EVENTS_POLL_INTERVAL': float(environ.get('SLACK_APP_PONG_CHANNEL_EVENTS_POLL_INTERVAL', 1)),
+        'METRICS_TOKEN': environ.get('SLACK_APP_PONG_METRICS_TOKEN'),  # /metrics requires it as bearer token if set
+        # Slack Web API calls (the OAuth token exchange) fail after these connect and read timeouts, in seconds, the
+        # connections of each worker are pooled up to SLACK_API_POOL_SIZE
+        'SLACK_API_URL': environ.get('SLACK_APP_PONG_SLACK_API_URL', 'https://slack.com/api/'),
+        'SLACK_API_CONNECT_TIMEOUT': float(environ.get('SLACK_APP_PONG_SLACK_API_CONNECT_TIMEOUT', 3.05)),
+        'SLACK_API_READ_TIMEOUT': float(environ.get('SLACK_APP_PONG_SLACK_API_READ_TIMEOUT', 5)),
+        'SLACK_API_POOL_SIZE': int(environ.get('SLACK_APP_PONG_SLACK_API_POOL_SIZE', 4)),
+        'CLIENT_ID': environ['SLACK_APP_PONG_CLIENT_ID'],
+        'CLIENT_SECRET': environ['SLACK_APP_PONG_CLIENT_SECRET'],
+        'SENTRY_DSN': environ.get('SLACK_APP_PONG_SENTRY_DSN'),  # should not be configured when test are running
+    }
 
-CLIENT_ID = os.environ['SLACK_APP_PONG_CLIENT_ID']
-CLIENT_SECRET = os.environ['SLACK_APP_PONG_CLIENT_SECRET']
 
-
-class AuthorizeException(Exception):
-    pass
+def init_sentry(dsn: Optional[str]):
+    """ Sends errors to Sentry if a DSN is configured, the SDK and its integrations are only imported then.
+    """
+    if not dsn:
+        return
+    import sentry_sdk
+    from sentry_sdk.integrations.flask import FlaskIntegration
+    from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
+    sentry_sdk.init(dsn=dsn, integrations=[FlaskIntegration(), SqlalchemyIntegration()])
+
+
+# process-wide state, created by init_state with the sizes of the app's config
+# rendered leaderboard lines keyed by (channel id, leaderboard version, view)
+leaderboard_cache: LRUCache = None
+leaderboard_flights: SingleFlight = None
+seen_signatures: ExpiringSet = None
+# leaderboard versions by channel id, only used while channel_listener delivers the changes of other workers
+channel_versions: Memo = None
+deferred_responder: DeferredResponder = None
+channel_listener: ChannelListener = None
+slack_client: SlackClient = None
+
+
+def invalidate_leaderboard(channel_id: int = None):
+    """ Drops the memoized version and the rendered leaderboards of the channel (only the versions if it's None).
+    """
+    channel_versions.evict(channel_id)
+    if channel_id is not None:
+        leaderboard_cache.evict(lambda key: key[0] == channel_id)
+
+
+def init_state(config: dict):
+    """ Replaces the process-wide caches and workers by ones sized by the config.
+    """
+    global leaderboard_cache, leaderboard_flights, seen_signatures, channel_versions, deferred_responder, \
+        channel_listener, slack_client
+    leaderboard_cache = LRUCache(maxsize=config['LEADERBOARD_CACHE_SIZE'])
+    leaderboard_flights = SingleFlight(timeout=config['LEADERBOARD_SINGLE_FLIGHT_TIMEOUT'])
+    seen_signatures = ExpiringSet(maxsize=config['SEEN_SIGNATURES_SIZE'])
+    channel_versions = Memo()
+    deferred_responder = DeferredResponder(workers=config['DEFERRED_WORKERS'], queue_size=config['DEFERRED_QUEUE_SIZE'])
+    channel_listener = ChannelListener(on_change=invalidate_leaderboard,
+                                       poll_interval=config['CHANNEL_EVENTS_POLL_INTERVAL'])
+    slack_client = SlackClient(base_url=config['SLACK_API_URL'], connect_timeout=config['SLACK_API_CONNECT_TIMEOUT'],
+                               read_timeout=config['SLACK_API_READ_TIMEOUT'], pool_size=config['SLACK_API_POOL_SIZE'])
+
+
+registry = Registry()
+request_seconds = registry.register(Histogram(
+    'slack_pong_request_seconds', 'Wall time of requests.', labelnames=('route',)
+))
+phase_seconds = registry.register(Histogram(
+    'slack_pong_request_phase_seconds', 'Time spent in each phase of a request.', labelnames=('route', 'phase')
+))
+registry.register(Gauge(
+    'slack_pong_leaderboard_cache', 'Leaderboard cache size and counters.',
+    lambda: {(stat,): value for stat, value in leaderboard_cache.stats().items()}, labelnames=('stat',)
+))
+registry.register(Gauge(
+    'slack_pong_leaderboard_flights', 'Leaderboard computations, shared by concurrent requests or computed again.',
+    lambda: {(stat,): value for stat, value in leaderboard_flights.stats().items()}, labelnames=('stat',)
+))
+rejected_requests = registry.register(Counter(
+    'slack_pong_rejected_requests_total', 'Requests that failed the signature check, by reason.', labelnames=('reason',)
+))
+registry.register(Gauge(
+    'slack_pong_seen_signatures', 'Seen signature cache size and unexpired evictions.',
+    lambda: {(stat,): value for stat, value in seen_signatures.stats().items()}, labelnames=('stat',)
+))
+registry.register(Gauge(
+    'slack_pong_channel_events', 'Channel change listener state and counters.',
+    lambda: {(stat,): value for stat, value in channel_listener.stats().items()}, labelnames=('stat',)
+))
+registry.register(Gauge(
+    'slack_pong_database_pool', 'Database connection pool usage.',
+    lambda: {(stat,): value for stat, value in get_pool_stats().items()}, labelnames=('stat',)
+))
+registry.register(Gauge(
+    'slack_pong_deferred_queue_depth', 'Deferred responses waiting for a worker.',
+    lambda: {(): deferred_responder.queue.qsize()}
+))
 
 
 class ValidateException(Exception):
     pass
 
 
-class TimeoutException(Exception):
+class ReplayException(Exception):
     pass
 
 
-@app.before_request
 def before_request():
-    g.start = time.time()
+    if current_app.config['CHANNEL_EVENTS']:
+        channel_listener.start(get_engine())
+    g.start = time.perf_counter()
+    g.phases = {}
+    g.request_info = {}
 
 
-@app.after_request
 def after_request(response):
-    diff = time.time() - g.start
-    if diff > 0.5:
-        sentry_sdk.capture_exception(TimeoutException(response))  # pragma: nocover TODO
+    diff = time.perf_counter() - g.start
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    request_seconds.observe(diff, route=route)
+    for phase, seconds in g.phases.items():
+        phase_seconds.observe(seconds, route=route, phase=phase)
+    if diff > current_app.config['SLOW_REQUEST_THRESHOLD']:
+        breakdown = ' '.join(f'{phase}={seconds:.3f}s' for phase, seconds in g.phases.items())
+        info = ' '.join(f'{name}={value}' for name, value in g.request_info.items())
+        logger.warning(f'slow request {request.method} {route} took {diff:.3f}s: {breakdown} {info}'.strip())
     return response
 
 
-@app.errorhandler(500)
+def metrics():
+    token = current_app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return 'Unauthorized', 401
+    return registry.expose(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
 def handle_internal_server_error(e):
     if isinstance(e.original_exception, ValidateException):
         return 'Bad Request', 400
-    elif isinstance(e.original_exception, AuthorizeException):
-        return 'Unauthorized', 401
     return 'Internal Server Error', 500  # pragma: nocover TODO
 
 
-@app.route('/oauth', methods=['GET'])
 def oauth():
     code = request.args.get('code')
     if not code:
         return 'code missing', 500
 
-    r = requests.get(url='https://slack.com/api/oauth.access', params={
-        'code': code,
-        'client_id': CLIENT_ID,
-        'client_secret': CLIENT_SECRET
-    })
-    json.loads(r.text)
+    try:
+        with span('slack_api'):
+            response = slack_client.oauth_access(client_id=current_app.config['CLIENT_ID'],
+                                                 client_secret=current_app.config['CLIENT_SECRET'], code=code)
+    except SlackApiError as e:
+        logger.warning(f'installation failed: {e}')
+        return 'installation failed', 502
+    with get_session() as db, span('insert'):
+        save_installation(db, oauth_access=response)
     return 'redirect somewhere'  # TODO make an actual redirection and test this out
 
 
+SIGNATURE = re.compile(r'v0=[0-9a-f]{64}')
+TIMESTAMP = re.compile(r'[0-9]{1,12}')
+remembered_signatures = itertools.count(1)  # of this worker, see SEEN_SIGNATURES_SWEEP_INTERVAL
+
+
+def check_signature() -> Optional[str]:
+    """ Returns why the request isn't a fresh request signed by Slack, or None if it is.
+
+    Header shape, age and replays seen by this worker are checked before the body is read, the signature is compared
+    in constant time. Replays sent to another worker are rejected by the handler's transaction, see remember_request.
+    See https://api.slack.com/docs/verifying-requests-from-slack
+    """
+    x_slack_signature = request.headers.get('X-Slack-Signature', '')
+    x_slack_request_timestamp = request.headers.get('X-Slack-Request-Timestamp', '')
+    if not SIGNATURE.fullmatch(x_slack_signature) or not TIMESTAMP.fullmatch(x_slack_request_timestamp):
+        return 'malformed'
+    max_age = current_app.config['SIGNATURE_MAX_AGE']
+    if abs(time.time() - int(x_slack_request_timestamp)) > max_age:
+        return 'stale'
+    if x_slack_signature in seen_signatures:
+        return 'replay'
+    my_signature = hmac.new(
+        current_app.config['SIGNING_SECRET'].encode(),
+        b'v0:' + x_slack_request_timestamp.encode() + b':' + request.get_data(),
+        hashlib.sha256
+    ).hexdigest()
+    if not hmac.compare_digest(f'v0={my_signature}', x_slack_signature):
+        return 'signature'
+    expires = int(x_slack_request_timestamp) + max_age
+    if not seen_signatures.add(x_slack_signature, expires=expires):
+        return 'replay'  # the same request is being handled concurrently
+    g.signature = (x_slack_signature, expires)
+    return None
+
+
+def remember_request(db):
+    """ Records the request's signature in the handler's transaction, before any of its writes. A replay accepted by
+    another worker is rejected (with ReplayException) once that worker commits, a rolled back one can be retried.
+
+    Requests that don't open a session write nothing, they are only checked against the worker's seen signatures.
+    """
+    if g.get('signature') is None:
+        return  # not an authorized request
+    signature, expires = g.signature
+    sweep = next(remembered_signatures) % current_app.config['SEEN_SIGNATURES_SWEEP_INTERVAL'] == 0
+    if not remember_signature(db, signature=signature, expires_at=datetime.utcfromtimestamp(expires), sweep=sweep):
+        raise ReplayException(signature)
+
+
 def authorize(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
+        with span('signature'):
+            reason = check_signature()
+        if reason:
+            rejected_requests.inc(reason=reason)
+            return 'Unauthorized', 401
         try:
-            request_body = request.get_data().decode()
-            x_slack_signature = request.headers['X-Slack-Signature']
-            version = x_slack_signature.split('=')[0]
-            x_slack_request_timestamp = request.headers['X-Slack-Request-Timestamp']
-            sig_basestring = f'{version}:{x_slack_request_timestamp}:{request_body}'
-            my_signature = hmac.new(
-                app.config['SIGNING_SECRET'].encode(),
-                sig_basestring.encode(),
-                hashlib.sha256
-            ).hexdigest()
-            assert f'{version}={my_signature}' == x_slack_signature
+            return f(*args, **kwargs)
+        except ReplayException:
+            rejected_requests.inc(reason='replay')  # seen by another worker
+            return 'Unauthorized', 401
         except Exception:
-            raise AuthorizeException(request.headers, request.form)
-        return f(*args, **kwargs)
+            seen_signatures.discard(g.signature[0])  # Slack retries the request, its writes may have been rolled back
+            raise
     return wrapper
 
 
 def validate(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
-        try:
-            for field in ['user_id', 'user_name', 'text', 'team_id', 'team_domain', 'channel_id', 'channel_name']:
-                assert field in request.form and isinstance(request.form[field], str)
-        except Exception:
-            raise ValidateException(request.form)
+        with span('validation'):
+            try:
+                for field in ['user_id', 'user_name', 'text', 'team_id', 'team_domain', 'channel_id', 'channel_name']:
+                    assert field in request.form and isinstance(request.form[field], str)
+            except Exception:
+                raise ValidateException(request.form)
         return f(*args, **kwargs)
     return wrapper
 
 
-@app.route('/nickname', methods=['POST'])
 @authorize
 def nickname():
     # TODO limit length, validation, also tests
     # TODO make it clear that this command is available
     with get_session() as db:
-        team = get_team(db=db, slack_team_id=request.form['team_id'], slack_team_domain=request.form['team_domain'])
-        app_user = get_app_user(db=db, team_id=team.id, slack_user_id=request.form['user_id'],
-                                slack_user_name=request.form['user_name'])
+        remember_request(db)
+        with span('lookup'):
+            team = get_team(db=db, slack_team_id=request.form['team_id'],
+                            slack_team_domain=request.form['team_domain'])
+            app_user = get_app_user(db=db, team_id=team.id, slack_user_id=request.form['user_id'],
+                                    slack_user_name=request.form['user_name'])
         app_user.nickname = request.form['text']
+        team.nickname_version = Team.nickname_version + 1  # outdates every cached leaderboard of the team
+        db.flush()  # locks the team before its channels, concurrent commands must take them in the same order
+        channel_ids = [channel_id for channel_id, in db.query(Channel.id).filter(Channel.team_id == team.id)]
+        publish_channel_changes(db, channel_ids=channel_ids)
+        db.commit()
+        for channel_id in channel_ids:
+            invalidate_leaderboard(channel_id=channel_id)
         return {
             'response_type': 'in_channel',
             'text': f'<@{app_user.slack_user_id}> changed his nickname to _{app_user.nickname}_'
@@ -133,66 +341,101 @@ def nickname():
 
 
 def get_leaderboard_lines(db, leaderboard: List[PlayerStats]):
-    updated_leaderboard = [x.set_name(get_display_name(db=db, app_user_id=x.app_user_id)) for x in leaderboard]
-    longest = SimpleNamespace(**{
-        'elo': len('ELO'),
-        'counter': len(str(len(leaderboard))),
-        'name': len('Name'),
-        'won': 1,  # len('W')
-        'lost': 1,  # len('L')
-        'move': len('#↑/↓'),
-        'played': 2,  # len('GP')
-        'win_percentage': len('Win %'),
-        'streak': len('Streak')
-    })
-    for x in updated_leaderboard:
-        longest.elo = max(longest.elo, len(str(x.elo)))
-        longest.name = max(longest.name, len(str(x.name)))
-        longest.won = max(longest.won, len(str(x.won)))
-        longest.lost = max(longest.lost, len(str(x.lost)))
-        longest.move = max(longest.move, len(str(x.move)))
-        longest.played = max(longest.played, len(str(x.played)))
-        longest.win_percentage = max(longest.win_percentage, len(str(x.win_percentage)))
-        longest.streak = max(longest.streak, len(str(x.streak)))
-
-    lines = []
-    elo = 'ELO'[:longest.elo].rjust(longest.elo)
-    counter = '#'[:longest.counter].rjust(longest.counter)
-    name = 'Name'[:longest.name].ljust(longest.name)
-    won = 'W'[:longest.won].rjust(longest.won)
-    lost = 'L'[:longest.lost].rjust(longest.lost)
-    move = '#↑/↓'[:longest.move].rjust(longest.move)
-    played = 'GP'[:longest.played].rjust(longest.played)
-    win_percentage = 'Win %'[:longest.win_percentage].rjust(longest.win_percentage)
-    streak = 'Streak'[:longest.streak].rjust(longest.streak)
-    line = f'[ {elo} ] {counter}. {name} {move} | {won} | {lost} | {played} | {win_percentage} | {streak}'
-    lines.append(line)
-    for i, x in enumerate(updated_leaderboard, start=1):
-        elo = str(x.elo)[:longest.elo].rjust(longest.elo)
-        counter = str(i)[:longest.counter].rjust(longest.counter)
-        name = x.name[:longest.name].ljust(longest.name)
-        won = str(x.won)[:longest.won].rjust(longest.won)
-        lost = str(x.lost)[:longest.lost].rjust(longest.lost)
-        move = str(x.move)[:longest.move].rjust(longest.move)
-        played = str(x.played)[:longest.played].rjust(longest.played)
-        win_percentage = str(x.win_percentage)[:longest.win_percentage].rjust(longest.win_percentage)
-        streak = str(x.streak)[:longest.streak].rjust(longest.streak)
-        line = f'[ {elo} ] {counter}. {name} {move} | {won} | {lost} | {played} | {win_percentage} | {streak}'
-        lines.append('―'*len(line))
-        lines.append(line)
+    display_names = get_display_names(db=db, app_user_ids=[x.app_user_id for x in leaderboard])
+    return format_leaderboard(leaderboard, display_names=display_names)
+
+
+def get_channel_version(db, channel_id: int) -> tuple:
+    """ Returns the channel's leaderboard version, memoized while the changes of other workers are being delivered.
+
+    Only committed versions are memoized, a version that includes the session's own pending changes is not.
+    """
+    load = lambda: tuple(get_leaderboard_version(db, channel_id=channel_id))  # noqa: E731
+    if not channel_listener.connected or has_pending_changes(db, channel_id=channel_id):
+        return load()
+    return channel_versions.get(channel_id, load=load)
+
+
+def render_leaderboard(db, channel_id: int, view: LeaderboardView = LeaderboardView()) -> List[str]:
+    """ Returns leaderboard lines of the channel, rendered lines are reused until the channel's version changes.
+
+    Concurrent requests for the same version share one computation, see LEADERBOARD_SINGLE_FLIGHT_TIMEOUT.
+    """
+    generation = channel_versions.generation
+    key = (channel_id, *get_channel_version(db, channel_id=channel_id), view)
+    lines = leaderboard_cache.get(key)
+    if lines is None:
+        def compute():
+            leaderboard = get_leaderboard(db=db, channel_id=channel_id, view=view)
+            with span('render'):
+                lines = get_leaderboard_lines(db=db, leaderboard=leaderboard)
+            if channel_versions.generation == generation:  # a change since the key was built may not be in the lines
+                leaderboard_cache.put(key, lines)
+            return lines
+        with span('wait'):
+            lines = leaderboard_flights.do(key, compute)
     return lines
 
 
-@app.route('/won', methods=['POST'])
+def leaderboard_message(db, channel_id: int, text: str = '', view: LeaderboardView = LeaderboardView()) -> dict:
+    return {
+        'response_type': 'in_channel',
+        'text': text + '```' + '\n'.join(render_leaderboard(db=db, channel_id=channel_id, view=view)) + '```'
+    }
+
+
+def won_leaderboard_view(app_user_ids: Set[int]) -> LeaderboardView:
+    """ The top of the leaderboard plus the players of the reported matches, or everyone if WON_LEADERBOARD_SIZE
+    isn't set.
+    """
+    if not current_app.config['WON_LEADERBOARD_SIZE']:
+        return LeaderboardView()
+    return LeaderboardView(size=current_app.config['WON_LEADERBOARD_SIZE'], include=tuple(sorted(app_user_ids)))
+
+
+def defer_leaderboard_message(db, channel_id: int, text: str = '', view: LeaderboardView = LeaderboardView()) -> bool:
+    """ Commits the session and leaves rendering of the leaderboard to the deferred responder, if it is enabled.
+
+    Returns False when the leaderboard has to be rendered right away (disabled, no response_url or queue full).
+    """
+    if not current_app.config['DEFERRED_RESPONSES'] or not request.form.get('response_url'):
+        return False
+    db.commit()  # the leaderboard is rendered within the worker's own session
+
+    def build():
+        with get_session() as worker_db:
+            return leaderboard_message(worker_db, channel_id=channel_id, text=text, view=view)
+    return deferred_responder.submit(current_app._get_current_object(), response_url=request.form['response_url'],
+                                     build=build)
+
+
+MENTION = re.compile(r'<@([^|>]+)\|([^>]*)>')  # Slack escapes a mention as <@user_id|user_name>
+BEAT = re.compile(r'<@[^|>]+\|[^>]*>\s+beat\s+<@[^|>]+\|[^>]*>', re.IGNORECASE)
+
+
+def parse_results(text: str, reporter_slack_id: str) -> List[Tuple[str, str]]:
+    """ Parses the text of /won into (winner, loser) slack user ids, in the reported order.
+
+    Every mentioned player was beaten by the reporter, unless a line reads `@winner beat @loser`, so a tournament's
+    score sheet can be reported with one multi-line command.
+    """
+    results = []
+    for line in text.strip().splitlines():
+        mentions = [slack_id for slack_id, _ in MENTION.findall(line)]
+        if BEAT.fullmatch(line.strip()):
+            results.append((mentions[0], mentions[1]))
+        else:
+            results.extend((reporter_slack_id, slack_id) for slack_id in mentions)
+    return results
+
+
 @authorize
 @validate
 def won():
     # validate the command text
     winner_slack_id = request.form['user_id']
-    try:
-        loser_slack_id = request.form['text'].strip().split('<@')[1].split('|')[0].split('>')[0]
-        loser_slack_name = request.form['text'].strip().split('|')[1][:-1]
-    except Exception:
+    results = parse_results(request.form['text'], reporter_slack_id=winner_slack_id)
+    if not results:
         return {
             'text': ':x: You should mention someone when reporting a win, like this:',
             'attachments': [{
@@ -200,34 +443,124 @@ def won():
             }]
         }
 
-    # check that mentioned player is not the one reporting the win
-    if winner_slack_id == loser_slack_id:
+    # check that nobody is reported to have beaten himself
+    if any(winner == loser for winner, loser in results):
         return {
             'text': ':x: You cannot mention yourself. Mention the player you have won.'
         }
+    if len(results) > current_app.config['WON_MAX_MATCHES']:
+        return {
+            'text': f':x: At most {current_app.config["WON_MAX_MATCHES"]} matches can be reported at once.'
+        }
 
-    winner_slack_name = request.form['user_name']
+    slack_users = {slack_id: name for slack_id, name in MENTION.findall(request.form['text'])}
+    slack_users[winner_slack_id] = request.form['user_name']
     team_id = request.form['team_id']
     team_domain = request.form['team_domain']
     channel_id = request.form['channel_id']
     channel_name = request.form['channel_name']
 
     with get_session() as db:
-        team = get_team(db, slack_team_id=team_id, slack_team_domain=team_domain)
-        channel = get_channel(db, team_id=team.id, slack_channel_id=channel_id, slack_channel_name=channel_name)
-        winner = get_app_user(db, team_id=team.id, slack_user_id=winner_slack_id, slack_user_name=winner_slack_name)
-        loser = get_app_user(db, team_id=team.id, slack_user_id=loser_slack_id, slack_user_name=loser_slack_name)
-        insert_match(db, channel_id=channel.id, winner_id=winner.id, loser_id=loser.id)
-
-        leaderboard = get_leaderboard(db=db, channel_id=channel.id)
-        leaderboard_lines = get_leaderboard_lines(db=db, leaderboard=leaderboard)
+        remember_request(db)
+        with span('lookup'):
+            ids = resolve_ids(db, slack_team_id=team_id, slack_team_domain=team_domain, slack_channel_id=channel_id,
+                              slack_channel_name=channel_name, slack_users=slack_users)
+        results = [(ids.app_user_ids[winner], ids.app_user_ids[loser]) for winner, loser in results]
+        with span('insert'):
+            insert_matches(db, channel_id=ids.channel_id, results=results)
+        db.commit()  # the leaderboard is rendered (and its version memoized) from committed state only
+        invalidate_leaderboard(channel_id=ids.channel_id)
+
+        view = won_leaderboard_view(app_user_ids={x for result in results for x in result})
+        text = f'{len(results)} matches recorded.\n' if len(results) > 1 else ''
+        if defer_leaderboard_message(db, channel_id=ids.channel_id, text=text, view=view):
+            return {
+                'response_type': 'ephemeral',
+                'text': f'{len(results)} matches recorded, the leaderboard will be posted shortly.' if text else
+                        'Match recorded, the leaderboard will be posted shortly.'
+            }
+        return leaderboard_message(db, channel_id=ids.channel_id, text=text, view=view)
+
+
+def parse_leaderboard_view(text: str, app_user_id: int) -> LeaderboardView:
+    """ Parses the text of /leaderboard: empty or `top [N]`, `page P` or `me`. Raises ValueError if it's neither.
+    """
+    size = current_app.config['LEADERBOARD_PAGE_SIZE']
+    words = text.lower().split()
+    if not words:
+        return LeaderboardView(size=size)
+    if words[0] == 'me' and len(words) == 1:
+        return LeaderboardView(size=size, around=app_user_id)
+    if words[0] == 'page' and len(words) == 2 and int(words[1]) >= 1:
+        return LeaderboardView(start=(int(words[1]) - 1) * size + 1, size=size)
+    if words[0] == 'top' and len(words) == 1:
+        return LeaderboardView(size=size)
+    if words[0] == 'top' and len(words) == 2 and int(words[1]) >= 1:
+        return LeaderboardView(size=min(int(words[1]), current_app.config['LEADERBOARD_MAX_SIZE']))
+    if words[0] == 'as-of' and len(words) == 2:  # the end of the day
+        as_of = datetime.strptime(words[1], '%Y-%m-%d').replace(hour=23, minute=59, second=59)
+        return LeaderboardView(size=size, as_of=as_of)
+    if words[0] == 'as-of' and len(words) == 3:
+        return LeaderboardView(size=size, as_of=datetime.strptime(' '.join(words[1:]), '%Y-%m-%d %H:%M'))
+    raise ValueError(text)
+
+
+def timeline_message(db, channel_id: int, app_user_id: int) -> dict:
+    timeline = get_rating_timeline(db, channel_id=channel_id, app_user_id=app_user_id,
+                                   count=current_app.config['LEADERBOARD_PAGE_SIZE'])
+    if not timeline:
+        return {
+            'text': 'You haven\'t played in this channel yet.'
+        }
+    display_names = get_display_names(db=db, app_user_ids=[
+        match.loser_id if match.winner_id == app_user_id else match.winner_id for match, _, _ in timeline
+    ])
+    lines = []
+    for match, before, after in timeline:
+        won = match.winner_id == app_user_id
+        opponent = display_names[match.loser_id if won else match.winner_id]
+        lines.append(f'{match.timestamp:%Y-%m-%d %H:%M} {"W" if won else "L"} {int(after):>5} '
+                     f'({int(after) - int(before):+d}) vs {opponent}')
+    return {
+        'response_type': 'ephemeral',
+        'text': '```' + '\n'.join(lines) + '```'
+    }
+
+
+@authorize
+@validate
+def leaderboard():
+    user_id = request.form['user_id']
+
+    with get_session() as db:
+        remember_request(db)
+        with span('lookup'):
+            ids = resolve_ids(db, slack_team_id=request.form['team_id'], slack_team_domain=request.form['team_domain'],
+                              slack_channel_id=request.form['channel_id'],
+                              slack_channel_name=request.form['channel_name'],
+                              slack_users={user_id: request.form['user_name']})
+        try:
+            view = None if request.form['text'].strip().lower() == 'timeline' else \
+                parse_leaderboard_view(request.form['text'], app_user_id=ids.app_user_ids[user_id])
+        except ValueError:
+            return {
+                'text': ':x: Usage: `/leaderboard`, `/leaderboard top 20`, `/leaderboard page 2`, `/leaderboard me`, '
+                        '`/leaderboard as-of 2019-12-31 [18:00]` or `/leaderboard timeline`'
+            }
+        with get_read_session(db, channel_id=ids.channel_id) as read_db:
+            if view is None:
+                return timeline_message(read_db, channel_id=ids.channel_id, app_user_id=ids.app_user_ids[user_id])
+            lines = render_leaderboard(read_db, channel_id=ids.channel_id, view=view)
+        if len(lines) == 1:
+            return {
+                'text': 'You haven\'t played in this channel yet.' if view.around else 'No players on this page.'
+            }
         return {
             'response_type': 'in_channel',
-            'text': '```' + '\n'.join(leaderboard_lines) + '```'
+            'text': '```' + '\n'.join(lines) + '```'
         }
 
 
-@app.route('/revert', methods=['POST'])
 @authorize
 @validate
 def revert():
@@ -239,27 +572,30 @@ def revert():
     channel_name = request.form['channel_name']
 
     with get_session() as db:
-        team = get_team(db=db, slack_team_id=team_id, slack_team_domain=team_domain)
-        channel = get_channel(db=db, team_id=team.id, slack_channel_id=channel_id, slack_channel_name=channel_name)
-        winner = get_app_user(db=db, team_id=team.id, slack_user_id=winner_slack_id, slack_user_name=winner_slack_name)
-        last_match = get_last_match(db=db, channel_id=channel.id, winner_id=winner.id)
+        remember_request(db)
+        with span('lookup'):
+            ids = resolve_ids(db, slack_team_id=team_id, slack_team_domain=team_domain, slack_channel_id=channel_id,
+                              slack_channel_name=channel_name, slack_users={winner_slack_id: winner_slack_name})
+            last_match = get_last_match(db=db, channel_id=ids.channel_id, winner_id=ids.app_user_ids[winner_slack_id])
         if last_match is None:
             return {
                 'response_type': 'in_channel',
                 'text': 'Cannot revert your latest win since you haven\'t won a match yet.'
             }
         else:
-            db.delete(last_match)
+            revert_match(db, match=last_match)
+            publish_channel_changes(db, channel_ids=[ids.channel_id])
             db.commit()
-            leaderboard = get_leaderboard(db=db, channel_id=channel.id)
-            leaderboard_lines = get_leaderboard_lines(db=db, leaderboard=leaderboard)
-            return {
-                'response_type': 'in_channel',
-                'text': 'Match reverted. Here is the corrected leaderboard:\n```' + '\n'.join(leaderboard_lines) + '```'
-            }
+            invalidate_leaderboard(channel_id=ids.channel_id)
+            text = 'Match reverted. Here is the corrected leaderboard:\n'
+            if defer_leaderboard_message(db, channel_id=ids.channel_id, text=text):
+                return {
+                    'response_type': 'ephemeral',
+                    'text': 'Match reverted, the corrected leaderboard will be posted shortly.'
+                }
+            return leaderboard_message(db, channel_id=ids.channel_id, text=text)
 
 
-@app.route('/reset', methods=['POST'])
 @authorize
 @validate
 def reset():
@@ -269,9 +605,17 @@ def reset():
     channel_name = request.form['channel_name']
 
     with get_session() as db:
-        team = get_team(db=db, slack_team_id=team_id, slack_team_domain=team_domain)
-        channel = get_channel(db=db, team_id=team.id, slack_channel_id=channel_id, slack_channel_name=channel_name)
+        remember_request(db)
+        with span('lookup'):
+            ids = resolve_ids(db, slack_team_id=team_id, slack_team_domain=team_domain, slack_channel_id=channel_id,
+                              slack_channel_name=channel_name, slack_users={})
+            channel = db.query(Channel).get(ids.channel_id)
         channel.rankings_reset_at = datetime.utcnow().replace(microsecond=0)
+        invalidate_standings(db, channel_id=channel.id)
+        delete_checkpoints(db, channel_id=channel.id)
+        publish_channel_changes(db, channel_ids=[channel.id])
+        db.commit()
+        invalidate_leaderboard(channel_id=channel.id)
 
     return {
         'response_type': 'in_channel',
@@ -279,5 +623,178 @@ def reset():
     }
 
 
+@click.command('check-standings')
+@with_appcontext
+@click.option('--rebuild', is_flag=True, help='Invalidate inconsistent standings so they are rebuilt by replay.')
+def check_standings_command(rebuild):
+    """ Compares every channel's standings with a full replay of its match history.
+    """
+    inconsistent = 0
+    with get_session() as db:
+        for channel in db.query(Channel).order_by(Channel.id).all():
+            differences = check_standings(db, channel_id=channel.id)
+            for difference in differences:
+                click.echo(f'channel {channel.id} ({channel.slack_channel_name}): {difference}')
+            if differences:
+                inconsistent += 1
+                if rebuild:
+                    invalidate_standings(db, channel_id=channel.id)
+    click.echo(f'{inconsistent} inconsistent channel(s)')
+    if inconsistent and not rebuild:
+        sys.exit(1)
+
+
+@click.command('rebuild-checkpoints')
+@with_appcontext
+@click.option('--channel-id', type=int, help='Only rebuild the checkpoints of this channel.')
+def rebuild_checkpoints_command(channel_id):
+    """ Replaces the rating checkpoints of every channel with ones taken by a replay of its match history.
+    """
+    with get_session() as db:
+        channels = db.query(Channel).order_by(Channel.id)
+        if channel_id is not None:
+            channels = channels.filter(Channel.id == channel_id)
+        for channel in channels.all():
+            count = rebuild_checkpoints(db, channel_id=channel.id)
+            click.echo(f'channel {channel.id} ({channel.slack_channel_name}): {count} checkpoint(s)')
+            db.commit()
+
+
+@click.command('digest')
+@with_appcontext
+@click.argument('slack_team_ids', nargs=-1)
+@click.option('--size', type=int, help='Ranks shown per leaderboard, defaults to LEADERBOARD_PAGE_SIZE, 0 shows all.')
+@click.option('--processes', type=int, default=os.cpu_count(), show_default=True,
+              help='Worker processes that replay and render the leaderboards.')
+@click.option('--team-wide/--no-team-wide', default=True, help='Add the team-wide leaderboard of every team.')
+def digest_command(slack_team_ids, size, processes, team_wide):
+    """ Prints the leaderboard of every channel of the given teams (all teams if none are given), e.g. for a weekly
+    cron job.
+    """
+    from digest import render_leaderboards, render_team_leaderboard  # multiprocessing is only needed here
+
+    size = current_app.config['LEADERBOARD_PAGE_SIZE'] if size is None else size
+    view = LeaderboardView(size=size or None)
+    with get_session() as db:
+        teams = db.query(Team).order_by(Team.id)
+        if slack_team_ids:
+            teams = teams.filter(Team.slack_team_id.in_(slack_team_ids))
+        teams = teams.all()
+        channels = db.query(Channel).filter(Channel.team_id.in_([x.id for x in teams])).order_by(Channel.id).all()
+        leaderboards = render_leaderboards(db, channel_ids=[x.id for x in channels], view=view, processes=processes,
+                                           engine=current_app.config['ELO_ENGINE'])
+        for team in teams:
+            sections = [(f'#{x.slack_channel_name}', leaderboards[x.id]) for x in channels if x.team_id == team.id]
+            if team_wide:
+                sections.append(('team-wide', render_team_leaderboard(db, team_id=team.id, view=view,
+                                                                      engine=current_app.config['ELO_ENGINE'])))
+            for title, lines in sections:
+                if len(lines) > 1:  # channels without players are left out
+                    click.echo(f'{team.slack_team_domain} {title}')
+                    click.echo('\n'.join(lines) + '\n')
+
+
+def find_channel(db, slack_team_id: str, slack_channel_id: str) -> Channel:
+    channel = db.query(Channel).join(Team).filter(
+        Team.slack_team_id == slack_team_id,
+        Channel.slack_channel_id == slack_channel_id
+    ).one_or_none()
+    if channel is None:
+        raise click.ClickException(f'channel {slack_channel_id} of team {slack_team_id} not found')
+    return channel
+
+
+@click.command('export-matches')
+@with_appcontext
+@click.argument('slack_team_id')
+@click.argument('slack_channel_id')
+@click.argument('output', type=click.File('w', lazy=False), default='-')
+@click.option('--format', type=click.Choice(FORMATS), default='csv', show_default=True)
+def export_matches_command(slack_team_id, slack_channel_id, output, format):
+    """ Writes the channel's match history as CSV or JSON lines (to stdout by default).
+    """
+    with get_session() as db:
+        channel = find_channel(db, slack_team_id=slack_team_id, slack_channel_id=slack_channel_id)
+        export_matches(db, channel_id=channel.id, file=output, format=format)
+
+
+@click.command('import-matches')
+@with_appcontext
+@click.argument('slack_team_id')
+@click.argument('slack_channel_id')
+@click.argument('input', type=click.File('r'), default='-')
+@click.option('--format', type=click.Choice(FORMATS), default='csv', show_default=True)
+@click.option('--batch-size', type=int, default=10000, show_default=True)
+@click.option('--team-domain', help='Creates the team with this domain if it doesn\'t exist yet.')
+@click.option('--channel-name', help='Creates the channel with this name if it doesn\'t exist yet.')
+def import_matches_command(slack_team_id, slack_channel_id, input, format, batch_size, team_domain, channel_name):
+    """ Appends matches of a CSV or JSON lines file (as written by export-matches) to the channel's history.
+    """
+    with get_session() as db:
+        if team_domain and channel_name:
+            channel_id = resolve_ids(db, slack_team_id=slack_team_id, slack_team_domain=team_domain,
+                                     slack_channel_id=slack_channel_id, slack_channel_name=channel_name,
+                                     slack_users={}).channel_id
+        else:
+            channel_id = find_channel(db, slack_team_id=slack_team_id, slack_channel_id=slack_channel_id).id
+        try:
+            count = import_matches(db, channel_id=channel_id, file=input, format=format, batch_size=batch_size)
+        except ValueError as e:
+            raise click.ClickException(str(e))  # rolls back the whole import
+        rebuild_checkpoints(db, channel_id=channel_id)
+    click.echo(f'{count} match(es) imported')
+
+
+ROUTES = [
+    ('/metrics', 'GET', metrics),
+    ('/oauth', 'GET', oauth),
+    ('/nickname', 'POST', nickname),
+    ('/won', 'POST', won),
+    ('/leaderboard', 'POST', leaderboard),
+    ('/revert', 'POST', revert),
+    ('/reset', 'POST', reset),
+]
+COMMANDS = [
+    check_standings_command, rebuild_checkpoints_command, digest_command, export_matches_command,
+    import_matches_command
+]
+
+
+def create_app(config: dict = None) -> Flask:
+    """ Creates the app with the given config, read from the environment by default.
+
+    Optional integrations are imported when first used, see warm_up for what a preloading server should do up front.
+    """
+    app = Flask(__name__)
+    app.config.update(load_config(os.environ) if config is None else config)
+    init_sentry(app.config['SENTRY_DSN'])
+    init_state(app.config)
+    for rule, method, view in ROUTES:
+        app.add_url_rule(rule, view_func=view, methods=[method])
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.register_error_handler(500, handle_internal_server_error)
+    for command in COMMANDS:
+        app.cli.add_command(command)
+    return app
+
+
+def warm_up(app: Flask, connect: bool = True):
+    """ Does the one-off work of the first request ahead of time: configures the mappers, imports the replay engine
+    and creates the database engine, opening its first pooled connection if `connect` is set.
+
+    Run it before forking workers (with connect=False, connections must not be shared with the children) and again
+    in every worker.
+    """
+    configure_mappers()
+    get_replay(app.config['ELO_ENGINE'])
+    engine = get_engine(app.config)
+    if connect:
+        with engine.connect() as connection:
+            connection.execute('SELECT 1')
+
+
+app = create_app()
+
 if __name__ == "__main__":
     app.run()  # pragma: nocover
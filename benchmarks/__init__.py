@@ -0,0 +1,21 @@
+""" Benchmarks of the leaderboard pipeline.
+
+They run against a local database (a throwaway SQLite file by default) and need neither Slack nor network access:
+
+    python -m benchmarks.leaderboard --sizes 10,1000,100000 --output results.json --baseline previous.json
+"""
+import os
+
+from importlib import import_module
+
+
+def load_app(database_url: str, **config):
+    """ Returns the Flask app configured to use the given database.
+    """
+    os.environ.setdefault('SLACK_APP_PONG_DATABASE_URL', database_url)
+    for name in ['SLACK_APP_PONG_SIGNING_SECRET', 'SLACK_APP_PONG_CLIENT_ID', 'SLACK_APP_PONG_CLIENT_SECRET']:
+        os.environ.setdefault(name, 'benchmark')
+    app = import_module('app').app
+    app.config['DATABASE_URL'] = database_url
+    app.config.update(config)
+    return app
@@ -0,0 +1,103 @@
+""" Measures the throughput of digest leaderboards over many channels, one channel at a time against the batch API with
+a growing number of worker processes.
+
+    python -m benchmarks.digest [--database-url URL] [--channels 200] [--matches 1000] [--processes 1,2,4]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from typing import List
+
+from benchmarks import load_app
+from benchmarks.generate import generate
+from benchmarks.leaderboard import measure
+
+
+def run(database_url: str, channels: int, matches: int, players: int, processes: List[int], repeat: int,
+        seed: int = 0) -> dict:
+    """ Times the leaderboards of every channel, with standings that need a replay and with valid ones.
+    """
+    app = load_app(database_url)
+    from app import leaderboard_cache, render_leaderboard
+    from database import get_engine, get_session
+    from digest import render_leaderboards
+    from elo import get_standings, invalidate_standings
+    from models import Base
+
+    engine = get_engine(app.config)
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    results = []
+    with app.app_context():
+        with get_session() as db:
+            channel_ids = generate(db, players=players, matches=matches, channels=channels, seed=seed)
+
+        def invalidate():
+            leaderboard_cache.clear()
+            with get_session() as db:
+                for channel_id in channel_ids:
+                    invalidate_standings(db, channel_id=channel_id)
+
+        def rebuild():
+            leaderboard_cache.clear()
+            with get_session() as db:
+                for channel_id in channel_ids:
+                    get_standings(db, channel_id=channel_id)
+
+        def per_channel():
+            with get_session() as db:
+                for channel_id in channel_ids:
+                    render_leaderboard(db, channel_id=channel_id)
+                db.rollback()  # standings rebuilt by replay are thrown away, like the batch API doesn't write them
+
+        def batch(count):
+            def function():
+                with get_session() as db:
+                    render_leaderboards(db, channel_ids=channel_ids, processes=count)
+            return function
+
+        cases = [('per_channel', per_channel)] + [(f'batch_{count}', batch(count)) for count in processes]
+        for standings, setup in [('replay', invalidate), ('valid', rebuild)]:
+            for name, function in cases:
+                timing = measure(function, repeat, setup=setup)
+                results.append(dict(
+                    timing,
+                    benchmark=f'{name}_{standings}',
+                    channels=channels,
+                    matches=matches,
+                    channels_per_second=channels / timing['median']
+                ))
+    return {'results': results, 'environment': {'cpu_count': os.cpu_count()}}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file, all tables are dropped')
+    parser.add_argument('--channels', type=int, default=200)
+    parser.add_argument('--matches', type=int, default=1000, help='matches per channel')
+    parser.add_argument('--players', type=int, default=30)
+    parser.add_argument('--processes', default='1,2,4', help='comma separated worker process counts')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write machine-readable results to this JSON file')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = args.database_url or 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+        results = run(database_url, channels=args.channels, matches=args.matches, players=args.players,
+                      processes=[int(x) for x in args.processes.split(',')], repeat=args.repeat, seed=args.seed)
+
+    for x in results['results']:
+        print(f'{x["benchmark"]:>20} {x["channels"]:>5} channels x {x["matches"]:>6} matches  '
+              f'median {x["median"] * 1000:10.3f} ms  {x["channels_per_second"]:8.1f} channels/s')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
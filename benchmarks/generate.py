@@ -0,0 +1,68 @@
+import random
+
+from datetime import datetime, timedelta
+from typing import List
+
+from models import AppUser, Team, Channel, Match
+
+
+def pick_match(rnd: random.Random, app_user_ids: List[int], activity: List[float], skill: List[float]):
+    """ Picks two different players, active players play more often and the better one usually wins.
+    """
+    while True:
+        a, b = rnd.choices(range(len(app_user_ids)), weights=activity, k=2)
+        if a != b:
+            break
+    if rnd.random() < skill[a] / (skill[a] + skill[b]):
+        return app_user_ids[a], app_user_ids[b]
+    return app_user_ids[b], app_user_ids[a]
+
+
+def generate(db, players: int, matches: int, channels: int = 1, seed: int = 0, batch_size: int = 10000) -> List[int]:
+    """ Writes a team with the given number of players and channels, each channel holding `matches` matches.
+
+    The same seed always produces the same history. Channel standings are left to be rebuilt by replay.
+    Returns the ids of the created channels.
+    """
+    rnd = random.Random(seed)
+    started_at = datetime(2019, 1, 1)
+
+    team = Team(slack_team_id=f'TBENCH{seed}', slack_team_domain=f'benchmark-{seed}')
+    db.add(team)
+    db.flush()
+    app_users = [
+        AppUser(team_id=team.id, slack_user_id=f'UBENCH{i}', slack_user_name=f'player {i}') for i in range(players)
+    ]
+    db.add_all(app_users)
+    db.flush()
+    app_user_ids = [x.id for x in app_users]
+    activity = [1 / (i + 1) for i in range(players)]  # Zipf-like, a few players play most of the matches
+    skill = [rnd.lognormvariate(0, 0.5) for _ in range(players)]
+
+    channel_ids = []
+    for c in range(channels):
+        channel = Channel(
+            team_id=team.id,
+            slack_channel_id=f'CBENCH{c}',
+            slack_channel_name=f'benchmark-{c}',
+            rankings_reset_at=started_at
+        )
+        db.add(channel)
+        db.flush()
+        channel_ids.append(channel.id)
+        rows = []
+        for i in range(matches):
+            winner_id, loser_id = pick_match(rnd, app_user_ids=app_user_ids, activity=activity, skill=skill)
+            rows.append({
+                'channel_id': channel.id,
+                'winner_id': winner_id,
+                'loser_id': loser_id,
+                'timestamp': started_at + timedelta(minutes=i)
+            })
+            if len(rows) == batch_size:
+                db.execute(Match.__table__.insert(), rows)
+                rows = []
+        if rows:
+            db.execute(Match.__table__.insert(), rows)
+    db.flush()
+    return channel_ids
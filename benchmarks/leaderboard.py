@@ -0,0 +1,200 @@
+""" Times the leaderboard pipeline for channels with a growing number of matches.
+
+    python -m benchmarks.leaderboard [--database-url URL] [--sizes 10,100,1000] [--output results.json]
+                                     [--baseline previous.json] [--max-regression 1.25]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from importlib import import_module
+from random import Random
+from typing import List
+
+import sqlalchemy
+
+from benchmarks import load_app
+from benchmarks.generate import generate
+from benchmarks.slack import sign, command_body, mention
+
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000]
+
+
+def get_engines() -> List[str]:
+    try:
+        import numpy  # noqa: F401
+    except ImportError:  # pragma: nocover
+        return ['python']
+    return ['python', 'numpy']
+
+
+def measure(function, repeat: int, setup=None) -> dict:
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return {'min': min(timings), 'median': statistics.median(timings), 'repeat': repeat}
+
+
+def measure_memory(function) -> int:
+    """ Returns the peak memory allocated by the function, in bytes.
+    """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_size(app, matches: int, players: int, repeat: int, seed: int = 0) -> List[dict]:
+    """ Generates a channel with the given number of matches and times every stage of the pipeline on it.
+    """
+    from database import get_engine, get_session
+    from elo import (
+        get_leaderboard, get_match_history, get_replay, invalidate_standings, iter_match_history, replay,
+        get_standings_as_of, delete_checkpoints, rebuild_checkpoints
+    )
+    from models import Base
+    get_leaderboard_lines = import_module('app').get_leaderboard_lines
+
+    engine = get_engine(app.config)
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+
+    results = {}
+    with app.app_context():
+        with get_session() as db:
+            channel_id, = generate(db, players=players, matches=matches, seed=seed)
+
+        with get_session() as db:
+            results['load_history'] = measure(lambda: get_match_history(db, channel_id=channel_id), repeat)
+            history = get_match_history(db, channel_id=channel_id)
+            for name in get_engines():
+                results[f'replay_{name}'] = measure(lambda: get_replay(name)(history), repeat)
+            # history loading plus replay, full ORM objects vs streamed (id, winner_id, loser_id, batched) batches
+            for name, load in [('orm', get_match_history), ('streaming', iter_match_history)]:
+                def load_and_replay():
+                    return replay(load(db, channel_id=channel_id))
+                results[f'load_and_replay_{name}'] = dict(
+                    measure(load_and_replay, repeat),
+                    peak_bytes=measure_memory(load_and_replay)
+                )
+            results['rebuild'] = measure(
+                lambda: get_leaderboard(db, channel_id=channel_id),
+                repeat,
+                setup=lambda: invalidate_standings(db, channel_id=channel_id)
+            )
+            results['get_leaderboard'] = measure(lambda: get_leaderboard(db, channel_id=channel_id), repeat)
+            leaderboard = get_leaderboard(db, channel_id=channel_id)
+            results['render'] = measure(lambda: get_leaderboard_lines(db=db, leaderboard=leaderboard), repeat)
+            # historical leaderboard three quarters into the history, replayed from the start vs from a checkpoint
+            as_of = history[len(history) * 3 // 4].timestamp
+            delete_checkpoints(db, channel_id=channel_id)
+            results['as_of'] = measure(lambda: get_standings_as_of(db, channel_id=channel_id, as_of=as_of), repeat)
+            rebuild_checkpoints(db, channel_id=channel_id)
+            results['as_of_checkpoints'] = measure(
+                lambda: get_standings_as_of(db, channel_id=channel_id, as_of=as_of), repeat
+            )
+
+        def invalidate():
+            with get_session() as db:
+                invalidate_standings(db, channel_id=channel_id)
+
+        client = app.test_client()
+        rnd = Random(seed)
+
+        def won():
+            winner, loser = rnd.sample(range(players), 2)
+            body = command_body('/won', team_id=f'TBENCH{seed}', channel_id='CBENCH0', user_id=f'UBENCH{winner}',
+                                text=mention(f'UBENCH{loser}'))
+            response = client.post('/won', data=body, headers=sign(app.config['SIGNING_SECRET'], body))
+            assert response.status_code == 200, response.status_code
+
+        results['won'] = measure(won, repeat)
+        results['won_after_reset'] = measure(won, repeat, setup=invalidate)
+
+    return [dict(benchmark=name, matches=matches, players=players, **timing) for name, timing in results.items()]
+
+
+def run(database_url: str, sizes: List[int], players: int, repeat: int, seed: int = 0) -> dict:
+    app = load_app(database_url)
+    results = []
+    for matches in sizes:
+        results.extend(run_size(app, matches=matches, players=players, repeat=repeat, seed=seed))
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'sqlalchemy': sqlalchemy.__version__,
+            'database': sqlalchemy.engine.url.make_url(database_url).get_backend_name()
+        },
+        'results': results
+    }
+
+
+def compare(results: dict, baseline: dict) -> List[dict]:
+    """ Pairs every result with the baseline result of the same benchmark and size.
+    """
+    previous = {(x['benchmark'], x['matches']): x for x in baseline['results']}
+    rows = []
+    for x in results['results']:
+        if (x['benchmark'], x['matches']) in previous:
+            before = previous[(x['benchmark'], x['matches'])]['median']
+            rows.append({
+                'benchmark': x['benchmark'],
+                'matches': x['matches'],
+                'baseline': before,
+                'median': x['median'],
+                'ratio': x['median'] / before if before else float('inf')
+            })
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file, all tables are dropped')
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)), help='comma separated match counts')
+    parser.add_argument('--players', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write machine-readable results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file of a previous run to compare with')
+    parser.add_argument('--max-regression', type=float, default=1.25,
+                        help='exit with status 1 if a median is slower than the baseline by this factor')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = args.database_url or 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+        results = run(database_url, sizes=[int(x) for x in args.sizes.split(',')], players=args.players,
+                      repeat=args.repeat, seed=args.seed)
+
+    for x in results['results']:
+        memory = f'  peak {x["peak_bytes"] / 2 ** 20:8.2f} MiB' if 'peak_bytes' in x else ''
+        print(f'{x["benchmark"]:>25} {x["matches"]:>8} matches  median {x["median"] * 1000:10.3f} ms{memory}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            rows = compare(results, json.load(f))
+        for x in rows:
+            print(f'{x["benchmark"]:>25} {x["matches"]:>8} matches  {x["ratio"]:6.2f}x baseline')
+        if any(x['ratio'] > args.max_regression for x in rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
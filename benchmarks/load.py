@@ -0,0 +1,257 @@
+""" Replays signed slash command traffic against a running app at a target rate and reports latency percentiles, error
+rates and the share of responses slower than Slack's 3 second limit.
+
+    python -m benchmarks.load --serve --database-url postgres://localhost/slack_pong_load [--rps 20] [--duration 30]
+    python -m benchmarks.load --url http://127.0.0.1:8000 --signing-secret SECRET [--mix won=70,revert=5,...]
+
+With --serve a gunicorn (gunicorn.conf.py, WEB_CONCURRENCY workers) is started on the given database, whose tables are
+dropped and created first. Only local servers and databases are accepted.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from random import Random
+from typing import Dict, List
+from urllib.parse import urlparse
+
+from sqlalchemy.engine.url import make_url
+
+from benchmarks.slack import command_body, mention, sign
+
+
+COMMANDS = ('won', 'revert', 'reset', 'nickname', 'leaderboard')
+DEFAULT_MIX = 'won=70,leaderboard=15,revert=8,nickname=5,reset=2'
+LOCAL_HOSTS = (None, '', 'localhost', '127.0.0.1', '::1')
+SLACK_TIMEOUT = 3  # seconds Slack waits for a slash command's response
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """ Parses `command=weight,...` into weights by command.
+    """
+    weights = {}
+    for part in mix.split(','):
+        command, weight = part.split('=')
+        assert command in COMMANDS, f'unknown command {command}, expected one of {", ".join(COMMANDS)}'
+        weights[command] = float(weight)
+    assert sum(weights.values()) > 0
+    return weights
+
+
+def zipf_weights(count: int, skew: float) -> List[float]:
+    """ Weights of ranks 1..count, a few channels (players) account for most of the traffic when skew is about 1.
+    """
+    return [1 / rank ** skew for rank in range(1, count + 1)]
+
+
+class Traffic:
+    """ Seeded generator of slash commands: channels are picked with a Zipf distribution, each channel has its own
+    roster of regulars drawn from its team, in which players are picked with a Zipf distribution as well.
+    """
+
+    def __init__(self, mix: Dict[str, float], teams: int, channels: int, players: int, roster: int, skew: float,
+                 seed: int = 0):
+        assert players >= roster >= 2
+        self.rnd = Random(seed)
+        self.commands, self.command_weights = list(mix), list(mix.values())
+        self.channels = [(f'TLOAD{i % teams}', f'CLOAD{i}') for i in range(channels)]
+        self.channel_weights = zipf_weights(channels, skew)
+        self.rosters = [self.rnd.sample([f'ULOAD{x}' for x in range(players)], roster) for _ in range(channels)]
+        self.player_weights = zipf_weights(roster, skew)
+
+    def next(self):
+        """ Returns the command name and form body of the next request.
+        """
+        command = self.rnd.choices(self.commands, self.command_weights)[0]
+        i = self.rnd.choices(range(len(self.channels)), self.channel_weights)[0]
+        team_id, channel_id = self.channels[i]
+        user_id, *opponents = self.pick_players(self.rosters[i], count=3)
+        text = ''
+        if command == 'won':  # mostly singles, now and then a doubles session reported at once
+            text = ' '.join(mention(x) for x in opponents[:2 if self.rnd.random() < 0.1 else 1])
+        elif command == 'nickname':
+            text = f'nick{self.rnd.randrange(1000)}'
+        return command, command_body(f'/{command}', team_id=team_id, channel_id=channel_id, user_id=user_id, text=text)
+
+    def pick_players(self, roster: List[str], count: int) -> List[str]:
+        picked = []
+        while len(picked) < count:
+            x = self.rnd.choices(roster, self.player_weights)[0]
+            if x not in picked:
+                picked.append(x)
+        return picked
+
+
+def percentile(values: List[float], p: float) -> float:
+    """ Nearest-rank percentile of the values.
+    """
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))] if values else 0.0
+
+
+def summarize(samples: List[tuple], duration: float) -> dict:
+    """ Aggregates (command, latency, ok) samples, overall and per command.
+    """
+    def stats(rows):
+        latencies = [x[1] for x in rows]
+        return {
+            'requests': len(rows),
+            'rps': len(rows) / duration,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'mean': statistics.mean(latencies) if latencies else 0.0,
+            'error_rate': sum(not x[2] for x in rows) / len(rows) if rows else 0.0,
+            'over_slack_timeout': sum(x[1] > SLACK_TIMEOUT for x in rows) / len(rows) if rows else 0.0
+        }
+    result = {'all': stats(samples)}
+    for command in sorted({x[0] for x in samples}):
+        result[command] = stats([x for x in samples if x[0] == command])
+    return result
+
+
+def run(url: str, signing_secret: str, rps: float, duration: float, mix: Dict[str, float], teams: int = 2,
+        channels: int = 10, players: int = 40, roster: int = 8, skew: float = 1.0, concurrency: int = 32,
+        arrivals: str = 'poisson', timeout: float = 10, seed: int = 0) -> dict:
+    """ Sends requests at `rps` (open loop, on a fixed or Poisson schedule) for `duration` seconds.
+
+    Latency is measured from the scheduled send time, so a server (or generator) that falls behind shows up in the
+    latency instead of silently lowering the rate.
+    """
+    import requests
+
+    assert urlparse(url).hostname in LOCAL_HOSTS, f'{url} is not a local server'
+    assert arrivals in ('poisson', 'uniform')
+    traffic = Traffic(mix, teams=teams, channels=channels, players=players, roster=roster, skew=skew, seed=seed)
+    schedule_rnd = Random(seed + 1)
+    local = threading.local()
+    samples = []
+    lock = threading.Lock()
+
+    def send(scheduled: float, command: str, body: str):
+        session = getattr(local, 'session', None) or requests.Session()
+        local.session = session
+        try:
+            response = session.post(f'{url.rstrip("/")}/{command}', data=body, headers=sign(signing_secret, body),
+                                    timeout=timeout)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        latency = time.perf_counter() - scheduled
+        with lock:
+            samples.append((command, latency, ok))
+
+    start = time.perf_counter()
+    scheduled = start
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while scheduled < start + duration:
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, scheduled, *traffic.next())
+            scheduled += schedule_rnd.expovariate(rps) if arrivals == 'poisson' else 1 / rps
+    elapsed = time.perf_counter() - start
+    return {
+        'summary': summarize(samples, duration=elapsed),
+        'settings': {'url': url, 'rps': rps, 'duration': duration, 'mix': mix, 'teams': teams, 'channels': channels,
+                     'players': players, 'roster': roster, 'skew': skew, 'concurrency': concurrency,
+                     'arrivals': arrivals, 'seed': seed}
+    }
+
+
+@contextmanager
+def serve(database_url: str, signing_secret: str, workers: int, env: dict = None):
+    """ Starts gunicorn on a free local port with fresh tables in the given local database, yields its URL.
+    """
+    from models import Base
+    from sqlalchemy import create_engine
+
+    assert make_url(database_url).host in LOCAL_HOSTS, f'{database_url} is not a local database'
+    engine = create_engine(database_url)
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    engine.dispose()
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, **(env or {}), PORT=str(port), WEB_CONCURRENCY=str(workers),
+               SLACK_APP_PONG_DATABASE_URL=database_url, SLACK_APP_PONG_SIGNING_SECRET=signing_secret)
+    for name in ['SLACK_APP_PONG_CLIENT_ID', 'SLACK_APP_PONG_CLIENT_SECRET']:
+        env.setdefault(name, 'load')
+    env.pop('NEW_RELIC_LICENSE_KEY', None)
+    server = subprocess.Popen([  # gunicorn 19 can't be run with -m gunicorn
+        sys.executable, '-m', 'gunicorn.app.wsgiapp', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}', 'app:app'
+    ], cwd=root, env=env)
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if server.poll() is not None or time.time() > deadline:
+                    raise RuntimeError('gunicorn did not start')
+                time.sleep(0.1)
+        yield f'http://127.0.0.1:{port}'
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='app to load, unless --serve is given')
+    parser.add_argument('--serve', action='store_true', help='start gunicorn on --database-url for the run')
+    parser.add_argument('--database-url', help='local database for --serve, all tables are dropped')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers with --serve')
+    parser.add_argument('--signing-secret', default=os.getenv('SLACK_APP_PONG_SIGNING_SECRET', 'load'))
+    parser.add_argument('--rps', type=float, default=20)
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='comma separated command=weight')
+    parser.add_argument('--teams', type=int, default=2)
+    parser.add_argument('--channels', type=int, default=10)
+    parser.add_argument('--players', type=int, default=40, help='per team')
+    parser.add_argument('--roster', type=int, default=8, help='regular players per channel')
+    parser.add_argument('--skew', type=float, default=1.0, help='Zipf exponent of channel and player popularity')
+    parser.add_argument('--concurrency', type=int, default=32, help='requests in flight at most')
+    parser.add_argument('--arrivals', choices=('poisson', 'uniform'), default='poisson')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write machine-readable results to this JSON file')
+    args = parser.parse_args(argv)
+    if args.serve and not args.database_url:
+        parser.error('--serve requires --database-url')
+
+    def load(url):
+        return run(url, signing_secret=args.signing_secret, rps=args.rps, duration=args.duration,
+                   mix=parse_mix(args.mix), teams=args.teams, channels=args.channels, players=args.players,
+                   roster=args.roster, skew=args.skew, concurrency=args.concurrency, arrivals=args.arrivals,
+                   seed=args.seed)
+
+    if args.serve:
+        with serve(args.database_url, signing_secret=args.signing_secret, workers=args.workers) as url:
+            results = load(url)
+    else:
+        results = load(args.url)
+
+    for command, x in results['summary'].items():
+        print(f'{command:>12} {x["requests"]:>7} requests {x["rps"]:7.1f}/s  p50 {x["p50"] * 1000:8.1f} ms  '
+              f'p95 {x["p95"] * 1000:8.1f} ms  p99 {x["p99"] * 1000:8.1f} ms  errors {x["error_rate"]:6.1%}  '
+              f'over 3 s {x["over_slack_timeout"]:6.1%}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
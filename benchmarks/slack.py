@@ -0,0 +1,43 @@
+import hashlib
+import hmac
+import time
+import uuid
+
+from urllib.parse import urlencode
+
+
+def sign(signing_secret: str, body: str, timestamp: int = None) -> dict:
+    """ Returns the headers Slack sends along with a request body.
+
+    See https://api.slack.com/docs/verifying-requests-from-slack
+    """
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(signing_secret.encode(), f'v0:{timestamp}:{body}'.encode(), hashlib.sha256).hexdigest()
+    return {
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'X-Slack-Request-Timestamp': str(timestamp),
+        'X-Slack-Signature': f'v0={signature}'
+    }
+
+
+def command_body(command: str, team_id: str, channel_id: str, user_id: str, text: str = '',
+                 trigger_id: str = None) -> str:
+    """ Returns the form encoded body of a slash command.
+    """
+    return urlencode({
+        'token': 'benchmark',
+        'command': command,
+        'team_id': team_id,
+        'team_domain': team_id.lower(),
+        'channel_id': channel_id,
+        'channel_name': channel_id.lower(),
+        'user_id': user_id,
+        'user_name': user_id.lower(),
+        'text': text,
+        'response_url': f'https://hooks.slack.invalid/commands/{team_id}/{channel_id}',
+        'trigger_id': trigger_id or uuid.uuid4().hex  # makes otherwise equal commands sent within a second differ
+    })
+
+
+def mention(user_id: str) -> str:
+    return f'<@{user_id}|{user_id.lower()}>'
@@ -0,0 +1,130 @@
+""" Times how long a fresh worker process takes to import the app and to serve its first request, with and without
+warm_up, and lists optional modules that got imported along with the app.
+
+    python -m benchmarks.startup [--database-url URL] [--repeat 5] [--output results.json]
+                                 [--baseline previous.json] [--max-regression 1.25]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from typing import List
+
+from sqlalchemy import create_engine
+
+# imported when first used, a worker that has them loaded right after `import app` pays for them on every start
+LAZY_MODULES = ('requests', 'sentry_sdk', 'numpy', 'concurrent.futures.process')
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+eager = [x for x in sys.argv[2].split(',') if x in sys.modules]
+warm_up = float(sys.argv[1])
+if warm_up:
+    app.warm_up(app.app)
+warmed = time.perf_counter()
+from benchmarks.slack import sign, command_body
+client = app.app.test_client()
+timings = []
+for _ in range(2):
+    body = command_body('/leaderboard', team_id='TSTARTUP', channel_id='CSTARTUP', user_id='USTARTUP')
+    before = time.perf_counter()
+    response = client.post('/leaderboard', data=body, headers=sign(app.app.config['SIGNING_SECRET'], body))
+    assert response.status_code == 200, response.status_code
+    timings.append(time.perf_counter() - before)
+print(json.dumps({'import': imported - start, 'warm_up': warmed - imported, 'first_request': timings[0],
+                  'warm_request': timings[1], 'eager_modules': eager}))
+"""
+
+
+def probe(database_url: str, warm_up: bool) -> dict:
+    """ Imports the app in a new interpreter and sends it two requests.
+    """
+    env = dict(os.environ, SLACK_APP_PONG_DATABASE_URL=database_url)
+    for name in ['SLACK_APP_PONG_SIGNING_SECRET', 'SLACK_APP_PONG_CLIENT_ID', 'SLACK_APP_PONG_CLIENT_SECRET']:
+        env.setdefault(name, 'benchmark')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE, '1' if warm_up else '0', ','.join(LAZY_MODULES)],
+        cwd=root, env=env, stdout=subprocess.PIPE, check=True
+    ).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def run(database_url: str, repeat: int) -> dict:
+    from models import Base
+
+    engine = create_engine(database_url)
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    engine.dispose()
+    results = []
+    eager_modules = set()
+    for warm_up in (False, True):
+        samples = [probe(database_url, warm_up=warm_up) for _ in range(repeat)]
+        eager_modules.update(x for sample in samples for x in sample['eager_modules'])
+        names = ['import', 'warm_up', 'first_request', 'warm_request'] if warm_up else \
+            ['import', 'first_request', 'warm_request']
+        for name in names:
+            timings = [x[name] for x in samples]
+            results.append({
+                'benchmark': f'{name}_after_warm_up' if warm_up and name != 'warm_up' else name,
+                'min': min(timings),
+                'median': statistics.median(timings),
+                'repeat': repeat
+            })
+    return {'results': results, 'eager_modules': sorted(eager_modules)}
+
+
+def compare(results: dict, baseline: dict) -> List[dict]:
+    """ Pairs every result with the baseline result of the same benchmark.
+    """
+    previous = {x['benchmark']: x['median'] for x in baseline['results']}
+    return [{
+        'benchmark': x['benchmark'],
+        'baseline': previous[x['benchmark']],
+        'median': x['median'],
+        'ratio': x['median'] / previous[x['benchmark']] if previous[x['benchmark']] else float('inf')
+    } for x in results['results'] if x['benchmark'] in previous]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file, all tables are dropped')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write machine-readable results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file of a previous run to compare with')
+    parser.add_argument('--max-regression', type=float, default=1.25,
+                        help='exit with status 1 if a median is slower than the baseline by this factor')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = args.database_url or 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+        results = run(database_url, repeat=args.repeat)
+
+    for x in results['results']:
+        print(f'{x["benchmark"]:>30}  median {x["median"] * 1000:10.3f} ms  min {x["min"] * 1000:10.3f} ms')
+    print(f'{"eager optional modules":>30}  {", ".join(results["eager_modules"]) or "none"}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    status = 1 if results['eager_modules'] else 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            rows = compare(results, json.load(f))
+        for x in rows:
+            print(f'{x["benchmark"]:>30}  {x["ratio"]:6.2f}x baseline')
+        if any(x['ratio'] > args.max_regression for x in rows):
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
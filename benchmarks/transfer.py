@@ -0,0 +1,105 @@
+""" Measures the throughput of match history export and import, with COPY (Postgres only) and the batched fallback.
+
+    python -m benchmarks.transfer [--database-url URL] [--sizes 10000,100000,1000000] [--output results.json]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from itertools import count
+from typing import List
+
+from benchmarks import load_app
+from benchmarks.generate import generate
+from benchmarks.leaderboard import measure, measure_memory
+
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+
+
+def run_size(app, directory: str, matches: int, players: int, repeat: int, seed: int = 0) -> List[dict]:
+    """ Generates a channel with the given number of matches, exports it and imports the files into new channels.
+    """
+    import transfer
+    from database import get_engine, get_session, get_channel
+    from models import Base, Channel
+
+    engine = get_engine(app.config)
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    methods = ['copy', 'batched'] if engine.dialect.name == 'postgresql' else ['batched']
+    channels = count()
+    results = []
+    with app.app_context():
+        with get_session() as db:
+            channel_id, = generate(db, players=players, matches=matches, seed=seed)
+            team_id = db.query(Channel.team_id).filter(Channel.id == channel_id).scalar()
+
+        original = transfer.use_copy
+        for method in methods:
+            transfer.use_copy = original if method == 'copy' else (lambda db: False)
+            try:
+                for format in transfer.FORMATS:
+                    path = os.path.join(directory, f'matches.{format}')
+
+                    def export():
+                        with get_session() as db, open(path, 'w') as f:
+                            transfer.export_matches(db, channel_id=channel_id, file=f, format=format)
+
+                    def import_():
+                        with get_session() as db, open(path) as f:
+                            channel = get_channel(db, team_id=team_id, slack_channel_id=f'CIMPORT{next(channels)}',
+                                                  slack_channel_name='import')
+                            transfer.import_matches(db, channel_id=channel.id, file=f, format=format)
+
+                    for name, function in [('export', export), ('import', import_)]:
+                        timing = measure(function, repeat)
+                        results.append(dict(
+                            timing,
+                            benchmark=f'{name}_{format}_{method}',
+                            matches=matches,
+                            rows_per_second=matches / timing['median'],
+                            peak_bytes=measure_memory(function)
+                        ))
+            finally:
+                transfer.use_copy = original
+    return results
+
+
+def run(database_url: str, sizes: List[int], players: int, repeat: int, seed: int = 0) -> dict:
+    app = load_app(database_url)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for matches in sizes:
+            results.extend(run_size(app, directory, matches=matches, players=players, repeat=repeat, seed=seed))
+    return {'results': results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file, all tables are dropped')
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)), help='comma separated match counts')
+    parser.add_argument('--players', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write machine-readable results to this JSON file')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = args.database_url or 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+        results = run(database_url, sizes=[int(x) for x in args.sizes.split(',')], players=args.players,
+                      repeat=args.repeat, seed=args.seed)
+
+    for x in results['results']:
+        print(f'{x["benchmark"]:>20} {x["matches"]:>8} matches  median {x["median"] * 1000:10.3f} ms  '
+              f'{x["rows_per_second"]:10.0f} rows/s  peak {x["peak_bytes"] / 2 ** 20:8.2f} MiB')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,230 @@
+import time
+
+from collections import OrderedDict
+from threading import Event, Lock
+
+
+class LRUCache:
+    """ Thread-safe mapping that holds at most `maxsize` entries, evicting the least recently used one first.
+
+    A maxsize of 0 disables the cache.
+    """
+
+    def __init__(self, maxsize: int):
+        assert isinstance(maxsize, int) and maxsize >= 0
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            if self.maxsize == 0:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def evict(self, predicate):
+        """ Removes every entry whose key satisfies the predicate.
+        """
+        with self._lock:
+            for key in [x for x in self._entries if predicate(x)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+class ExpiringSet:
+    """ Thread-safe set of keys that each expire at a given time, holding at most `maxsize` unexpired keys.
+
+    Expired keys are dropped as keys are added, beyond maxsize the oldest key is evicted first. A maxsize of 0 disables
+    the set.
+    """
+
+    def __init__(self, maxsize: int, clock=time.time):
+        assert isinstance(maxsize, int) and maxsize >= 0
+        self.maxsize = maxsize
+        self.clock = clock
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> expiry time, in order of addition
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            expires = self._entries.get(key)
+            return expires is not None and expires >= self.clock()
+
+    def add(self, key, expires: float) -> bool:
+        """ Adds the key unless it's already present and unexpired, returns whether it was added.
+        """
+        with self._lock:
+            now = self.clock()
+            if self._entries.get(key, now - 1) >= now:
+                return False
+            if self.maxsize == 0:
+                return True
+            self._entries[key] = expires
+            self._entries.move_to_end(key)
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if oldest >= now and len(self._entries) <= self.maxsize:
+                    break
+                self._entries.popitem(last=False)
+                if oldest >= now:
+                    self.evictions += 1
+            return True
+
+    def discard(self, key):
+        """ Removes the key if it's present.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'evictions': self.evictions
+        }
+
+
+class Memo:
+    """ Thread-safe mapping of values loaded on first use and kept until they're evicted.
+
+    A value whose load raced an eviction isn't kept, as it may have been loaded before the change behind the eviction.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._values = {}
+        self._generation = 0  # incremented by every eviction
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    @property
+    def generation(self) -> int:
+        """ Changes with every eviction, a value derived from the memoized ones may be kept while it doesn't change.
+        """
+        with self._lock:
+            return self._generation
+
+    def get(self, key, load):
+        with self._lock:
+            if key in self._values:
+                self.hits += 1
+                return self._values[key]
+            self.misses += 1
+            generation = self._generation
+        value = load()
+        with self._lock:
+            if generation == self._generation:
+                self._values[key] = value
+        return value
+
+    def evict(self, key=None):
+        """ Drops the key's value, or every value if key is None.
+        """
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._values.clear()
+            else:
+                self._values.pop(key, None)
+
+
+class SingleFlight:
+    """ Coalesces concurrent calls by key: while one call for a key is running, other callers of the same key wait for
+    its result instead of making their own.
+
+    Waiting is bounded by `timeout` seconds, a waiter then (or when the running call failed) calls the function itself.
+    A timeout of 0 disables coalescing.
+    """
+
+    class Call:
+        def __init__(self):
+            self.done = Event()
+            self.result = None
+            self.failed = False
+
+    def __init__(self, timeout: float):
+        assert timeout >= 0
+        self.timeout = timeout
+        self.calls = 0
+        self.shared = 0
+        self.fallbacks = 0
+        self._running = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._running)
+
+    def do(self, key, function):
+        with self._lock:
+            call = self._running.get(key) if self.timeout else None
+            if call is None:
+                call = self._running[key] = SingleFlight.Call()
+                self.calls += 1
+                leader = True
+            else:
+                leader = False
+        if leader:
+            try:
+                call.result = function()
+                return call.result
+            except BaseException:
+                call.failed = True
+                raise
+            finally:
+                with self._lock:
+                    if self._running.get(key) is call:
+                        del self._running[key]
+                call.done.set()
+        if call.done.wait(self.timeout) and not call.failed:
+            with self._lock:
+                self.shared += 1
+            return call.result
+        with self._lock:
+            self.fallbacks += 1
+        return function()
+
+    def stats(self) -> dict:
+        return {
+            'running': len(self._running),
+            'calls': self.calls,
+            'shared': self.shared,
+            'fallbacks': self.fallbacks
+        }
@@ -0,0 +1,140 @@
+import logging
+import os
+import select
+import threading
+
+from sqlalchemy import select as sql_select, text
+from typing import Iterable
+
+from models import Channel
+
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_EVENTS = 'slack_pong_channel'  # Postgres notification channel, the payload is the id of the changed channel
+PUBLISHED = 'published_channel_ids'  # Session.info key of (transaction, ids of the channels it published)
+
+
+def publish_channel_changes(db, channel_ids: Iterable[int]):
+    """ Bumps the version of the channels and notifies the workers listening for changes once the transaction commits.
+
+    Every write that changes a rendered leaderboard (matches, reverts, resets, nicknames) publishes its channels.
+    """
+    channel_ids = sorted(set(channel_ids))
+    assert all(isinstance(x, int) for x in channel_ids)
+    if not channel_ids:
+        return
+    transaction, published = db.info.get(PUBLISHED, (None, set()))
+    db.info[PUBLISHED] = (db.transaction, (published if transaction is db.transaction else set()) | set(channel_ids))
+    db.query(Channel).filter(Channel.id.in_(channel_ids)).update(
+        {Channel.version: Channel.version + 1}, synchronize_session=False
+    )
+    if db.get_bind().dialect.name == 'postgresql':
+        db.execute(text('SELECT pg_notify(:event, CAST(id AS text)) FROM channel WHERE id = ANY(:channel_ids)'),
+                   {'event': CHANNEL_EVENTS, 'channel_ids': channel_ids})
+
+
+def has_pending_changes(db, channel_id: int) -> bool:
+    """ Whether the session's open transaction published a change of the channel, which it hasn't committed yet.
+    """
+    transaction, published = db.info.get(PUBLISHED, (None, ()))
+    return transaction is db.transaction and channel_id in published
+
+
+class ChannelListener:
+    """ Background thread that calls `on_change(channel_id)` for every channel change published by any worker.
+
+    On Postgres it LISTENs for the notifications, other backends poll the channel versions every `poll_interval`
+    seconds. When (re)connected it calls `on_change(None)` as changes may have been missed in the meantime, `connected`
+    tells whether changes are currently being delivered.
+    """
+
+    def __init__(self, on_change, poll_interval: float = 1.0, listen: bool = None):
+        assert poll_interval > 0
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.listen = listen
+        self.connected = False
+        self.events = 0
+        self.reconnects = 0
+        self._engine = None
+        self._pid = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self, engine):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # threads don't survive a fork, a worker process forked from a preloaded master starts its own
+            self._pid = os.getpid()
+            self._engine = engine
+            self.connected = False
+            self._stop.clear()
+            threading.Thread(target=self._run, name='channel-listener', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        self._pid = None
+
+    def stats(self) -> dict:
+        return {
+            'connected': int(self.connected),
+            'events': self.events,
+            'reconnects': self.reconnects
+        }
+
+    def _run(self):
+        listen = self._engine.dialect.name == 'postgresql' if self.listen is None else self.listen
+        while not self._stop.is_set():
+            try:
+                if listen:
+                    self._listen()
+                else:
+                    self._poll()
+            except Exception:
+                logger.exception('channel listener lost its connection, reconnecting')
+            finally:
+                self.connected = False
+            if self._stop.wait(self.poll_interval):
+                break
+            self.reconnects += 1
+
+    def _connected(self):
+        self.connected = True
+        self.on_change(None)
+
+    def _change(self, channel_id: int):
+        self.events += 1
+        self.on_change(channel_id)
+
+    def _listen(self):
+        # a connection of its own, a pooled one would be returned to the pool between notifications
+        cargs, cparams = self._engine.dialect.create_connect_args(self._engine.url)
+        connection = self._engine.dialect.connect(*cargs, **cparams)
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANNEL_EVENTS}')
+            self._connected()
+            while not self._stop.is_set():
+                if select.select([connection], [], [], self.poll_interval) == ([], [], []):
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    self._change(int(connection.notifies.pop(0).payload))
+        finally:
+            connection.close()
+
+    def _poll(self):
+        versions = None
+        while not self._stop.is_set():
+            with self._engine.connect() as connection:
+                current = dict(connection.execute(sql_select([Channel.id, Channel.version])).fetchall())
+            if versions is None:
+                self._connected()
+            else:
+                for channel_id in sorted(x for x in set(current) | set(versions) if current.get(x) != versions.get(x)):
+                    self._change(channel_id)
+            versions = current
+            self._stop.wait(self.poll_interval)
@@ -2,6 +2,8 @@ from pytest import fixture
 from database import get_session
 from models import Base
 from importlib import reload
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine.url import make_url
 import app
 
 
@@ -25,3 +27,22 @@ def db_session(client):
 def prepare_db(db_session):
     Base.metadata.drop_all(bind=db_session.get_bind())
     Base.metadata.create_all(bind=db_session.get_bind())
+
+
+@fixture
+def replica(client, prepare_db, db_session, monkeypatch):
+    """ A second local database configured as the read replica, with the same (empty) tables as the primary.
+
+    Nothing replicates to it on its own, tests copy the primary's rows over when the replica should catch up.
+    """
+    url = make_url(str(db_session.get_bind().url))
+    url.database += '_replica'
+    with db_session.get_bind().connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        if not connection.execute(text('SELECT 1 FROM pg_database WHERE datname = :name'), name=url.database).scalar():
+            connection.execute(f'CREATE DATABASE "{url.database}"')
+    engine = create_engine(url)
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    monkeypatch.setitem(client.application.config, 'REPLICA_DATABASE_URL', str(url))
+    yield engine
+    engine.dispose()
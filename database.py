@@ -1,26 +1,178 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine, event, exc, func, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import sessionmaker
+from channel_events import publish_channel_changes
 from contextlib import contextmanager
-from models import AppUser, Team, Channel, Match
+from elo import lock_channel, update_standings, save_last_checkpoint
+from models import AppUser, Installation, SeenSignature, Team, Channel, Match
 from datetime import datetime
 from flask import current_app
+from typing import Dict, List, NamedTuple, Tuple
+
+
+_engines = {}
+_sessionmakers = {}  # by engine, created along with it
+_engines_lock = threading.Lock()
+_pool_stats_lock = threading.Lock()  # the counters are updated by every thread of the worker
+_pool_stats = {
+    'checkouts': 0,
+    'connects': 0,
+    'invalidated': 0,
+    'wait_seconds_total': 0.0,
+    'wait_seconds_max': 0.0,
+    'replica_reads': 0,
+    'replica_fallbacks': 0,
+}
+
+
+def _count(stat: str, value=1):
+    with _pool_stats_lock:
+        _pool_stats[stat] += value
+
+
+def _engine_options(config, url: str):
+    if make_url(url).get_backend_name() == 'sqlite':
+        return ()  # SQLite (used by benchmarks) gets a NullPool or SingletonThreadPool, neither can be sized
+    return (
+        ('pool_size', config.get('DATABASE_POOL_SIZE', 5)),
+        ('max_overflow', config.get('DATABASE_MAX_OVERFLOW', 10)),
+        ('pool_timeout', config.get('DATABASE_POOL_TIMEOUT', 30)),
+        ('pool_recycle', config.get('DATABASE_POOL_RECYCLE', -1)),
+        ('pool_pre_ping', config.get('DATABASE_POOL_PRE_PING', True)),
+    )
+
+
+def _register_pool_events(engine):
+    """ Makes the pool safe to inherit across gunicorn forks.
+
+    Connections opened by another process (e.g. the gunicorn master when the app is preloaded) are invalidated on
+    checkout instead of being shared, see "Using Connection Pools with Multiprocessing" in the SQLAlchemy docs.
+    """
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+        _count('connects')
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info['pid'] != os.getpid():
+            _count('invalidated')
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                f'Connection record belongs to pid {connection_record.info["pid"]}, '
+                f'attempting to check out in pid {os.getpid()}'
+            )
+        _count('checkouts')
+
+
+def get_engine(config=None, replica: bool = False):
+    """ Returns the engine for the configured database (or its read replica, if one is configured), creating it on
+    first use within the current process.
+    """
+    config = config if config is not None else current_app.config
+    url = config.get('REPLICA_DATABASE_URL') if replica else None
+    url = url or config['DATABASE_URL']
+    options = _engine_options(config, url=url)
+    key = (url, options)
+    engine = _engines.get(key)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.get(key)
+            if engine is None:
+                engine = create_engine(url, **dict(options))
+                _register_pool_events(engine)
+                _sessionmakers[engine] = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+                _engines[key] = engine
+    return engine
+
+
+def get_pool_stats(config=None):
+    """ Returns pool usage counters, used to size DATABASE_POOL_SIZE and DATABASE_MAX_OVERFLOW.
+    """
+    pool = get_engine(config).pool
+    with _pool_stats_lock:
+        stats = dict(_pool_stats)
+    if not isinstance(pool, QueuePool):
+        return stats
+    return dict(
+        stats,
+        size=pool.size(),
+        checked_in=pool.checkedin(),
+        checked_out=pool.checkedout(),
+        overflow=pool.overflow(),
+    )
 
 
 @contextmanager
-def get_session():
+def get_session(replica: bool = False):
     """ Creates a context with an open SQLAlchemy session.
+
+    The session checks out a connection from the process-wide pool and returns it when the context is left. A replica
+    session is read-only and connects to REPLICA_DATABASE_URL if it's set, see get_read_session.
+    """
+    db_session = _sessionmakers[get_engine(replica=replica)]()
+    try:
+        start = time.perf_counter()
+        db_session.connection()
+        wait = time.perf_counter() - start
+        with _pool_stats_lock:
+            _pool_stats['wait_seconds_total'] += wait
+            _pool_stats['wait_seconds_max'] = max(_pool_stats['wait_seconds_max'], wait)
+        if replica and db_session.get_bind().dialect.name == 'postgresql':
+            db_session.execute('SET TRANSACTION READ ONLY')
+        yield db_session
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    finally:
+        db_session.close()
+
+
+def get_read_state(db, channel_id: int):
+    """ Returns the channel's leaderboard version and whether its standings are valid, or None if there's no such
+    channel (yet).
+    """
+    channel = db.query(Channel.standings_valid).filter(Channel.id == channel_id).first()
+    return channel and (tuple(get_leaderboard_version(db, channel_id=channel_id)), channel.standings_valid)
+
+
+@contextmanager
+def get_read_session(db, channel_id: int):
+    """ Creates a context with a session for the channel's leaderboard reads (history, standings and names).
+
+    That's a replica session if REPLICA_DATABASE_URL is set and the replica has caught up with `db`, the primary
+    session of the request, otherwise `db` itself. Read-your-writes rule: the replica is only used if it has the same
+    version of the channel (see get_leaderboard_version) as `db`, including `db`'s own uncommitted writes, and valid
+    standings, as rebuilding them is a write.
     """
-    engine = create_engine(current_app.config['DATABASE_URL'])
-    db_session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
-    yield db_session
-    db_session.commit()
-    db_session.close()
+    if not current_app.config.get('REPLICA_DATABASE_URL'):
+        yield db
+        return
+    with get_session(replica=True) as replica:
+        state = get_read_state(replica, channel_id=channel_id)
+        if state is not None and state == get_read_state(db, channel_id=channel_id) and state[1]:
+            _count('replica_reads')
+            yield replica
+            return
+    _count('replica_fallbacks')
+    yield db
 
 
-def get_display_name(db, app_user_id: int):
-    assert isinstance(app_user_id, int)
-    app_user = db.query(AppUser).get(app_user_id)
-    return app_user.nickname or app_user.slack_user_name
+def get_display_names(db, app_user_ids) -> dict:
+    """ Resolves nickname or slack name of every given app user with a single query.
+    """
+    app_user_ids = set(app_user_ids)
+    assert all(isinstance(x, int) for x in app_user_ids)
+    if not app_user_ids:
+        return {}
+    rows = db.query(AppUser.id, AppUser.nickname, AppUser.slack_user_name).filter(AppUser.id.in_(app_user_ids))
+    return {app_user_id: nickname or slack_user_name for app_user_id, nickname, slack_user_name in rows}
 
 
 def get_team(db, slack_team_id: str, slack_team_domain: str):
@@ -36,6 +188,50 @@ def get_team(db, slack_team_id: str, slack_team_domain: str):
     return team
 
 
+def save_installation(db, oauth_access: dict) -> Installation:
+    """ Stores the tokens of an oauth.access response, replacing those of an earlier installation into the team.
+    """
+    assert oauth_access['ok']
+    installation = get_installation(db, slack_team_id=oauth_access['team_id'])
+    if installation is None:
+        installation = Installation(slack_team_id=oauth_access['team_id'])
+        db.add(installation)
+    bot = oauth_access.get('bot') or {}
+    installation.slack_team_name = oauth_access['team_name']
+    installation.access_token = oauth_access['access_token']
+    installation.scope = oauth_access['scope']
+    installation.installed_by = oauth_access['user_id']
+    installation.bot_user_id = bot.get('bot_user_id')
+    installation.bot_access_token = bot.get('bot_access_token')
+    installation.installed_at = datetime.utcnow().replace(microsecond=0)
+    db.flush()
+    return installation
+
+
+def get_installation(db, slack_team_id: str):
+    """ Returns the team's installation (with the tokens for calls on its behalf) or None if it wasn't installed.
+    """
+    assert isinstance(slack_team_id, str)
+    return db.query(Installation).filter(Installation.slack_team_id == slack_team_id).one_or_none()
+
+
+INSERT_SEEN_SIGNATURE = """
+INSERT INTO seen_signature (signature, expires_at) VALUES (:signature, :expires_at)
+ON CONFLICT (signature) DO NOTHING
+"""
+
+
+def remember_signature(db, signature: str, expires_at: datetime, sweep: bool = False) -> bool:
+    """ Records the signature of an accepted request until it expires, returns False if any process recorded it before.
+
+    With sweep, expired signatures are deleted first.
+    """
+    assert isinstance(signature, str)
+    if sweep:
+        db.query(SeenSignature).filter(SeenSignature.expires_at < datetime.utcnow()).delete(synchronize_session=False)
+    return db.execute(text(INSERT_SEEN_SIGNATURE), {'signature': signature, 'expires_at': expires_at}).rowcount == 1
+
+
 def get_channel(db, team_id: int, slack_channel_id: str, slack_channel_name: str):
     assert isinstance(team_id, int)
     assert isinstance(slack_channel_id, str)
@@ -48,7 +244,8 @@ def get_channel(db, team_id: int, slack_channel_id: str, slack_channel_name: str
             team_id=team_id,
             slack_channel_id=slack_channel_id,
             slack_channel_name=slack_channel_name,
-            rankings_reset_at=datetime.utcnow().replace(microsecond=0)
+            rankings_reset_at=datetime.utcnow().replace(microsecond=0),
+            standings_valid=True  # no matches yet, the empty standings are up to date
         )
         db.add(channel)
         db.flush()
@@ -69,22 +266,165 @@ def get_app_user(db, team_id: int, slack_user_id: str, slack_user_name: str):
     return app_user
 
 
+class ResolvedIds(NamedTuple):
+    team_id: int
+    channel_id: int
+    app_user_ids: Dict[str, int]  # slack_user_id -> app_user.id
+
+
+# Only new teams, channels and users and renames lock rows: existing rows are neither updated nor locked by ON CONFLICT
+# DO NOTHING, unchanged names don't match the WHERE of the UPDATEs and the ids are read back with a plain SELECT. Rows
+# inserted by a concurrent transaction after the statement's snapshot are neither returned by the INSERT nor seen by the
+# SELECT, resolve_ids runs the statement again then.
+UPSERT_TEAM_CHANNEL = """
+WITH team_insert AS (
+    INSERT INTO team (slack_team_id, slack_team_domain, nickname_version)
+    VALUES (:slack_team_id, :slack_team_domain, 0)
+    ON CONFLICT (slack_team_id) DO NOTHING
+    RETURNING id
+), team_update AS (
+    UPDATE team SET slack_team_domain = :slack_team_domain
+    WHERE slack_team_id = :slack_team_id AND slack_team_domain IS DISTINCT FROM :slack_team_domain
+), team_row AS (
+    SELECT id FROM team_insert
+    UNION
+    SELECT id FROM team WHERE slack_team_id = :slack_team_id
+), channel_insert AS (
+    INSERT INTO channel (
+        team_id, slack_channel_id, slack_channel_name, rankings_reset_at, standings_valid, version, match_count
+    )
+    SELECT id, :slack_channel_id, :slack_channel_name, :rankings_reset_at, true, 0, 0 FROM team_row
+    ON CONFLICT (team_id, slack_channel_id) DO NOTHING
+    RETURNING id
+), channel_update AS (
+    UPDATE channel SET slack_channel_name = :slack_channel_name FROM team_row
+    WHERE channel.team_id = team_row.id AND channel.slack_channel_id = :slack_channel_id
+        AND channel.slack_channel_name IS DISTINCT FROM :slack_channel_name
+), channel_row AS (
+    SELECT id FROM channel_insert
+    UNION
+    SELECT channel.id FROM channel, team_row
+    WHERE channel.team_id = team_row.id AND channel.slack_channel_id = :slack_channel_id
+)
+"""
+
+UPSERT_APP_USERS = """
+, slack_user (id, name) AS (
+    VALUES {values}
+), app_user_insert AS (
+    INSERT INTO app_user (team_id, slack_user_id, slack_user_name)
+    SELECT team_row.id, slack_user.id, slack_user.name FROM team_row, slack_user
+    ON CONFLICT (team_id, slack_user_id) DO NOTHING
+    RETURNING id, slack_user_id
+), app_user_update AS (
+    UPDATE app_user SET slack_user_name = slack_user.name FROM team_row, slack_user
+    WHERE app_user.team_id = team_row.id AND app_user.slack_user_id = slack_user.id
+        AND app_user.slack_user_name IS DISTINCT FROM slack_user.name
+), app_user_rows AS (
+    SELECT id, slack_user_id FROM app_user_insert
+    UNION
+    SELECT app_user.id, app_user.slack_user_id FROM app_user, team_row, slack_user
+    WHERE app_user.team_id = team_row.id AND app_user.slack_user_id = slack_user.id
+)
+SELECT (SELECT id FROM team_row), (SELECT id FROM channel_row), app_user_rows.id, app_user_rows.slack_user_id
+FROM (SELECT 1) AS one LEFT JOIN app_user_rows ON true
+"""
+
+
+def resolve_ids(db, slack_team_id: str, slack_team_domain: str, slack_channel_id: str, slack_channel_name: str,
+                slack_users: Dict[str, str]) -> ResolvedIds:
+    """ Gets or creates the team, the channel and the app users (slack_user_id -> slack_user_name) of a command.
+
+    On Postgres this is a single statement (see UPSERT_TEAM_CHANNEL), which can't create duplicates when two first-time
+    commands of a team race each other and doesn't lock rows that are already up to date, so reads don't wait for
+    concurrent writes to the team. Other backends fall back to get_team and friends.
+    """
+    assert isinstance(slack_team_id, str)
+    assert isinstance(slack_team_domain, str)
+    assert isinstance(slack_channel_id, str)
+    assert isinstance(slack_channel_name, str)
+    assert all(isinstance(k, str) and isinstance(v, str) for k, v in slack_users.items())
+    if db.get_bind().dialect.name != 'postgresql':
+        team = get_team(db, slack_team_id=slack_team_id, slack_team_domain=slack_team_domain)
+        channel = get_channel(db, team_id=team.id, slack_channel_id=slack_channel_id,
+                              slack_channel_name=slack_channel_name)
+        app_user_ids = {slack_user_id: get_app_user(
+            db, team_id=team.id, slack_user_id=slack_user_id, slack_user_name=slack_user_name
+        ).id for slack_user_id, slack_user_name in slack_users.items()}
+        return ResolvedIds(team_id=team.id, channel_id=channel.id, app_user_ids=app_user_ids)
+
+    db.flush()
+    params = {
+        'slack_team_id': slack_team_id,
+        'slack_team_domain': slack_team_domain,
+        'slack_channel_id': slack_channel_id,
+        'slack_channel_name': slack_channel_name,
+        'rankings_reset_at': datetime.utcnow().replace(microsecond=0)
+    }
+    if slack_users:
+        values = []
+        for i, (slack_user_id, slack_user_name) in enumerate(slack_users.items()):
+            values.append(f'(:slack_user_id_{i}, :slack_user_name_{i})')
+            params[f'slack_user_id_{i}'] = slack_user_id
+            params[f'slack_user_name_{i}'] = slack_user_name
+        statement = UPSERT_TEAM_CHANNEL + UPSERT_APP_USERS.format(values=', '.join(values))
+    else:
+        statement = UPSERT_TEAM_CHANNEL + 'SELECT (SELECT id FROM team_row), (SELECT id FROM channel_row), NULL, NULL'
+    for attempt in range(3):
+        rows = db.execute(text(statement), params).fetchall()
+        ids = ResolvedIds(
+            team_id=rows[0][0],
+            channel_id=rows[0][1],
+            app_user_ids={slack_user_id: app_user_id for _, _, app_user_id, slack_user_id in rows if app_user_id}
+        )
+        if ids.team_id is not None and ids.channel_id is not None and len(ids.app_user_ids) == len(slack_users):
+            return ids
+    raise RuntimeError(f'could not resolve the ids of {slack_team_id}/{slack_channel_id}')  # pragma: nocover
+
+
 def insert_match(db, channel_id: int, winner_id: int, loser_id: int):
     assert isinstance(channel_id, int)
     assert isinstance(winner_id, int)
     assert isinstance(loser_id, int)
+    channel = lock_channel(db, channel_id=channel_id)
     timestamp = datetime.now().replace(microsecond=0)
     match = Match(
         channel_id=channel_id,
         winner_id=winner_id,
         loser_id=loser_id,
-        timestamp=timestamp
+        timestamp=timestamp,
+        batched=False
     )
+    checkpoint = update_standings(db, channel=channel, matches=[match])  # fills in the match's undo record
     db.add(match)
-    db.flush()  # TODO is flush needed
+    db.flush()
+    if checkpoint:
+        save_last_checkpoint(db, channel_id=channel_id)
+    publish_channel_changes(db, channel_ids=[channel_id])
     return match
 
 
+def insert_matches(db, channel_id: int, results: List[Tuple[int, int]]):
+    """ Inserts (winner_id, loser_id) results reported with one command in a single multi-row statement.
+
+    Every match after the first one is flagged as batched, standings are updated once for the whole batch.
+    """
+    assert isinstance(channel_id, int)
+    assert results and all(isinstance(x, int) for result in results for x in result)
+    channel = lock_channel(db, channel_id=channel_id)
+    timestamp = datetime.now().replace(microsecond=0)
+    matches = [
+        Match(channel_id=channel_id, winner_id=winner_id, loser_id=loser_id, timestamp=timestamp, batched=i > 0)
+        for i, (winner_id, loser_id) in enumerate(results)
+    ]
+    checkpoint = update_standings(db, channel=channel, matches=matches)  # fills in the matches' undo records
+    columns = [x.name for x in Match.__table__.columns if x.name != 'id']
+    db.execute(Match.__table__.insert().values([{x: getattr(match, x) for x in columns} for match in matches]))
+    if checkpoint:
+        save_last_checkpoint(db, channel_id=channel_id)
+    publish_channel_changes(db, channel_ids=[channel_id])
+
+
 def get_last_match(db, channel_id: int, winner_id: int):
     assert isinstance(channel_id, int)
     assert isinstance(winner_id, int)
@@ -92,3 +432,18 @@ def get_last_match(db, channel_id: int, winner_id: int):
         Match.channel_id == channel_id,
         Match.winner_id == winner_id
     ).order_by(Match.id.desc()).first()
+
+
+def get_leaderboard_version(db, channel_id: int):
+    """ Returns (last match id, channel version, rankings reset time, team nickname version) of the channel.
+
+    The rendered leaderboard of a channel only changes when one of these does. The channel version is bumped by every
+    write published with publish_channel_changes, which also covers deleted matches.
+    """
+    assert isinstance(channel_id, int)
+    last_match_id = db.query(func.max(Match.id)).filter(Match.channel_id == Channel.id).correlate(Channel).as_scalar()
+    return db.query(
+        last_match_id, Channel.version, Channel.rankings_reset_at, Team.nickname_version
+    ).select_from(Channel).join(
+        Team, Team.id == Channel.team_id
+    ).filter(Channel.id == channel_id).one()
@@ -0,0 +1,87 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def post_json(url: str, payload: dict, timeout: float = 5):
+    """ Default poster, sends the payload to a slash command's response_url.
+    """
+    import requests  # imported on first use, it's slow to import and most requests never need it
+    response = requests.post(url, json=payload, timeout=timeout)
+    response.raise_for_status()
+
+
+class DeferredResponder:
+    """ Bounded pool of worker threads that build slash command responses and POST them to the response_url.
+
+    Slack expects an answer within 3 seconds, handlers acknowledge the command right away and leave the expensive part
+    of the response to the pool. The poster is any callable taking (url, payload), tests replace it with a stand-in.
+    """
+
+    def __init__(self, workers: int, queue_size: int, poster=post_json, retries: int = 3, backoff: float = 0.5):
+        assert workers > 0 and queue_size > 0
+        self.workers = workers
+        self.poster = poster
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, app, response_url: str, build) -> bool:
+        """ Queues `build` to run within an app context, its result is posted to the response_url.
+
+        Returns False without queueing anything when the queue is full, the caller should then respond directly.
+        """
+        self._start()
+        try:
+            self.queue.put_nowait((app, response_url, build))
+        except queue.Full:
+            logger.warning('deferred response queue is full (%d jobs)', self.queue.maxsize)
+            return False
+        return True
+
+    def join(self):
+        """ Blocks until every queued response has been posted or given up on.
+        """
+        self.queue.join()
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # threads don't survive a fork, a worker process forked from a preloaded master starts its own
+            self._pid = os.getpid()
+            self._threads = [
+                threading.Thread(target=self._work, name=f'deferred-responder-{i}', daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def _work(self):
+        while True:
+            app, response_url, build = self.queue.get()
+            try:
+                with app.app_context():
+                    payload = build()
+                self._post(response_url, payload)
+            except Exception:
+                logger.exception('deferred response to %s failed', response_url)
+            finally:
+                self.queue.task_done()
+
+    def _post(self, response_url: str, payload: dict):
+        for attempt in range(self.retries + 1):
+            try:
+                return self.poster(response_url, payload)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
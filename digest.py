@@ -0,0 +1,121 @@
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Dict, List, NamedTuple, Optional
+
+from database import get_display_names
+from elo import (
+    CHECKPOINT_FIELDS, format_leaderboard, get_player_stats, get_replay, select_player_stats, set_previous_ranks,
+    LeaderboardView
+)
+from models import Channel, Match, Standing
+
+
+class HistoryRow(NamedTuple):
+    id: int
+    winner_id: int
+    loser_id: int
+    batched: bool
+
+
+class LeaderboardJob(NamedTuple):
+    """ Everything needed to build a channel's leaderboard in a worker process, without a database session.
+    """
+    channel_id: int
+    standings: Optional[List[tuple]]  # CHECKPOINT_FIELDS rows of valid standings, ordered by Standing.id
+    last_report: Optional[list]  # Channel.last_report of valid standings
+    history: Optional[List[HistoryRow]]  # matches to replay when the standings need a rebuild
+    display_names: Dict[int, str]
+
+
+def load_jobs(db, channel_ids: List[int], batch_size: int = 10000) -> List[LeaderboardJob]:
+    """ Loads what the channels' leaderboards are built from with a few bulk queries, whatever the number of channels.
+
+    Valid standings are read as they are, the match history is only loaded for channels whose standings need a
+    rebuild. Nothing is written, those standings are rebuilt by the next regular read.
+    """
+    assert all(isinstance(x, int) for x in channel_ids)
+    channels = db.query(Channel.id, Channel.standings_valid, Channel.last_report).filter(Channel.id.in_(channel_ids))
+    valid, last_reports = {}, {}
+    for channel_id, standings_valid, last_report in channels:
+        valid[channel_id], last_reports[channel_id] = standings_valid, last_report
+    standings = defaultdict(list)
+    histories = defaultdict(list)
+    if any(valid.values()):
+        rows = db.query(Standing.channel_id, *[getattr(Standing, x) for x in CHECKPOINT_FIELDS]).filter(
+            Standing.channel_id.in_([x for x, v in valid.items() if v])
+        ).order_by(Standing.channel_id, Standing.id)
+        for channel_id, *row in rows:
+            standings[channel_id].append(tuple(row))
+    if not all(valid.values()):
+        rows = db.query(
+            Match.channel_id, Match.id, Match.winner_id, Match.loser_id, Match.batched
+        ).join(Channel).filter(
+            Channel.id.in_([x for x, v in valid.items() if not v]),
+            Match.timestamp >= Channel.rankings_reset_at
+        ).order_by(Match.channel_id, Match.id).yield_per(batch_size)
+        for channel_id, *row in rows:
+            histories[channel_id].append(HistoryRow(*row))
+
+    players = {channel_id: {x[0] for x in rows} for channel_id, rows in standings.items()}
+    for channel_id, rows in histories.items():
+        players[channel_id] = {x for match in rows for x in (match.winner_id, match.loser_id)}
+    display_names = get_display_names(db, app_user_ids=set().union(*players.values()))
+    return [LeaderboardJob(
+        channel_id=channel_id,
+        standings=standings[channel_id] if valid[channel_id] else None,
+        last_report=last_reports[channel_id] if valid[channel_id] else None,
+        history=None if valid[channel_id] else histories[channel_id],
+        display_names={x: display_names[x] for x in players.get(channel_id, ())}
+    ) for channel_id in channel_ids if channel_id in valid]
+
+
+def build_leaderboard(job: LeaderboardJob, view: LeaderboardView, engine: str) -> List[str]:
+    """ Replays (if needed), ranks and renders a channel's leaderboard, runs in a worker process.
+    """
+    if job.history is not None:
+        standings = get_replay(engine)(job.history, channel_id=job.channel_id)
+    else:
+        standings = [Standing(channel_id=job.channel_id, **dict(zip(CHECKPOINT_FIELDS, x))) for x in job.standings]
+        set_previous_ranks(standings, last_report=job.last_report)
+    if view == LeaderboardView():
+        leaderboard = get_player_stats(standings)
+    else:
+        leaderboard = select_player_stats(standings, view=view)
+    return format_leaderboard(leaderboard, display_names=job.display_names)
+
+
+def render_leaderboards(db, channel_ids: List[int], view: LeaderboardView = LeaderboardView(), processes: int = 1,
+                        engine: str = 'python') -> Dict[int, List[str]]:
+    """ Returns the leaderboard lines of many channels, keyed and ordered by channel id as given.
+
+    Data is loaded in bulk (see load_jobs), replay and rendering are fanned out over `processes` worker processes.
+    """
+    assert processes >= 1
+    assert view.as_of is None and view.around is None, 'digests show the current standings of everyone'
+    jobs = load_jobs(db, channel_ids=channel_ids)
+    build = partial(build_leaderboard, view=view, engine=engine)
+    if processes == 1 or len(jobs) < 2:
+        return {job.channel_id: build(job) for job in jobs}
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        lines = pool.map(build, jobs, chunksize=max(1, len(jobs) // (processes * 4)))
+        return dict(zip((job.channel_id for job in jobs), lines))
+
+
+def render_team_leaderboard(db, team_id: int, view: LeaderboardView = LeaderboardView(), engine: str = 'python',
+                            batch_size: int = 10000) -> List[str]:
+    """ Returns the team-wide leaderboard, the histories of all the team's channels (each since its rankings reset)
+    replayed as one in the reported order.
+    """
+    assert isinstance(team_id, int)
+    rows = db.query(Match.id, Match.winner_id, Match.loser_id, Match.batched).join(Channel).filter(
+        Channel.team_id == team_id,
+        Match.timestamp >= Channel.rankings_reset_at
+    ).order_by(Match.id).yield_per(batch_size)
+    standings = get_replay(engine)(rows)
+    if view == LeaderboardView():
+        leaderboard = get_player_stats(standings)
+    else:
+        leaderboard = select_player_stats(standings, view=view)
+    display_names = get_display_names(db, app_user_ids=[x.app_user_id for x in leaderboard])
+    return format_leaderboard(leaderboard, display_names=display_names)
@@ -1,6 +1,18 @@
+import heapq
+
 from collections import defaultdict
-from copy import deepcopy
-from models import Match, Channel
+from datetime import datetime
+from flask import current_app
+from itertools import chain, islice
+from operator import itemgetter
+from metrics import span, record
+from sqlalchemy import func
+from sqlalchemy.orm.attributes import set_committed_value
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from models import Checkpoint, Match, Channel, Standing
+
+
+STATE_FIELDS = ('elo', 'played', 'won', 'lost', 'streak')
 
 
 def calculate_expected(player_1_elo, player_2_elo):
@@ -24,39 +36,90 @@ def calculate_elo(old, exp, score, k=32):
 
 
 class PlayerStats:
+    """ Leaderboard row, fields are kept numeric and only formatted when rendered (see format).
+    """
+    __slots__ = ('rank', 'app_user_id', 'elo', 'played', 'lost', 'won', 'move', 'streak')
 
-    def __init__(self, app_user_id, elo, played, lost, won, move: int, streak: int):
+    def __init__(self, rank: int, app_user_id, elo, played, lost, won, move: int, streak: int):
         """
         Args:
+            rank (int): position on the leaderboard, starting with 1
             move (int): direction and difference of standings after the last reported match
             streak (int): for instance +2 is winning streak of 2 games, -2 is losing streak of two games
         """
         assert isinstance(move, int)
         assert isinstance(streak, int)
 
+        self.rank = rank
         self.app_user_id = app_user_id
         self.elo = elo
         self.played = played
         self.lost = lost
         self.won = won
-        self.win_percentage = '{:.1f}%'.format(won / played * 100)
-        if move == 0:
-            self.move = ''
-        elif move > 0:
-            self.move = f'{move}↑'
+        self.move = move
+        self.streak = streak
+
+    def __eq__(self, other):
+        if not isinstance(other, PlayerStats):
+            return NotImplemented
+        return all(getattr(self, x) == getattr(other, x) for x in self.__slots__)
+
+    def __repr__(self):
+        return 'PlayerStats(' + ', '.join(f'{x}={getattr(self, x)!r}' for x in self.__slots__) + ')'
+
+    @property
+    def win_percentage(self) -> float:
+        return self.won / self.played * 100
+
+    def format(self) -> Tuple[str, str, str, str, str, str, str]:
+        """ Returns the rendered (elo, move, won, lost, played, win %, streak) columns.
+        """
+        if self.move == 0:
+            move = ''
+        elif self.move > 0:
+            move = f'{self.move}↑'
         else:
-            self.move = f'{abs(move)}↓'
-        if streak >= 2:
-            self.streak = f'{streak} Won'
-        elif streak <= -2:
-            self.streak = f'{abs(streak)} Lost'
+            move = f'{-self.move}↓'
+        if self.streak >= 2:
+            streak = f'{self.streak} Won'
+        elif self.streak <= -2:
+            streak = f'{-self.streak} Lost'
         else:
-            self.streak = ''
+            streak = ''
+        return (
+            str(self.elo), move, str(self.won), str(self.lost), str(self.played),
+            '{:.1f}%'.format(self.win_percentage), streak
+        )
 
-    def set_name(self, name: str):
-        assert isinstance(name, str)
-        self.name = name
-        return self
+
+LEADERBOARD_HEADER = ('ELO', '#↑/↓', 'W', 'L', 'GP', 'Win %', 'Streak')  # in the order of PlayerStats.format
+
+
+def format_leaderboard(leaderboard: List[PlayerStats], display_names: Dict[int, str]) -> List[str]:
+    """ Renders the rows ordered by rank, a gap between ranks (in a partial leaderboard) is marked with a line of dots.
+    """
+    rows = [(x.rank, display_names[x.app_user_id], x.format()) for x in leaderboard]
+    counter_width = len(str(leaderboard[-1].rank)) if leaderboard else 1
+    name_width = len('Name')
+    widths = [len(x) for x in LEADERBOARD_HEADER]
+    for _, name, cells in rows:
+        name_width = max(name_width, len(name))
+        widths = list(map(max, widths, map(len, cells)))
+
+    def render(counter: str, name: str, cells: Tuple[str, ...]) -> str:
+        elo, move, won, lost, played, win_percentage, streak = (x.rjust(w) for x, w in zip(cells, widths))
+        return (f'[ {elo} ] {counter.rjust(counter_width)}. {name.ljust(name_width)} {move} | {won} | {lost} | '
+                f'{played} | {win_percentage} | {streak}')
+
+    lines = [render('#', 'Name', LEADERBOARD_HEADER)]
+    separator = '―' * len(lines[0])  # every line is padded to the same length
+    gap = '·' * len(lines[0])
+    previous_rank = rows[0][0] - 1 if rows else 0
+    for rank, name, cells in rows:
+        lines.append(separator if rank == previous_rank + 1 else gap)
+        lines.append(render(str(rank), name, cells))
+        previous_rank = rank
+    return lines
 
 
 def update_state(match: Match, elo: dict, played: dict, won: dict, lost: dict, streak: dict):
@@ -86,49 +149,578 @@ def update_state(match: Match, elo: dict, played: dict, won: dict, lost: dict, s
         streak[match.loser_id] = -1
 
 
-def get_leaderboard(db, channel_id: int):
-    match_list = db.query(Match).join(Channel).filter(
+def initial_state(standings: Iterable[Standing]) -> dict:
+    """ Returns the state dicts of update_state, starting from the given standings (e.g. a checkpoint's).
+    """
+    state = {
+        'elo': defaultdict(lambda: 1500),
+        'played': defaultdict(lambda: 0),
+        'won': defaultdict(lambda: 0),
+        'lost': defaultdict(lambda: 0),
+        'streak': defaultdict(lambda: 0)
+    }
+    for standing in standings:
+        for field in STATE_FIELDS:
+            state[field][standing.app_user_id] = getattr(standing, field)
+    return state
+
+
+def replay(matches: Iterable[Match], channel_id: int = None, initial: List[Standing] = (),
+           undo: Dict[int, dict] = None) -> List[Standing]:
+    """ Replays the matches and returns the resulting standings, ordered by the player's first match.
+
+    The matches are consumed once, in order, they can be streamed (see iter_match_history). The previous rank is the
+    rank before the last report, which is the last match or the last batch of matches reported with one command.
+    Replay starts from scratch or from the initial standings (of a checkpoint) the matches follow. Given an undo dict,
+    the undo record of every match (see undo_record) is added to it by match id.
+    """
+    # --- before the last report ---
+    state = initial_state(initial)
+    last_report = []
+    for match in matches:
+        if not match.batched:
+            apply_report(last_report, state=state, undo=undo)
+            last_report = []
+        last_report.append(match)
+    # calculate rankings before the last report
+    if last_report:
+        rankings = rank_by_elo(state['elo'])
+    else:
+        rankings = {x.app_user_id: x.previous_rank for x in initial}
+
+    # --- after the last report ---
+    apply_report(last_report, state=state, undo=undo)
+
+    return [Standing(
+        channel_id=channel_id,
+        app_user_id=app_user_id,
+        elo=state['elo'][app_user_id],
+        played=state['played'][app_user_id],
+        won=state['won'][app_user_id],
+        lost=state['lost'][app_user_id],
+        streak=state['streak'][app_user_id],
+        previous_rank=rankings.get(app_user_id)
+    ) for app_user_id in state['elo']]
+
+
+def apply_report(report: List[Match], state: dict, undo: Dict[int, dict] = None):
+    for match in report:
+        if undo is not None:
+            undo[match.id] = undo_record(match, state=state)
+        update_state(match=match, **state)
+
+
+def rank_by_elo(elo: Dict[int, float]) -> Dict[int, int]:
+    return {app_user_id: rank for rank, (app_user_id, _) in enumerate(sort_by_elo(elo.items()), start=1)}
+
+
+UNDO_FIELDS = ('elo', 'streak')  # restored by revert_match, played, won and lost are just counted back
+
+
+def undo_record(match: Match, state: dict) -> dict:
+    """ Returns the Match columns of the players' state (of update_state) right before the match.
+    """
+    record = {}
+    for side, app_user_id in [('winner', match.winner_id), ('loser', match.loser_id)]:
+        for field in UNDO_FIELDS:
+            record[f'{side}_{field}_before'] = state[field].get(app_user_id, 1500 if field == 'elo' else 0)
+    return record
+
+
+def sort_by_elo(items):
+    """ Sorts (app_user_id, elo) pairs by elo, players with equal elo keep their order.
+    """
+    return sorted(items, key=lambda kv: kv[1], reverse=True)
+
+
+def get_player_stats(standings: List[Standing]) -> List[PlayerStats]:
+    ranked = sort_by_elo((standing, standing.elo) for standing in standings)
+    return [to_player_stats(standing, rank=index) for index, (standing, _) in enumerate(ranked, start=1)]
+
+
+def to_player_stats(standing: Standing, rank: int) -> PlayerStats:
+    return PlayerStats(
+        rank=rank,
+        app_user_id=standing.app_user_id,
+        elo=int(standing.elo),
+        played=standing.played,
+        won=standing.won,
+        lost=standing.lost,
+        move=standing.previous_rank - rank if standing.previous_rank is not None else 0,
+        streak=standing.streak
+    )
+
+
+class LeaderboardView(NamedTuple):
+    """ Part of a leaderboard to show, the default is the whole leaderboard.
+    """
+    start: int = 1  # first rank shown
+    size: Optional[int] = None  # number of ranks shown, None shows everyone from start on
+    around: Optional[int] = None  # app_user_id whose rank is centered within size, start is then ignored
+    include: Tuple[int, ...] = ()  # app_user_ids shown in addition to the selected ranks
+    as_of: Optional[datetime] = None  # shows the leaderboard after the last match reported up to then
+
+
+def ranking_keys(standings: List[Standing]):
+    """ Returns (sort key, standing) pairs, equal elo keeps the order of the standings (first match, as in sort_by_elo).
+    """
+    return [((-standing.elo, index), standing) for index, standing in enumerate(standings)]
+
+
+def get_rank(standings: List[Standing], app_user_id: int) -> Optional[int]:
+    """ Returns the player's rank in a single pass, without sorting the standings.
+    """
+    keyed = ranking_keys(standings)
+    key = next((key for key, x in keyed if x.app_user_id == app_user_id), None)
+    if key is None:
+        return None
+    return 1 + sum(1 for other, _ in keyed if other < key)
+
+
+def select_player_stats(standings: List[Standing], view: LeaderboardView) -> List[PlayerStats]:
+    """ Returns the stats of the players within the view ordered by rank.
+
+    Only the standings up to the last selected rank are ordered (with a heap), the cost grows with the view's size
+    and position rather than with the number of players.
+    """
+    keyed = ranking_keys(standings)
+    start = view.start
+    if view.around is not None:
+        assert view.size is not None
+        rank = get_rank(standings, app_user_id=view.around)
+        if rank is None:
+            return []
+        start = max(1, rank - (view.size - 1) // 2)
+    stop = start + view.size if view.size is not None else len(standings) + 1
+    selected = {}
+    for rank, (_, standing) in enumerate(heapq.nsmallest(stop - 1, keyed, key=itemgetter(0))[start - 1:], start=start):
+        selected[standing.app_user_id] = to_player_stats(standing, rank=rank)
+    included = [(key, x) for key, x in keyed if x.app_user_id in view.include and x.app_user_id not in selected]
+    for key, standing in included:
+        rank = 1 + sum(1 for other, _ in keyed if other < key)
+        selected[standing.app_user_id] = to_player_stats(standing, rank=rank)
+    return sorted(selected.values(), key=lambda x: x.rank)
+
+
+def get_replay(engine: str = None):
+    """ Returns the replay function of the engine, 'python' (default) or 'numpy' (see elo_numpy).
+    """
+    engine = engine or current_app.config.get('ELO_ENGINE', 'python')
+    if engine == 'numpy':
+        from elo_numpy import replay as numpy_replay  # numpy is only needed when the engine is enabled
+        return numpy_replay
+    assert engine == 'python', engine
+    return replay
+
+
+def get_match_history(db, channel_id: int) -> List[Match]:
+    """ Loads the matches since the channel's rankings reset as ORM objects, iter_match_history streams the columns
+    replay needs instead.
+    """
+    return db.query(Match).join(Channel).filter(
+        Channel.id == channel_id,
+        Match.timestamp >= Channel.rankings_reset_at
+    ).order_by(Match.id).all()
+
+
+def iter_match_history(db, channel_id: int, batch_size: int = 1000, after_match_id: int = None,
+                       until_match_id: int = None) -> Iterator[Tuple[int, int, int, bool]]:
+    """ Streams (id, winner_id, loser_id, batched) of the matches since the channel's rankings reset, in the reported
+    order, optionally only the ones after and up to the given match ids.
+
+    Rows are fetched through a server-side cursor in batches, so memory doesn't grow with the length of the history.
+    """
+    rows = db.query(Match.id, Match.winner_id, Match.loser_id, Match.batched).join(Channel).filter(
         Channel.id == channel_id,
         Match.timestamp >= Channel.rankings_reset_at
-    ).all()
-
-    # --- before the last reported match ---
-    elo = defaultdict(lambda: 1500)
-    played = defaultdict(lambda: 0)
-    won = defaultdict(lambda: 0)
-    lost = defaultdict(lambda: 0)
-    streak = defaultdict(lambda: 0)
-    for match in match_list[:-1]:
-        update_state(match=match, elo=elo, played=played, won=won, lost=lost, streak=streak)
-    sorted_by_elo = sorted(elo.items(), key=lambda kv: kv[1], reverse=True)
-    # calculate rankings before the last reported match
-    index = 0
-    rankings = {}
-    for app_user_id, _ in sorted_by_elo:
-        index += 1
-        rankings[app_user_id] = index
-
-    # --- after the last reported match ---
-    elo_new = deepcopy(elo)
-    played_new = deepcopy(played)
-    won_new = deepcopy(won)
-    lost_new = deepcopy(lost)
-    if match_list:
-        update_state(match=match_list[-1], elo=elo_new, played=played_new, won=won_new, lost=lost_new, streak=streak)
-    sorted_by_elo_new = sorted(elo_new.items(), key=lambda kv: kv[1], reverse=True)
-
-    player_stats = []
-    index = 0
-    for app_user_id, elo in sorted_by_elo_new:
-        index += 1
-        move = rankings[app_user_id] - index if app_user_id in rankings else 0
-        player_stats.append(PlayerStats(
-            app_user_id=app_user_id,
-            elo=int(elo),
-            played=played_new[app_user_id],
-            won=won_new[app_user_id],
-            lost=lost_new[app_user_id],
-            move=move,
-            streak=streak[app_user_id]
-        ))
-    return player_stats
+    )
+    if after_match_id is not None:
+        rows = rows.filter(Match.id > after_match_id)
+    if until_match_id is not None:
+        rows = rows.filter(Match.id <= until_match_id)
+    rows = rows.order_by(Match.id).yield_per(batch_size)
+    rows = iter(rows)
+    while True:
+        with span('history'):
+            batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield from batch
+
+
+def lock_channel(db, channel_id: int) -> Channel:
+    """ Locks the channel row until the end of the transaction, serializing writes to the channel's standings.
+    """
+    db.flush()  # the channel is reloaded, pending changes must not be lost
+    return db.query(Channel).filter(Channel.id == channel_id).with_for_update().populate_existing().one()
+
+
+def rebuild_standings(db, channel_id: int):
+    channel = lock_channel(db, channel_id=channel_id)
+    db.query(Standing).filter(Standing.channel_id == channel.id).delete(synchronize_session=False)
+    with span('replay'):
+        standings = get_replay()(iter_match_history(db, channel_id=channel.id), channel_id=channel.id)
+    db.add_all(standings)
+    channel.match_count = sum(x.played for x in standings) // 2
+    channel.last_report = None  # the replayed previous ranks are stored as they are
+    record('replayed_matches', channel.match_count)
+    channel.standings_valid = True
+    db.flush()
+
+
+def invalidate_standings(db, channel_id: int):
+    """ Drops the channel's standings, they are rebuilt from the match history on the next read.
+    """
+    channel = lock_channel(db, channel_id=channel_id)
+    db.query(Standing).filter(Standing.channel_id == channel.id).delete(synchronize_session=False)
+    channel.match_count = 0
+    channel.last_report = None
+    channel.standings_valid = False
+    db.flush()
+
+
+def update_standings(db, channel: Channel, matches: List[Match]) -> bool:
+    """ Applies matches reported with one command to the standings of their players without a replay, and fills in
+    their undo records. Returns whether a checkpoint is due after the report (see save_last_checkpoint).
+
+    Only the players' rows are read and written, the previous ranks of everyone are derived from the channel's last
+    report when the standings are read (see load_standings). The channel has to be locked (see lock_channel) and the
+    matches are inserted afterwards, with their undo records.
+    """
+    matches = [x for x in matches if x.timestamp >= channel.rankings_reset_at]
+    if not channel.standings_valid or not matches:
+        return False
+    app_user_ids = {x for match in matches for x in [match.winner_id, match.loser_id]}
+    standings = db.query(Standing).filter(
+        Standing.channel_id == channel.id,
+        Standing.app_user_id.in_(app_user_ids)
+    ).order_by(Standing.id).all()
+
+    by_app_user_id = {standing.app_user_id: standing for standing in standings}
+    for app_user_id in (x for match in matches for x in [match.winner_id, match.loser_id]):
+        if app_user_id not in by_app_user_id:
+            by_app_user_id[app_user_id] = Standing(
+                channel_id=channel.id, app_user_id=app_user_id, elo=1500, played=0, won=0, lost=0, streak=0
+            )
+            db.add(by_app_user_id[app_user_id])
+
+    players = {x: by_app_user_id[x] for match in matches for x in [match.winner_id, match.loser_id]}
+    state = {field: {x.app_user_id: getattr(x, field) for x in players.values()} for field in STATE_FIELDS}
+    channel.last_report = [[x, state['elo'][x] if state['played'][x] else None] for x in players]
+    for match in matches:
+        for field, value in undo_record(match, state=state).items():
+            setattr(match, field, value)
+        update_state(match=match, **state)
+    for player in players.values():
+        for field in STATE_FIELDS:
+            setattr(player, field, state[field][player.app_user_id])
+    channel.match_count += len(matches)
+    db.flush()
+
+    return checkpoint_due(matches_before=channel.match_count - len(matches), matches_after=channel.match_count)
+
+
+def get_previous_ranks(standings: List[Standing], last_report: list) -> Dict[int, int]:
+    """ Returns the ranks before the last report, which are those of the standings with the elo the report's players
+    had before it (see Channel.last_report), without the players who joined with the report.
+    """
+    elo_before = dict(last_report)
+    return rank_by_elo({
+        x.app_user_id: elo_before.get(x.app_user_id, x.elo) for x in standings
+        if elo_before.get(x.app_user_id, x.elo) is not None
+    })
+
+
+def set_previous_ranks(standings: List[Standing], last_report: Optional[list]):
+    """ Sets the previous ranks derived from the channel's last report, without a last report (right after a replay)
+    the stored ones are up to date.
+    """
+    if last_report is None:
+        return
+    previous_ranks = get_previous_ranks(standings, last_report=last_report)
+    for standing in standings:
+        # not a change to write, the column keeps the previous ranks of the last replay
+        set_committed_value(standing, 'previous_rank', previous_ranks.get(standing.app_user_id))
+
+
+def load_standings(db, channel: Channel) -> List[Standing]:
+    """ Returns the channel's standings ordered by the player's first match, with their previous ranks.
+    """
+    standings = db.query(Standing).filter(Standing.channel_id == channel.id).order_by(Standing.id).all()
+    set_previous_ranks(standings, last_report=channel.last_report)
+    return standings
+
+
+def revert_match(db, match: Match):
+    """ Deletes the match and takes it out of the channel's standings, replaying only the history from the report
+    before the match's report on.
+
+    The standings before that report are restored from the undo records of the matches since, which are then replayed
+    without the reverted one (recomputing the last report and the undo records). Reverting the channel's last match
+    restores and replays two reports at most, however long the history is. If a match since has no undo record, the
+    standings are invalidated and rebuilt by a full replay on the next read. Checkpoints taken since the match are
+    dropped, the standings are saved as a checkpoint after the channel's last match instead.
+    """
+    channel = lock_channel(db, channel_id=match.channel_id)
+    deleted = delete_checkpoints(db, channel_id=channel.id, since_match_id=match.id)
+    if not channel.standings_valid or match.timestamp < channel.rankings_reset_at:
+        db.delete(match)
+        db.flush()
+        return
+    report_ids = db.query(Match.id).filter(
+        Match.channel_id == channel.id,
+        Match.timestamp >= channel.rankings_reset_at,
+        Match.id <= match.id,
+        Match.batched.is_(False)
+    ).order_by(Match.id.desc()).limit(2).all()
+    matches = db.query(Match).filter(
+        Match.channel_id == channel.id,
+        Match.id >= report_ids[-1].id
+    ).order_by(Match.id).all()
+    db.delete(match)
+    if any(getattr(x, f'{side}_{field}_before') is None
+           for x in matches for side in ['winner', 'loser'] for field in UNDO_FIELDS):
+        invalidate_standings(db, channel_id=channel.id)
+        return
+
+    standings = db.query(Standing).filter(Standing.channel_id == channel.id).order_by(Standing.id).all()
+    state = initial_state(standings)
+    for x in reversed(matches):
+        for side, app_user_id in [('winner', x.winner_id), ('loser', x.loser_id)]:
+            for field in UNDO_FIELDS:
+                state[field][app_user_id] = getattr(x, f'{side}_{field}_before')
+            state['played'][app_user_id] -= 1
+        state['won'][x.winner_id] -= 1
+        state['lost'][x.loser_id] -= 1
+    initial = [
+        Standing(app_user_id=x.app_user_id, **{field: state[field][x.app_user_id] for field in STATE_FIELDS})
+        for x in standings if state['played'][x.app_user_id]
+    ]
+
+    matches = [x for x in matches if x.id != match.id]
+    following = [x for x in matches if x.id > match.id]
+    if not match.batched and following and following[0].batched:
+        following[0].batched = False  # the rest of the reverted match's report becomes a report of its own
+    undo = {}
+    with span('replay'):
+        replayed = {x.app_user_id: x for x in replay(matches, channel_id=channel.id, initial=initial, undo=undo)}
+    record('replayed_matches', len(matches))
+    for x in matches:
+        for field, value in undo[x.id].items():
+            setattr(x, field, value)
+    last_report = matches[max((i for i, x in enumerate(matches) if not x.batched), default=0):]
+    elo_before = {}
+    for x in last_report:
+        for side, app_user_id in [('winner', x.winner_id), ('loser', x.loser_id)]:
+            joined = replayed[app_user_id].previous_rank is None
+            elo_before.setdefault(app_user_id, None if joined else undo[x.id][f'{side}_elo_before'])
+    channel.last_report = [[app_user_id, elo] for app_user_id, elo in elo_before.items()]
+    channel.match_count -= 1
+
+    # players without matches before the report lose their standing, one is added again after the existing ones if
+    # they play later on, which keeps the standings in the order of the players' first match
+    for standing in standings:
+        if state['played'][standing.app_user_id]:
+            replayed_standing = replayed.pop(standing.app_user_id)
+            for field in STATE_FIELDS:
+                setattr(standing, field, getattr(replayed_standing, field))
+        else:
+            db.delete(standing)
+    db.flush()
+    db.add_all(replayed.values())
+    db.flush()
+    if deleted and channel.match_count:
+        save_last_checkpoint(db, channel_id=channel.id)  # the dropped ones may have been the only recent ones
+
+
+CHECKPOINT_FIELDS = ('app_user_id',) + STATE_FIELDS + ('previous_rank',)
+
+
+def checkpoint_due(matches_before: int, matches_after: int) -> bool:
+    """ A checkpoint is taken after the report that reaches every CHECKPOINT_INTERVAL-th match since the reset.
+    """
+    interval = current_app.config.get('CHECKPOINT_INTERVAL', 0)
+    return bool(interval) and matches_after // interval > matches_before // interval
+
+
+def to_checkpoint(channel_id: int, match_id: int, standings: Iterable[Standing]) -> Checkpoint:
+    return Checkpoint(
+        channel_id=channel_id,
+        match_id=match_id,
+        standings=[[getattr(x, field) for field in CHECKPOINT_FIELDS] for x in standings]
+    )
+
+
+def from_checkpoint(checkpoint: Checkpoint) -> List[Standing]:
+    return [Standing(channel_id=checkpoint.channel_id, **dict(zip(CHECKPOINT_FIELDS, x))) for x in checkpoint.standings]
+
+
+def save_checkpoint(db, checkpoint: Checkpoint):
+    """ Adds the checkpoint, once the channel has more than CHECKPOINT_MAX_COUNT every other one older than the newest
+    half of them is dropped, which keeps storage bounded and older history sparser while recent history stays dense.
+    """
+    db.add(checkpoint)
+    db.flush()
+    match_ids = [x for x, in db.query(Checkpoint.match_id).filter(
+        Checkpoint.channel_id == checkpoint.channel_id
+    ).order_by(Checkpoint.match_id.desc())]
+    max_count = current_app.config.get('CHECKPOINT_MAX_COUNT', 100)
+    if len(match_ids) > max_count:
+        recent = max(1, max_count // 2)
+        db.query(Checkpoint).filter(
+            Checkpoint.channel_id == checkpoint.channel_id,
+            Checkpoint.match_id.in_(match_ids[recent + 1::2])
+        ).delete(synchronize_session=False)
+
+
+def save_last_checkpoint(db, channel_id: int):
+    """ Saves the channel's standings as a checkpoint after its last inserted match, see update_standings.
+    """
+    match_id = db.query(func.max(Match.id)).filter(Match.channel_id == channel_id).scalar()
+    if db.query(Checkpoint.id).filter(Checkpoint.channel_id == channel_id, Checkpoint.match_id == match_id).first():
+        return  # e.g. the match after it was reverted
+    standings = load_standings(db, channel=db.query(Channel).get(channel_id))
+    save_checkpoint(db, checkpoint=to_checkpoint(channel_id, match_id=match_id, standings=standings))
+
+
+def get_checkpoint(db, channel_id: int, match_id: int) -> Optional[Checkpoint]:
+    """ Returns the latest checkpoint of the channel up to (and including) the match.
+    """
+    return db.query(Checkpoint).filter(
+        Checkpoint.channel_id == channel_id,
+        Checkpoint.match_id <= match_id
+    ).order_by(Checkpoint.match_id.desc()).first()
+
+
+def delete_checkpoints(db, channel_id: int, since_match_id: int = None) -> int:
+    """ Drops checkpoints that include the given match (all checkpoints by default), after a revert or reset changed
+    the history they were taken from. Returns how many were dropped.
+    """
+    checkpoints = db.query(Checkpoint).filter(Checkpoint.channel_id == channel_id)
+    if since_match_id is not None:
+        checkpoints = checkpoints.filter(Checkpoint.match_id >= since_match_id)
+    return checkpoints.delete(synchronize_session=False)
+
+
+def iter_checkpoints(matches: Iterable[Match], channel_id: int) -> Iterator[Checkpoint]:
+    """ Replays the matches from scratch and yields the checkpoints insert_match(es) would have taken along the way.
+    """
+    state = initial_state(())
+    last_report = []
+    count = 0
+    for match in chain(matches, [None]):
+        if match is None or not match.batched:
+            due = last_report and checkpoint_due(matches_before=count, matches_after=count + len(last_report))
+            if due:
+                ranked = sort_by_elo(state['elo'].items())
+                rankings = {app_user_id: rank for rank, (app_user_id, _) in enumerate(ranked, start=1)}
+            for x in last_report:
+                update_state(match=x, **state)
+            if due:
+                yield Checkpoint(channel_id=channel_id, match_id=last_report[-1].id, standings=[
+                    [app_user_id] + [state[field][app_user_id] for field in STATE_FIELDS] + [rankings.get(app_user_id)]
+                    for app_user_id in state['elo']
+                ])
+            count += len(last_report)
+            last_report = []
+        if match is not None:
+            last_report.append(match)
+
+
+def rebuild_checkpoints(db, channel_id: int) -> int:
+    """ Replaces the channel's checkpoints with ones taken by a replay of its history, returns how many were taken.
+    """
+    lock_channel(db, channel_id=channel_id)
+    delete_checkpoints(db, channel_id=channel_id)
+    count = 0
+    for checkpoint in iter_checkpoints(iter_match_history(db, channel_id=channel_id), channel_id=channel_id):
+        save_checkpoint(db, checkpoint=checkpoint)
+        count += 1
+    return count
+
+
+def get_standings_as_of(db, channel_id: int, as_of: datetime) -> List[Standing]:
+    """ Returns the standings after the last match reported up to `as_of`, replaying only the matches that follow
+    the nearest checkpoint.
+    """
+    match_id = db.query(func.max(Match.id)).join(Channel).filter(
+        Channel.id == channel_id,
+        Match.timestamp >= Channel.rankings_reset_at,
+        Match.timestamp <= as_of
+    ).scalar()
+    if match_id is None:
+        return []
+    checkpoint = get_checkpoint(db, channel_id=channel_id, match_id=match_id)
+    matches = iter_match_history(db, channel_id=channel_id, after_match_id=checkpoint and checkpoint.match_id,
+                                 until_match_id=match_id)
+    with span('replay'):
+        return replay(matches, channel_id=channel_id, initial=from_checkpoint(checkpoint) if checkpoint else [])
+
+
+def get_rating_timeline(db, channel_id: int, app_user_id: int, count: int) -> List[Tuple[Match, float, float]]:
+    """ Returns the player's last `count` matches together with the player's elo before and after each of them.
+    """
+    matches = db.query(Match).join(Channel).filter(
+        Channel.id == channel_id,
+        Match.timestamp >= Channel.rankings_reset_at,
+        (Match.winner_id == app_user_id) | (Match.loser_id == app_user_id)
+    ).order_by(Match.id.desc()).limit(count).all()[::-1]
+    if not matches:
+        return []
+    checkpoint = get_checkpoint(db, channel_id=channel_id, match_id=matches[0].id - 1)
+    state = initial_state(from_checkpoint(checkpoint) if checkpoint else [])
+    elo = {}
+    with span('replay'):
+        for match in iter_match_history(db, channel_id=channel_id, after_match_id=checkpoint and checkpoint.match_id,
+                                        until_match_id=matches[-1].id):
+            before = state['elo'][app_user_id]
+            update_state(match=match, **state)
+            if match.id >= matches[0].id and app_user_id in (match.winner_id, match.loser_id):
+                elo[match.id] = before, state['elo'][app_user_id]
+    return [(match, *elo[match.id]) for match in matches]
+
+
+def check_standings(db, channel_id: int) -> List[str]:
+    """ Compares the channel's standings with a full replay of its match history.
+
+    Returns a description of every difference, an empty list means the standings are consistent.
+    """
+    channel = db.query(Channel).get(channel_id)
+    if not channel.standings_valid:
+        return []
+    matches = iter_match_history(db, channel_id=channel_id)
+    expected = {x.app_user_id: x for x in get_replay()(matches, channel_id=channel_id)}
+    actual = {x.app_user_id: x for x in load_standings(db, channel=channel)}
+    differences = []
+    for app_user_id in sorted(set(expected) | set(actual)):
+        if app_user_id not in actual:
+            differences.append(f'app_user {app_user_id}: missing from standings')
+        elif app_user_id not in expected:
+            differences.append(f'app_user {app_user_id}: has standings but no matches')
+        else:
+            for field in STATE_FIELDS + ('previous_rank',):
+                if getattr(actual[app_user_id], field) != getattr(expected[app_user_id], field):
+                    differences.append(
+                        f'app_user {app_user_id}: {field} is {getattr(actual[app_user_id], field)}, '
+                        f'replay gives {getattr(expected[app_user_id], field)}'
+                    )
+    return differences
+
+
+def get_standings(db, channel_id: int) -> List[Standing]:
+    channel = db.query(Channel).get(channel_id)
+    if not channel.standings_valid:
+        rebuild_standings(db, channel_id=channel_id)
+    with span('standings'):
+        return load_standings(db, channel=channel)
+
+
+def get_leaderboard(db, channel_id: int, view: LeaderboardView = LeaderboardView()) -> List[PlayerStats]:
+    if view.as_of is not None:
+        standings = get_standings_as_of(db, channel_id=channel_id, as_of=view.as_of)
+    else:
+        standings = get_standings(db, channel_id=channel_id)
+    with span('rank'):
+        if view == LeaderboardView():
+            return get_player_stats(standings)
+        return select_player_stats(standings, view=view)
@@ -0,0 +1,88 @@
+import numpy as np
+
+from itertools import chain
+from typing import Iterable, List
+from models import Match, Standing
+
+
+def to_dense(matches: Iterable[Match]):
+    """ Maps app_user_ids to dense indexes in order of the player's first match (winner before loser).
+
+    Returns the app_user_id of every dense index, an (matches, 2) array of (winner, loser) indexes and the batched
+    flag of every match.
+    """
+    rows = np.fromiter(chain.from_iterable(
+        (match.winner_id, match.loser_id, match.batched) for match in matches
+    ), dtype=np.int64).reshape(-1, 3)
+    app_user_ids, first_index, inverse = np.unique(rows[:, :2], return_index=True, return_inverse=True)
+    order = np.argsort(first_index, kind='stable')
+    dense_index = np.empty_like(order)
+    dense_index[order] = np.arange(len(order))
+    return app_user_ids[order], dense_index[inverse.ravel()].reshape(-1, 2), rows[:, 2].astype(bool)
+
+
+def calculate_ratings(winners: List[int], losers: List[int], elo: List[float]):
+    """ Applies the matches to the ratings in place.
+
+    Elo updates depend on the previous ratings, so they can't be vectorized across matches. The arithmetic is the
+    same as in elo.update_state (including the loser being scored against the updated winner) to give equal floats.
+    """
+    for winner, loser in zip(winners, losers):
+        old = elo[winner]
+        elo[winner] = old + 32 * (1 - 1 / (1 + 10 ** ((elo[loser] - old) / 400))) + 1
+        old = elo[loser]
+        elo[loser] = old + 32 * (0 - 1 / (1 + 10 ** ((elo[winner] - old) / 400))) + 1
+
+
+def calculate_streaks(dense, players: int):
+    """ Returns the signed length of every player's last run of wins (positive) or losses (negative).
+    """
+    events = dense.ravel()  # chronological, winner before loser
+    results = np.tile(np.array([1, -1]), len(dense))
+    order = np.argsort(events, kind='stable')
+    events, results = events[order], results[order]
+    run_start = np.ones(len(events), dtype=bool)
+    run_start[1:] = (events[1:] != events[:-1]) | (results[1:] != results[:-1])
+    run_start_position = np.flatnonzero(run_start)[np.cumsum(run_start) - 1]
+    last = np.flatnonzero(np.append(events[1:] != events[:-1], True))
+    streak = np.zeros(players, dtype=np.int64)
+    streak[events[last]] = results[last] * (last - run_start_position[last] + 1)
+    return streak
+
+
+def replay(matches: Iterable[Match], channel_id: int = None) -> List[Standing]:
+    """ Array-backed equivalent of elo.replay.
+    """
+    app_user_ids, dense, batched = to_dense(matches)
+    if not len(dense):
+        return []
+    players = len(app_user_ids)
+    winners, losers = dense[:, 0], dense[:, 1]
+    won = np.bincount(winners, minlength=players).tolist()
+    lost = np.bincount(losers, minlength=players).tolist()
+    streak = calculate_streaks(dense, players=players).tolist()
+    # the last report is the last match, or the last batch of matches reported with one command
+    last_report = int(np.flatnonzero(~batched)[-1]) if not batched.all() else 0
+
+    # --- before the last report ---
+    elo = [1500] * players
+    calculate_ratings(winners[:last_report].tolist(), losers[:last_report].tolist(), elo)
+    # players are in order of their first match, the ones that joined with the last report are at the end
+    present = int(dense[:last_report].max()) + 1 if last_report else 0
+    previous_rank = np.zeros(players, dtype=np.int64)
+    previous_rank[np.argsort(-np.array(elo[:present], dtype=float), kind='stable')] = np.arange(1, present + 1)
+    previous_rank = previous_rank.tolist()
+
+    # --- after the last report ---
+    calculate_ratings(winners[last_report:].tolist(), losers[last_report:].tolist(), elo)
+
+    return [Standing(
+        channel_id=channel_id,
+        app_user_id=app_user_id,
+        elo=elo[index],
+        played=won[index] + lost[index],
+        won=won[index],
+        lost=lost[index],
+        streak=streak[index],
+        previous_rank=previous_rank[index] or None
+    ) for index, app_user_id in enumerate(app_user_ids.tolist())]
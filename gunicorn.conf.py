@@ -0,0 +1,24 @@
+""" Gunicorn settings, `gunicorn -c gunicorn.conf.py app:app` (see Procfile).
+
+The app is imported and warmed up once in the master, workers are forked with the modules, mappers and replay engine
+already loaded and only open their own database connections.
+"""
+import os
+
+if os.getenv('NEW_RELIC_LICENSE_KEY'):  # replaces `newrelic-admin run-program`, the agent must load before the app
+    import newrelic.agent
+    newrelic.agent.initialize()
+
+bind = f'0.0.0.0:{os.getenv("PORT", "8000")}'
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+preload_app = True
+
+
+def when_ready(server):
+    from app import app, warm_up
+    warm_up(app, connect=False)  # connections opened before the fork would be shared by the workers
+
+
+def post_fork(server, worker):
+    from app import app, warm_up
+    warm_up(app)
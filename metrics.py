@@ -0,0 +1,135 @@
+import threading
+import time
+
+from contextlib import contextmanager
+from flask import g, has_app_context
+from typing import Dict, Tuple
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+@contextmanager
+def span(phase: str):
+    """ Adds the time spent within the context to the phase breakdown of the current request, if there is one.
+
+    Spans can be nested, time spent in an inner span is only counted towards the inner phase.
+    """
+    if not has_app_context() or 'phases' not in g:
+        yield
+        return
+    stack = g.setdefault('span_stack', [])
+    stack.append(0)  # time spent in nested spans
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = stack.pop()
+        g.phases[phase] = g.phases.get(phase, 0) + elapsed - nested
+        if stack:
+            stack[-1] += elapsed
+
+
+def record(name: str, value):
+    """ Attaches a value (e.g. the number of replayed matches) to the current request, used in the slow request log.
+    """
+    if has_app_context() and 'request_info' in g:
+        g.request_info[name] = g.request_info.get(name, 0) + value
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+
+
+class Counter:
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[x] for x in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(labels[x] for x in self.labelnames), 0)
+
+    def expose(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} counter'
+        for key, value in sorted(self._values.items()):
+            yield f'{self.name}{format_labels(dict(zip(self.labelnames, key)))} {value}'
+
+
+class Histogram:
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [count per bucket..., count above the last bucket, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[x] for x in self.labelnames)
+        with self._lock:
+            counts = self._values.setdefault(key, [0] * (len(self.buckets) + 2))
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, **labels) -> int:
+        return sum(self._values.get(tuple(labels[x] for x in self.labelnames), [0, 0])[:-1])
+
+    def expose(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        for key, counts in sorted(self._values.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{format_labels(dict(labels, le=bound))} {cumulative}'
+            yield f'{self.name}_sum{format_labels(labels)} {counts[-1]}'
+            yield f'{self.name}_count{format_labels(labels)} {cumulative}'
+
+
+class Gauge:
+    """ Gauge whose values are read from a callback at exposition time, the callback returns {labels tuple: value}.
+    """
+
+    def __init__(self, name: str, documentation: str, callback, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.callback = callback
+
+    def expose(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} gauge'
+        for key, value in sorted(self.callback().items()):
+            yield f'{self.name}{format_labels(dict(zip(self.labelnames, key)))} {value}'
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self) -> str:
+        """ Renders every metric in the Prometheus text format.
+        """
+        return ''.join(line + '\n' for metric in self.metrics for line in metric.expose())
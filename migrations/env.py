@@ -0,0 +1,55 @@
+import os
+import sys
+
+from alembic import context
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from logging.config import fileConfig
+from sqlalchemy import create_engine, inspect
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import Base  # noqa: E402
+
+
+config = context.config
+if config.config_file_name:
+    fileConfig(config.config_file_name, disable_existing_loggers=False)
+
+target_metadata = Base.metadata
+
+
+def get_url():
+    return config.get_main_option('sqlalchemy.url') or os.environ['SLACK_APP_PONG_DATABASE_URL']
+
+
+def run_migrations_offline():
+    context.configure(url=get_url(), target_metadata=target_metadata, literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def stamp_unversioned(connection):
+    """ Marks a database created by Base.metadata.create_all before migrations were introduced as being at 0001, so the
+    release phase's `alembic upgrade head` migrates it instead of failing on the existing tables.
+    """
+    tables = inspect(connection).get_table_names()
+    if 'team' in tables and 'alembic_version' not in tables:
+        with connection.begin():
+            MigrationContext.configure(connection).stamp(ScriptDirectory.from_config(config), '0001')
+
+
+def run_migrations_online():
+    engine = create_engine(get_url())
+    with engine.connect() as connection:
+        stamp_unversioned(connection)
+        context.configure(connection=connection, target_metadata=target_metadata)
+        with context.begin_transaction():
+            context.run_migrations()
+    engine.dispose()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
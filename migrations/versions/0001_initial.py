@@ -0,0 +1,57 @@
+"""initial schema, as created by Base.metadata.create_all before migrations were introduced
+
+Databases created that way are stamped with 0001 by env.py before they are upgraded.
+
+Revision ID: 0001
+Revises:
+Create Date: 2019-12-10 00:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'team',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('slack_team_id', sa.String(), nullable=False, unique=True),
+        sa.Column('slack_team_domain', sa.String(), nullable=False)
+    )
+    op.create_table(
+        'app_user',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('team_id', sa.Integer(), sa.ForeignKey('team.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('slack_user_id', sa.String(), nullable=False),
+        sa.Column('slack_user_name', sa.String(), nullable=False),
+        sa.Column('nickname', sa.String())
+    )
+    op.create_table(
+        'channel',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('team_id', sa.Integer(), sa.ForeignKey('team.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('slack_channel_id', sa.String(), nullable=False),
+        sa.Column('slack_channel_name', sa.String(), nullable=False),
+        sa.Column('rankings_reset_at', sa.DateTime(), nullable=False)
+    )
+    op.create_table(
+        'match',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('channel_id', sa.Integer(), sa.ForeignKey('channel.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('winner_id', sa.Integer(), sa.ForeignKey('app_user.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('loser_id', sa.Integer(), sa.ForeignKey('app_user.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('timestamp', sa.DateTime(), nullable=False)
+    )
+    op.create_index('idx_match_0', 'match', ['id', 'timestamp'])
+
+
+def downgrade():
+    op.drop_table('match')
+    op.drop_table('channel')
+    op.drop_table('app_user')
+    op.drop_table('team')
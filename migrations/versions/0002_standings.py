@@ -0,0 +1,38 @@
+"""standings snapshot and team nickname version
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2019-12-10 00:00:01
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('team', sa.Column('nickname_version', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('channel', sa.Column('standings_valid', sa.Boolean(), nullable=False, server_default=sa.false()))
+    op.create_table(
+        'standing',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('channel_id', sa.Integer(), sa.ForeignKey('channel.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('app_user_id', sa.Integer(), sa.ForeignKey('app_user.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('elo', sa.Float(), nullable=False),
+        sa.Column('played', sa.Integer(), nullable=False),
+        sa.Column('won', sa.Integer(), nullable=False),
+        sa.Column('lost', sa.Integer(), nullable=False),
+        sa.Column('streak', sa.Integer(), nullable=False),
+        sa.Column('previous_rank', sa.Integer()),
+        sa.UniqueConstraint('channel_id', 'app_user_id', name='uq_standing_channel_id_app_user_id')
+    )
+
+
+def downgrade():
+    op.drop_table('standing')
+    op.drop_column('channel', 'standings_valid')
+    op.drop_column('team', 'nickname_version')
@@ -0,0 +1,52 @@
+"""indexes for the hot queries, unique slack ids per team
+
+Duplicate channels and app users (possible before the unique constraints) are merged into the oldest row first.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2019-12-10 00:00:02
+"""
+from alembic import op
+
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('''
+        UPDATE match SET channel_id = duplicate.keep_id
+        FROM (SELECT id, min(id) OVER (PARTITION BY team_id, slack_channel_id) AS keep_id FROM channel) duplicate
+        WHERE match.channel_id = duplicate.id AND duplicate.id <> duplicate.keep_id
+    ''')
+    for column in ['winner_id', 'loser_id']:
+        op.execute(f'''
+            UPDATE match SET {column} = duplicate.keep_id
+            FROM (SELECT id, min(id) OVER (PARTITION BY team_id, slack_user_id) AS keep_id FROM app_user) duplicate
+            WHERE match.{column} = duplicate.id AND duplicate.id <> duplicate.keep_id
+        ''')
+    op.execute('DELETE FROM channel a USING channel b '
+               'WHERE a.team_id = b.team_id AND a.slack_channel_id = b.slack_channel_id AND a.id > b.id')
+    op.execute('DELETE FROM app_user a USING app_user b '
+               'WHERE a.team_id = b.team_id AND a.slack_user_id = b.slack_user_id AND a.id > b.id')
+    # merged channels need their standings rebuilt
+    op.execute('DELETE FROM standing')
+    op.execute('UPDATE channel SET standings_valid = false')
+
+    op.create_unique_constraint('uq_app_user_team_id_slack_user_id', 'app_user', ['team_id', 'slack_user_id'])
+    op.create_unique_constraint('uq_channel_team_id_slack_channel_id', 'channel', ['team_id', 'slack_channel_id'])
+    op.drop_index('idx_match_0', table_name='match')
+    op.create_index('ix_match_channel_id_timestamp', 'match', ['channel_id', 'timestamp'])
+    op.create_index('ix_match_channel_id_id', 'match', ['channel_id', 'id'])
+    op.create_index('ix_match_channel_id_winner_id_id', 'match', ['channel_id', 'winner_id', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_match_channel_id_winner_id_id', table_name='match')
+    op.drop_index('ix_match_channel_id_id', table_name='match')
+    op.drop_index('ix_match_channel_id_timestamp', table_name='match')
+    op.create_index('idx_match_0', 'match', ['id', 'timestamp'])
+    op.drop_constraint('uq_channel_team_id_slack_channel_id', 'channel', type_='unique')
+    op.drop_constraint('uq_app_user_team_id_slack_user_id', 'app_user', type_='unique')
@@ -0,0 +1,22 @@
+"""match reported in the same command as the previous one
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2019-12-10 00:00:03
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('match', sa.Column('batched', sa.Boolean(), nullable=False, server_default=sa.false()))
+
+
+def downgrade():
+    op.drop_column('match', 'batched')
@@ -0,0 +1,29 @@
+"""rating checkpoints
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2019-12-10 00:00:04
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'checkpoint',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('channel_id', sa.Integer(), sa.ForeignKey('channel.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('match_id', sa.Integer(), sa.ForeignKey('match.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('standings', sa.JSON(), nullable=False),
+        sa.UniqueConstraint('channel_id', 'match_id', name='uq_checkpoint_channel_id_match_id')
+    )
+
+
+def downgrade():
+    op.drop_table('checkpoint')
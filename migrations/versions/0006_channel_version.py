@@ -0,0 +1,22 @@
+"""channel version published to other workers
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2019-12-10 00:00:05
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('channel', sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('channel', 'version')
@@ -0,0 +1,33 @@
+"""installation tokens
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2019-12-10 00:00:06
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'installation',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('slack_team_id', sa.String(), nullable=False, unique=True),
+        sa.Column('slack_team_name', sa.String(), nullable=False),
+        sa.Column('access_token', sa.String(), nullable=False),
+        sa.Column('scope', sa.String(), nullable=False),
+        sa.Column('installed_by', sa.String(), nullable=False),
+        sa.Column('bot_user_id', sa.String()),
+        sa.Column('bot_access_token', sa.String()),
+        sa.Column('installed_at', sa.DateTime(), nullable=False)
+    )
+
+
+def downgrade():
+    op.drop_table('installation')
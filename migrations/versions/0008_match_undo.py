@@ -0,0 +1,31 @@
+"""undo record of a match
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2019-12-10 00:00:07
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+COLUMNS = [
+    ('winner_elo_before', sa.Float()),
+    ('winner_streak_before', sa.Integer()),
+    ('loser_elo_before', sa.Float()),
+    ('loser_streak_before', sa.Integer())
+]
+
+
+def upgrade():
+    for name, type_ in COLUMNS:
+        op.add_column('match', sa.Column(name, type_))
+
+
+def downgrade():
+    for name, _ in reversed(COLUMNS):
+        op.drop_column('match', name)
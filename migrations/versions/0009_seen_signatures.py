@@ -0,0 +1,28 @@
+"""signatures of accepted requests
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2019-12-10 00:00:08
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'seen_signature',
+        sa.Column('signature', sa.String(), primary_key=True),
+        sa.Column('expires_at', sa.DateTime(), nullable=False)
+    )
+    op.create_index('ix_seen_signature_expires_at', 'seen_signature', ['expires_at'])
+
+
+def downgrade():
+    op.drop_index('ix_seen_signature_expires_at', table_name='seen_signature')
+    op.drop_table('seen_signature')
@@ -0,0 +1,29 @@
+"""match count and last report of a channel's standings
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2019-12-10 00:00:09
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0010'
+down_revision = '0009'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('channel', sa.Column('match_count', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('channel', sa.Column('last_report', sa.JSON()))
+    # last_report stays NULL, the stored previous ranks are up to date until the next report
+    op.execute(
+        'UPDATE channel SET match_count = '
+        '(SELECT coalesce(sum(played), 0) / 2 FROM standing WHERE standing.channel_id = channel.id)'
+    )
+
+
+def downgrade():
+    op.drop_column('channel', 'last_report')
+    op.drop_column('channel', 'match_count')
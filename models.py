@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Index
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, Float, JSON, String, DateTime, Index, UniqueConstraint
 from sqlalchemy.ext import declarative
 
 
@@ -11,6 +11,23 @@ class Team(Base):
     id = Column(Integer, primary_key=True)
     slack_team_id = Column(String, nullable=False, unique=True)
     slack_team_domain = Column(String, nullable=False)
+    nickname_version = Column(Integer, nullable=False, default=0)  # incremented whenever a member changes nickname
+
+
+class Installation(Base):
+    """ Tokens of the app's installation into a Slack team, which may be installed before its first command.
+    """
+    __tablename__ = 'installation'
+
+    id = Column(Integer, primary_key=True)
+    slack_team_id = Column(String, nullable=False, unique=True)  # Team.slack_team_id
+    slack_team_name = Column(String, nullable=False)
+    access_token = Column(String, nullable=False)
+    scope = Column(String, nullable=False)
+    installed_by = Column(String, nullable=False)  # slack user id
+    bot_user_id = Column(String)  # NULL unless the bot scope was granted
+    bot_access_token = Column(String)
+    installed_at = Column(DateTime, nullable=False)  # of the latest installation
 
 
 class AppUser(Base):
@@ -22,6 +39,10 @@ class AppUser(Base):
     slack_user_name = Column(String, nullable=False)
     nickname = Column(String)
 
+    __table_args__ = (
+        UniqueConstraint('team_id', 'slack_user_id', name='uq_app_user_team_id_slack_user_id'),  # get_app_user
+    )
+
 
 class Channel(Base):
     __tablename__ = 'channel'
@@ -31,6 +52,14 @@ class Channel(Base):
     slack_channel_id = Column(String, nullable=False)
     slack_channel_name = Column(String, nullable=False)
     rankings_reset_at = Column(DateTime, nullable=False)
+    standings_valid = Column(Boolean, nullable=False, default=False)  # False until standings are rebuilt by replay
+    version = Column(Integer, nullable=False, default=0)  # incremented by every change of the channel's leaderboard
+    match_count = Column(Integer, nullable=False, default=0)  # matches in the standings, counted along with them
+    last_report = Column(JSON)  # [app_user_id, elo before] of the last report's players, see get_previous_ranks
+
+    __table_args__ = (
+        UniqueConstraint('team_id', 'slack_channel_id', name='uq_channel_team_id_slack_channel_id'),  # get_channel
+    )
 
 
 class Match(Base):
@@ -41,7 +70,65 @@ class Match(Base):
     winner_id = Column(Integer, ForeignKey('app_user.id', ondelete='CASCADE'), nullable=False)
     loser_id = Column(Integer, ForeignKey('app_user.id', ondelete='CASCADE'), nullable=False)
     timestamp = Column(DateTime, nullable=False)
+    batched = Column(Boolean, nullable=False, default=False)  # reported in the same command as the previous match
+    # undo record, the players' elo and streak right before the match (see revert_match), NULL if the match was
+    # inserted while the channel's standings were invalid
+    winner_elo_before = Column(Float)
+    winner_streak_before = Column(Integer)
+    loser_elo_before = Column(Float)
+    loser_streak_before = Column(Integer)
+
+    __table_args__ = (
+        Index('ix_match_channel_id_timestamp', 'channel_id', 'timestamp'),  # match history since the rankings reset
+        Index('ix_match_channel_id_id', 'channel_id', 'id'),  # last match of a channel (get_leaderboard_version)
+        Index('ix_match_channel_id_winner_id_id', 'channel_id', 'winner_id', 'id'),  # get_last_match
+    )
+
+
+class Standing(Base):
+    """ Snapshot of a player's stats since the channel's last rankings reset, kept up to date by insert_match(es).
+    """
+    __tablename__ = 'standing'
+
+    id = Column(Integer, primary_key=True)  # ordered by the player's first match, used to break elo ties
+    channel_id = Column(Integer, ForeignKey('channel.id', ondelete='CASCADE'), nullable=False)
+    app_user_id = Column(Integer, ForeignKey('app_user.id', ondelete='CASCADE'), nullable=False)
+    elo = Column(Float, nullable=False)
+    played = Column(Integer, nullable=False)
+    won = Column(Integer, nullable=False)
+    lost = Column(Integer, nullable=False)
+    streak = Column(Integer, nullable=False)
+    previous_rank = Column(Integer)  # as of the last replay, read through elo.load_standings (see Channel.last_report)
+
+    __table_args__ = (
+        UniqueConstraint('channel_id', 'app_user_id', name='uq_standing_channel_id_app_user_id'),
+    )
+
+
+class Checkpoint(Base):
+    """ Standings of a channel right after a match, replays of older parts of the history start from the nearest one.
+    """
+    __tablename__ = 'checkpoint'
+
+    id = Column(Integer, primary_key=True)
+    channel_id = Column(Integer, ForeignKey('channel.id', ondelete='CASCADE'), nullable=False)
+    match_id = Column(Integer, ForeignKey('match.id', ondelete='CASCADE'), nullable=False)  # last match included
+    standings = Column(JSON, nullable=False)  # [app_user_id, elo, played, won, lost, streak, previous_rank] rows
+
+    __table_args__ = (
+        UniqueConstraint('channel_id', 'match_id', name='uq_checkpoint_channel_id_match_id'),  # get_checkpoint
+    )
+
+
+class SeenSignature(Base):
+    """ Signature of an accepted Slack request, kept until its timestamp is too old to pass check_signature anyway, so
+    a replay is rejected by every worker.
+    """
+    __tablename__ = 'seen_signature'
+
+    signature = Column(String, primary_key=True)
+    expires_at = Column(DateTime, nullable=False)
 
     __table_args__ = (
-        Index('idx_match_0', 'id', 'timestamp'),  # used withing get_leaderboard function
+        Index('ix_seen_signature_expires_at', 'expires_at'),  # remember_signature sweep
     )
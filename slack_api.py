@@ -0,0 +1,58 @@
+import os
+import threading
+
+
+class SlackApiError(Exception):
+    """ The Slack Web API could not be reached in time or answered with ok=false, the message says which.
+    """
+
+
+class SlackClient:
+    """ Calls Slack Web API methods through one pooled HTTP session per process, with strict connect/read timeouts.
+
+    A slow Slack API fails the call after `connect_timeout` + `read_timeout` seconds instead of pinning the worker.
+    `base_url` points the client at a local fake in tests.
+    """
+
+    def __init__(self, base_url: str = 'https://slack.com/api/', connect_timeout: float = 3.05,
+                 read_timeout: float = 5, pool_size: int = 4):
+        assert pool_size > 0
+        self.base_url = base_url.rstrip('/') + '/'
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def call(self, method: str, auth: tuple = None, **params) -> dict:
+        """ POSTs the form encoded params to the API method and returns the parsed response of an ok call.
+        """
+        import requests  # imported on first use, see session
+
+        try:
+            response = self.session.post(self.base_url + method, data=params, auth=auth, timeout=self.timeout)
+            response.raise_for_status()
+            body = response.json()
+        except (requests.RequestException, ValueError) as e:
+            raise SlackApiError(f'{method}: {type(e).__name__}: {e}') from e
+        if not body.get('ok'):
+            raise SlackApiError(f'{method}: {body.get("error", "not ok")}')
+        return body
+
+    def oauth_access(self, client_id: str, client_secret: str, code: str) -> dict:
+        """ Exchanges the code of an app installation for its tokens, see https://api.slack.com/methods/oauth.access
+        """
+        return self.call('oauth.access', auth=(client_id, client_secret), code=code)
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # connections must not be shared with a forked process, every worker opens its own
+                import requests
+                from requests.adapters import HTTPAdapter
+                self._session = requests.Session()
+                self._session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+                self._session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+                self._pid = os.getpid()
+            return self._session
@@ -1,12 +1,27 @@
+import app
 import json
+import elo
 import pytest
+import threading
+import time
 
+from datetime import datetime
+from functools import partial
+
+from sqlalchemy import event
+from sqlalchemy.exc import InternalError
 from undecorated import undecorated
 
-from models import Match
+from app import get_leaderboard_lines, render_leaderboard
+from benchmarks.slack import command_body, mention, sign
+from cache import ExpiringSet, SingleFlight
+from database import get_session, get_team, get_channel, get_app_user, get_pool_stats, insert_matches
+from elo import invalidate_standings, replay, PlayerStats
+from models import AppUser, Base, Channel, Checkpoint, Match, Standing
 
 
 @pytest.mark.usefixtures('prepare_db')
+@pytest.mark.freeze_time('2019-10-14 11:16:03')
 def test_authorize_validate(client, monkeypatch):
     headers = {
         'X-Slack-Signature': 'v0=1a42e11e6acd65647b826eed12be835247f0754f4a285f70a366d4a8472579da',
@@ -35,6 +50,51 @@ def test_authorize_validate(client, monkeypatch):
         assert client.post('/won', data=data, headers=headers).status_code == 400  # Bad Request
 
 
+@pytest.mark.usefixtures('prepare_db')
+def test_authorize_rejects_before_reading_the_body(client, db_session, monkeypatch):
+    body = command_body('/won', team_id='T1', channel_id='C1', user_id='A', text=mention('B'))
+    headers = sign(client.application.config['SIGNING_SECRET'], body)
+    post = partial(client.post, '/won', content_type='application/x-www-form-urlencoded')
+
+    assert post(data=body, headers=dict(headers, **{'X-Slack-Signature': 'v0=abc'})).status_code == 401
+    assert post(data=body, headers={}).status_code == 401
+    stale = sign(client.application.config['SIGNING_SECRET'], body, timestamp=int(time.time()) - 301)
+    assert post(data=body, headers=stale).status_code == 401
+    assert post(data=body + 'x', headers=headers).status_code == 401  # tampered body
+    assert post(data=body, headers=headers).status_code == 200
+
+    statements = []
+
+    def count_statements(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db_session.get_bind(), 'before_cursor_execute', count_statements)
+    try:
+        assert post(data=body, headers=headers).status_code == 401  # replayed
+    finally:
+        event.remove(db_session.get_bind(), 'before_cursor_execute', count_statements)
+    assert statements == []
+    assert db_session.query(Match).count() == 1
+    reasons = ['malformed', 'stale', 'signature', 'replay']
+    assert {x: app.rejected_requests.value(reason=x) for x in reasons} == dict(zip(reasons, [2, 1, 1, 1]))
+    assert 'slack_pong_rejected_requests_total{reason="replay"} 1' in client.get('/metrics').get_data(as_text=True)
+
+    monkeypatch.setattr(app, 'seen_signatures', ExpiringSet(maxsize=10))  # sent to a worker that hasn't seen it
+    assert post(data=body, headers=headers).status_code == 401
+    assert db_session.query(Match).count() == 1
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('connection lost')
+
+    body = command_body('/won', team_id='T1', channel_id='C1', user_id='A', text=mention('C'))
+    headers = sign(client.application.config['SIGNING_SECRET'], body)
+    with monkeypatch.context() as m:
+        m.setattr(app, 'insert_matches', fail)
+        assert post(data=body, headers=headers).status_code == 500
+    assert post(data=body, headers=headers).status_code == 200  # Slack's retry, the failed attempt was rolled back
+    assert db_session.query(Match).count() == 2
+
+
 def test_db(prepare_db, db_session):
     assert db_session.query(Match).count() == 0
 
@@ -43,6 +103,15 @@ def undecorate(app, function: str):
     app.view_functions[function] = undecorated(app.view_functions[function])
 
 
+def test_create_app(client):
+    created = app.create_app(dict(client.application.config, LEADERBOARD_CACHE_SIZE=3))
+    assert {x.rule for x in created.url_map.iter_rules()} >= {'/won', '/leaderboard', '/revert', '/reset', '/oauth'}
+    assert {'digest', 'import-matches'} <= set(created.cli.commands)
+    assert app.leaderboard_cache.maxsize == 3
+    app.warm_up(created)
+    assert get_pool_stats(created.config)['checked_in'] >= 1
+
+
 def test_nickname(client):
     undecorate(client.application, 'nickname')
     assert client.post('/nickname').status_code == 400  # bad request
@@ -172,3 +241,366 @@ def test_won(client):
         '[ 1501 ] 3. gregor                       2↓ | 1 | 1 |  2 | 50.0% |       '
         '```'
     )
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_check_standings_command(client, db_session):
+    undecorate(client.application, 'won')
+    for user_id, text in [('a_id', '<@b_id|b>'), ('b_id', '<@a_id|a>'), ('a_id', '<@c_id|c>')]:
+        client.post('/won', data={
+            'user_id': user_id,
+            'user_name': user_id[0],
+            'text': text,
+            'team_id': 'team_1',
+            'team_domain': 'some-team',
+            'channel_id': 'channel_1',
+            'channel_name': 'some-channel'
+        })
+    runner = client.application.test_cli_runner()
+    result = runner.invoke(args=['check-standings'])
+    assert result.exit_code == 0
+    assert result.output == '0 inconsistent channel(s)\n'
+
+    db_session.query(Standing).filter(Standing.played == 1).update({'streak': 5})
+    db_session.commit()
+    result = runner.invoke(args=['check-standings'])
+    assert result.exit_code == 1
+    assert result.output.endswith('streak is 5, replay gives -1\n1 inconsistent channel(s)\n')
+
+    assert runner.invoke(args=['check-standings', '--rebuild']).exit_code == 0
+    assert runner.invoke(args=['check-standings']).output == '0 inconsistent channel(s)\n'
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_get_leaderboard_lines_query_count_does_not_depend_on_player_count(db_session):
+    team = get_team(db_session, slack_team_id='team_1', slack_team_domain='some-team')
+    statements = []
+
+    def count_statements(*args):
+        statements.append(args[2])
+
+    query_counts = []
+    for players in [2, 20]:
+        app_user_ids = [get_app_user(
+            db_session, team_id=team.id, slack_user_id=f'{players}_{i}', slack_user_name=f'user {i}'
+        ).id for i in range(players)]
+        leaderboard = [PlayerStats(rank=i, app_user_id=x, elo=1500, played=1, lost=0, won=1, move=0, streak=1)
+                       for i, x in enumerate(app_user_ids, start=1)]
+        statements.clear()
+        event.listen(db_session.get_bind(), 'before_cursor_execute', count_statements)
+        try:
+            lines = get_leaderboard_lines(db=db_session, leaderboard=leaderboard)
+        finally:
+            event.remove(db_session.get_bind(), 'before_cursor_execute', count_statements)
+        assert len(lines) == 2 * players + 1
+        query_counts.append(len(statements))
+    assert query_counts == [1, 1]
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_render_leaderboard_cache(client):
+    undecorate(client.application, 'won')
+    undecorate(client.application, 'nickname')
+    cache = app.leaderboard_cache
+    data = {
+        'user_id': 'a_id',
+        'user_name': 'a',
+        'text': '<@b_id|b>',
+        'team_id': 'team_1',
+        'team_domain': 'some-team',
+        'channel_id': 'channel_1',
+        'channel_name': 'some-channel'
+    }
+    client.post('/won', data=data)
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (0, 1)
+
+    with client.application.app_context():
+        with get_session() as db:
+            channel_id = db.query(Channel.id).scalar()
+            lines = render_leaderboard(db, channel_id=channel_id)
+            assert render_leaderboard(db, channel_id=channel_id) is lines
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (2, 1)
+
+    client.post('/nickname', data=dict(data, text='the champion'))
+    with client.application.app_context():
+        with get_session() as db:
+            assert 'the champion' in render_leaderboard(db, channel_id=channel_id)[2]
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (2, 2)
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_render_leaderboard_single_flight(client, db_session, monkeypatch):
+    """ A burst of requests for a leaderboard whose standings need a rebuild replays the history once.
+    """
+    team = get_team(db_session, slack_team_id='team_1', slack_team_domain='some-team')
+    channel = get_channel(db_session, team_id=team.id, slack_channel_id='channel_1', slack_channel_name='some-channel')
+    players = [get_app_user(db_session, team_id=team.id, slack_user_id=f'{x}_id', slack_user_name=x) for x in 'abcd']
+    results = [(x.id, y.id) for x in players for y in players if x != y]
+    insert_matches(db_session, channel_id=channel.id, results=results)
+    channel_id = channel.id
+    replays = []
+
+    def slow_replay(*args, **kwargs):
+        replays.append(1)
+        time.sleep(0.1)  # long enough for the whole burst to arrive while the first replay runs
+        return replay(*args, **kwargs)
+    monkeypatch.setattr(elo, 'replay', slow_replay)
+
+    def burst(size: int) -> list:
+        invalidate_standings(db_session, channel_id=channel_id)
+        db_session.commit()
+        app.leaderboard_cache.clear()
+        barrier = threading.Barrier(size)
+        results = [None] * size
+
+        def request(i):
+            with client.application.app_context():
+                with get_session() as db:
+                    barrier.wait()
+                    results[i] = render_leaderboard(db, channel_id=channel_id)
+        threads = [threading.Thread(target=request, args=(i,)) for i in range(size)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    results = burst(8)
+    assert len(replays) == 1 and all(x == results[0] for x in results) and len(results[0]) > 1
+    assert app.leaderboard_flights.stats()['shared'] == 7
+
+    replays.clear()
+    monkeypatch.setattr(app, 'leaderboard_flights', SingleFlight(timeout=0))
+    assert burst(8) == results
+    assert len(replays) == 8  # without coalescing every request replays, one after another
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_won_deferred_response(client, monkeypatch):
+    undecorate(client.application, 'won')
+    posted = []
+    monkeypatch.setitem(client.application.config, 'DEFERRED_RESPONSES', True)
+    monkeypatch.setattr(app.deferred_responder, 'poster', lambda url, payload: posted.append((url, payload)))
+    data = {
+        'user_id': 'gregor_id',
+        'user_name': 'gregor',
+        'text': '<@yuri_id|yuri>',
+        'team_id': 'team_1',
+        'team_domain': 'some-team',
+        'channel_id': 'channel_1',
+        'channel_name': 'some-channel',
+        'response_url': 'http://localhost/response'
+    }
+    resp = json.loads(client.post('/won', data=data).get_data())
+    assert resp == {'response_type': 'ephemeral', 'text': 'Match recorded, the leaderboard will be posted shortly.'}
+    app.deferred_responder.join()
+    assert len(posted) == 1
+    url, payload = posted[0]
+    assert url == 'http://localhost/response'
+    assert payload['response_type'] == 'in_channel'
+    assert payload['text'].strip('```').split('\n')[2] == '[ 1517 ] 1. gregor      | 1 | 0 |  1 | 100.0% |       '
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_metrics_and_slow_request_log(client, db_session, monkeypatch, caplog):
+    undecorate(client.application, 'won')
+    monkeypatch.setitem(client.application.config, 'SLOW_REQUEST_THRESHOLD', 0)
+    data = {
+        'user_id': 'gregor_id',
+        'user_name': 'gregor',
+        'text': '<@yuri_id|yuri>',
+        'team_id': 'team_1',
+        'team_domain': 'some-team',
+        'channel_id': 'channel_1',
+        'channel_name': 'some-channel'
+    }
+    client.post('/won', data=data)
+    invalidate_standings(db_session, channel_id=db_session.query(Channel.id).scalar())
+    db_session.commit()
+    client.post('/won', data=data)  # rebuilds the standings by replay
+    message = caplog.records[-1].getMessage()
+    assert message.startswith('slow request POST /won took ')
+    for phase in ['lookup', 'insert', 'history', 'replay', 'standings', 'render']:
+        assert f' {phase}=' in message
+    assert message.endswith(' replayed_matches=2')
+
+    resp = client.get('/metrics')
+    assert resp.status_code == 200
+    text = resp.get_data(as_text=True)
+    assert 'slack_pong_request_seconds_count{route="/won"} 2\n' in text
+    assert 'slack_pong_request_phase_seconds_count{route="/won",phase="replay"} 1\n' in text
+    assert 'slack_pong_leaderboard_cache{stat="misses"} 2\n' in text
+    assert 'slack_pong_database_pool{stat="checkouts"}' in text
+
+    monkeypatch.setitem(client.application.config, 'METRICS_TOKEN', 'secret')
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_leaderboard_command(client, monkeypatch):
+    undecorate(client.application, 'won')
+    undecorate(client.application, 'leaderboard')
+    monkeypatch.setitem(client.application.config, 'LEADERBOARD_PAGE_SIZE', 2)
+    monkeypatch.setitem(client.application.config, 'WON_LEADERBOARD_SIZE', 1)
+    data = {
+        'user_id': 'a_id',
+        'user_name': 'a',
+        'text': '',
+        'team_id': 'team_1',
+        'team_domain': 'some-team',
+        'channel_id': 'channel_1',
+        'channel_name': 'some-channel'
+    }
+    assert client.post('/leaderboard', data=data).get_json()['text'] == 'No players on this page.'
+    for winner, loser in [('a', 'b'), ('a', 'c'), ('d', 'e')]:
+        response = client.post('/won', data=dict(data, user_id=f'{winner}_id', user_name=winner,
+                                                 text=f'<@{loser}_id|{loser}>'))
+    # compact leaderboard of /won shows the top player and both players of the match
+    lines = response.get_json()['text'].strip('`').split('\n')
+    assert [line.split('. ')[1].split()[0] for line in lines[2::2]] == ['a', 'd', 'e']
+    assert lines[3].startswith('―') and lines[5].startswith('·')
+
+    def names(text):
+        response = client.post('/leaderboard', data=dict(data, text=text)).get_json()
+        assert response['response_type'] == 'in_channel'
+        return [line.split('. ')[1].split()[0] for line in response['text'].strip('`').split('\n')[2::2]]
+    assert names('') == ['a', 'd']
+    assert names('top 4') == ['a', 'd', 'c', 'b']
+    assert names('page 2') == ['c', 'b']
+    assert names('page 3') == ['e']
+    assert names('me') == ['a', 'd']
+    assert client.post('/leaderboard', data=dict(data, text='page 4')).get_json() == {
+        'text': 'No players on this page.'
+    }
+    assert client.post('/leaderboard', data=dict(data, user_id='f_id', text='me')).get_json() == {
+        'text': 'You haven\'t played in this channel yet.'
+    }
+    assert client.post('/leaderboard', data=dict(data, text='page x')).get_json()['text'].startswith(':x: Usage')
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_won_batch(client, db_session, monkeypatch):
+    undecorate(client.application, 'won')
+    monkeypatch.setitem(client.application.config, 'WON_MAX_MATCHES', 3)
+    data = {
+        'user_id': 'a_id',
+        'user_name': 'a',
+        'text': '<@b_id|b> <@b_id|b>\n<@c_id|c> beat <@b_id|b>',
+        'team_id': 'team_1',
+        'team_domain': 'some-team',
+        'channel_id': 'channel_1',
+        'channel_name': 'some-channel'
+    }
+    inserts = []
+
+    def count_inserts(*args):
+        if args[2].startswith('INSERT INTO match'):
+            inserts.append(args[2])
+    event.listen(db_session.get_bind(), 'before_cursor_execute', count_inserts)
+    try:
+        text = client.post('/won', data=data).get_json()['text']
+    finally:
+        event.remove(db_session.get_bind(), 'before_cursor_execute', count_inserts)
+    assert len(inserts) == 1
+    assert text.startswith('3 matches recorded.\n```')
+    slack_user_ids = dict(db_session.query(AppUser.id, AppUser.slack_user_id))
+    matches = db_session.query(Match).order_by(Match.id)
+    assert [(slack_user_ids[x.winner_id], slack_user_ids[x.loser_id], x.batched) for x in matches] == [
+        ('a_id', 'b_id', False), ('a_id', 'b_id', True), ('c_id', 'b_id', True)
+    ]
+
+    assert client.post('/won', data=dict(data, text='<@b_id|b> beat <@b_id|b>')).get_json() == {
+        'text': ':x: You cannot mention yourself. Mention the player you have won.'
+    }
+    assert client.post('/won', data=dict(data, text='<@b_id|b> ' * 4)).get_json() == {
+        'text': ':x: At most 3 matches can be reported at once.'
+    }
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_leaderboard_as_of_and_timeline(client, db_session, monkeypatch):
+    undecorate(client.application, 'won')
+    undecorate(client.application, 'revert')
+    undecorate(client.application, 'leaderboard')
+    monkeypatch.setitem(client.application.config, 'CHECKPOINT_INTERVAL', 1)
+    data = {
+        'user_id': 'a_id',
+        'user_name': 'a',
+        'text': '<@b_id|b>',
+        'team_id': 'team_1',
+        'team_domain': 'some-team',
+        'channel_id': 'channel_1',
+        'channel_name': 'some-channel'
+    }
+    client.post('/won', data=data)
+    client.post('/won', data=dict(data, user_id='b_id', user_name='b', text='<@a_id|a>'))
+    client.post('/won', data=dict(data, user_id='b_id', user_name='b', text='<@a_id|a>'))
+    assert db_session.query(Checkpoint).count() == 3
+    client.post('/revert', data=dict(data, user_id='b_id', user_name='b'))
+    assert db_session.query(Checkpoint).count() == 2
+
+    db_session.query(Channel).one().rankings_reset_at = datetime(2019, 11, 1)
+    first, second = db_session.query(Match).order_by(Match.id)
+    first.timestamp = datetime(2019, 12, 1, 10, 0)
+    second.timestamp = datetime(2019, 12, 2, 10, 0)
+    db_session.commit()
+    response = client.post('/leaderboard', data=dict(data, text='as-of 2019-12-01')).get_json()
+    assert response['text'].split('\n')[2].startswith('[ 1517 ] 1. a ')
+    response = client.post('/leaderboard', data=dict(data, text='as-of 2019-12-02 10:00')).get_json()
+    assert response['text'].split('\n')[2].startswith('[ 1504 ] 1. b ')
+    assert client.post('/leaderboard', data=dict(data, text='as-of 2019-11-30')).get_json() == {
+        'text': 'No players on this page.'
+    }
+
+    response = client.post('/leaderboard', data=dict(data, text='timeline')).get_json()
+    assert response['text'] == '```2019-12-01 10:00 W  1517 (+17) vs b\n2019-12-02 10:00 L  1501 (-16) vs b```'
+
+
+def replicate(primary, replica):
+    """ Copies every row of the primary to the replica, like streaming replication catching up would.
+    """
+    for table in reversed(Base.metadata.sorted_tables):
+        replica.execute(table.delete())
+    for table in Base.metadata.sorted_tables:
+        rows = [dict(x) for x in primary.execute(table.select())]
+        if rows:
+            replica.execute(table.insert(), rows)
+
+
+def test_leaderboard_reads_from_caught_up_replica(client, db_session, replica):
+    undecorate(client.application, 'won')
+    undecorate(client.application, 'leaderboard')
+    data = {
+        'user_id': 'a_id',
+        'user_name': 'a',
+        'text': '<@b_id|b>',
+        'team_id': 'team_1',
+        'team_domain': 'some-team',
+        'channel_id': 'channel_1',
+        'channel_name': 'some-channel'
+    }
+
+    def leaderboard():
+        app.leaderboard_cache.clear()
+        return client.post('/leaderboard', data=dict(data, text='')).get_json()['text']
+
+    stats = get_pool_stats()
+    assert client.post('/won', data=data).status_code == 200
+    assert 'a   ' in leaderboard()  # the replica is empty, read from the primary
+    assert get_pool_stats()['replica_fallbacks'] == stats['replica_fallbacks'] + 1
+
+    replicate(db_session.get_bind(), replica)
+    replica.execute(AppUser.__table__.update().where(AppUser.slack_user_id == 'a_id').values(nickname='replica_a'))
+    assert 'replica_a' in leaderboard()
+    assert get_pool_stats()['replica_reads'] == stats['replica_reads'] + 1
+
+    # read-your-writes: the replica hasn't seen the second match yet, both responses come from the primary
+    assert '| 2 | 0 |  2 |' in client.post('/won', data=data).get_json()['text']
+    text = leaderboard()
+    assert '| 2 | 0 |  2 |' in text and 'replica_a' not in text
+    assert get_pool_stats()['replica_fallbacks'] == stats['replica_fallbacks'] + 2
+
+    with pytest.raises(InternalError, match='read-only transaction'):
+        with get_session(replica=True) as db:
+            db.execute(Match.__table__.delete())
@@ -0,0 +1,69 @@
+import pytest
+import threading
+
+from werkzeug.serving import make_server
+
+from benchmarks import digest, leaderboard, load, startup, transfer
+
+
+def test_leaderboard_benchmark_smoke(client, tmp_path):
+    results = leaderboard.run(f'sqlite:///{tmp_path}/benchmark.db', sizes=[5, 20], players=4, repeat=1)
+    assert {x['benchmark'] for x in results['results']} >= {'replay_python', 'rebuild', 'render', 'won'}
+    assert {x['matches'] for x in results['results']} == {5, 20}
+    assert results['environment']['database'] == 'sqlite'
+
+
+def test_leaderboard_benchmark_compare():
+    baseline = {'results': [{'benchmark': 'render', 'matches': 10, 'median': 0.002}]}
+    results = {'results': [
+        {'benchmark': 'render', 'matches': 10, 'median': 0.003},
+        {'benchmark': 'render', 'matches': 100, 'median': 0.003}
+    ]}
+    assert leaderboard.compare(results, baseline) == [
+        {'benchmark': 'render', 'matches': 10, 'baseline': 0.002, 'median': 0.003, 'ratio': 1.5}
+    ]
+
+
+def test_transfer_benchmark_smoke(client, tmp_path):
+    results = transfer.run(f'sqlite:///{tmp_path}/benchmark.db', sizes=[20], players=4, repeat=1)
+    assert {x['benchmark'] for x in results['results']} == {
+        'export_csv_batched', 'import_csv_batched', 'export_jsonl_batched', 'import_jsonl_batched'
+    }
+    assert all(x['rows_per_second'] > 0 for x in results['results'])
+
+
+def test_digest_benchmark_smoke(client, tmp_path):
+    results = digest.run(f'sqlite:///{tmp_path}/benchmark.db', channels=3, matches=10, players=4, processes=[1, 2],
+                         repeat=1)
+    assert [x['benchmark'] for x in results['results']] == [
+        'per_channel_replay', 'batch_1_replay', 'batch_2_replay', 'per_channel_valid', 'batch_1_valid', 'batch_2_valid'
+    ]
+
+
+def test_startup_benchmark_smoke(tmp_path):
+    results = startup.run(f'sqlite:///{tmp_path}/benchmark.db', repeat=1)
+    assert [x['benchmark'] for x in results['results']] == [
+        'import', 'first_request', 'warm_request', 'import_after_warm_up', 'warm_up', 'first_request_after_warm_up',
+        'warm_request_after_warm_up'
+    ]
+    assert results['eager_modules'] == []  # optional integrations are imported when first used
+    baseline = {'results': [{'benchmark': 'import', 'median': results['results'][0]['median']}]}
+    assert [x['ratio'] for x in startup.compare(results, baseline)] == [1]
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_load_benchmark_smoke(client):
+    server = make_server('127.0.0.1', 0, client.application, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        secret = client.application.config['SIGNING_SECRET']
+        results = load.run(f'http://127.0.0.1:{server.port}', signing_secret=secret, rps=40, duration=1,
+                           mix=load.parse_mix('won=4,revert=1,reset=1,nickname=1'), channels=3, players=6, roster=4,
+                           concurrency=4)
+    finally:
+        server.shutdown()
+    summary = results['summary']
+    assert summary['all']['requests'] > 10 and summary['all']['error_rate'] == 0
+    assert set(summary) <= {'all', 'won', 'revert', 'reset', 'nickname'} and 'won' in summary
+    assert summary['all']['p50'] <= summary['all']['p95'] <= summary['all']['p99']
+    assert load.percentile([3, 1, 2, 4], 50) == 2 and load.percentile([3, 1, 2, 4], 99) == 4
@@ -0,0 +1,86 @@
+import pytest
+import threading
+
+from cache import ExpiringSet, LRUCache, Memo, SingleFlight
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1  # 'b' is now the least recently used entry
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+    assert cache.stats() == {'size': 2, 'maxsize': 2, 'hits': 2, 'misses': 1, 'evictions': 1}
+
+
+def test_lru_cache_evict_by_predicate():
+    cache = LRUCache(maxsize=10)
+    for key in [(1, 'x'), (1, 'y'), (2, 'x')]:
+        cache.put(key, key)
+    cache.evict(lambda key: key[0] == 1)
+    assert len(cache) == 1
+    assert cache.get((2, 'x')) == (2, 'x')
+
+
+def test_lru_cache_disabled():
+    cache = LRUCache(maxsize=0)
+    cache.put('a', 1)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_expiring_set():
+    now = [100]
+    seen = ExpiringSet(maxsize=2, clock=lambda: now[0])
+    assert seen.add('a', expires=110)
+    assert not seen.add('a', expires=120)
+    assert 'a' in seen
+    now[0] = 111
+    assert 'a' not in seen
+    assert seen.add('a', expires=120)  # expired keys can be added again
+    assert seen.add('b', expires=130)
+    assert seen.add('c', expires=130)  # evicts 'a' before it expired
+    assert 'a' not in seen and 'b' in seen
+    now[0] = 131
+    assert seen.add('d', expires=140)  # expired keys are dropped without counting as evictions
+    assert seen.stats() == {'size': 1, 'maxsize': 2, 'evictions': 1}
+    seen.discard('d')
+    assert seen.add('d', expires=140)
+
+
+def test_memo_drops_loads_racing_an_eviction():
+    memo = Memo()
+    assert memo.get('a', load=lambda: 1) == 1
+    assert memo.get('a', load=lambda: 2) == 1
+
+    def load():
+        memo.evict('b')  # e.g. a change published while the value was being loaded
+        return 3
+    assert memo.get('a2', load=load) == 3
+    assert len(memo) == 1
+    memo.evict()
+    assert memo.get('a', load=lambda: 4) == 4
+
+
+def test_single_flight_bounded_wait():
+    flights = SingleFlight(timeout=0.05)
+    started, release = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait()
+        return 'slow'
+    leader = threading.Thread(target=flights.do, args=('key', slow))
+    leader.start()
+    started.wait()
+    assert flights.do('key', lambda: 'direct') == 'direct'  # gave up waiting for the leader
+    assert flights.do('other', lambda: 'other') == 'other'
+    release.set()
+    leader.join()
+    assert flights.stats() == {'running': 0, 'calls': 2, 'shared': 0, 'fallbacks': 1}
+
+    with pytest.raises(ZeroDivisionError):
+        flights.do('key', lambda: 1 / 0)
+    assert flights.do('key', lambda: 'again') == 'again'
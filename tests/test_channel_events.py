@@ -0,0 +1,108 @@
+import app
+import pytest
+import time
+
+from sqlalchemy import event
+from undecorated import undecorated
+
+from channel_events import publish_channel_changes, ChannelListener
+from database import get_session, get_team, get_channel, get_app_user, insert_match
+
+
+def wait_for(predicate, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+@pytest.mark.usefixtures('prepare_db')
+@pytest.mark.parametrize('listen', [True, False])
+def test_listener_delivers_committed_changes(db_session, listen):
+    team = get_team(db_session, slack_team_id='team_1', slack_team_domain='some-team')
+    channels = [get_channel(db_session, team_id=team.id, slack_channel_id=x, slack_channel_name=x) for x in 'ab']
+    db_session.commit()
+    changes = []
+    listener = ChannelListener(on_change=changes.append, poll_interval=0.05, listen=listen)
+    listener.start(db_session.get_bind())
+    try:
+        wait_for(lambda: listener.connected)
+        assert changes == [None]  # anything may have changed before the listener connected
+
+        publish_channel_changes(db_session, channel_ids=[channels[0].id])
+        db_session.rollback()
+        publish_channel_changes(db_session, channel_ids=[channels[1].id])
+        db_session.commit()
+        wait_for(lambda: len(changes) == 2)
+        time.sleep(0.1)
+        assert changes == [None, channels[1].id]  # rolled back changes aren't published
+        assert listener.stats() == {'connected': 1, 'events': 1, 'reconnects': 0}
+    finally:
+        listener.stop()
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_leaderboard_versions_are_memoized_until_another_worker_changes_the_channel(client, db_session, monkeypatch):
+    monkeypatch.setitem(client.application.config, 'CHANNEL_EVENTS', True)
+    monkeypatch.setattr(app.channel_listener, 'poll_interval', 0.05)
+    client.application.view_functions['leaderboard'] = undecorated(client.application.view_functions['leaderboard'])
+    data = {
+        'user_id': 'a_id',
+        'user_name': 'a',
+        'text': '',
+        'team_id': 'team_1',
+        'team_domain': 'some-team',
+        'channel_id': 'channel_1',
+        'channel_name': 'some-channel'
+    }
+    app.channel_listener.start(db_session.get_bind())
+    try:
+        wait_for(lambda: app.channel_listener.connected)
+        versions = []
+
+        def count_versions(conn, cursor, statement, *args):
+            versions.extend([statement] if 'max(match.id)' in statement else [])
+
+        event.listen(db_session.get_bind(), 'before_cursor_execute', count_versions)
+        try:
+            for _ in range(3):
+                assert client.post('/leaderboard', data=data).get_json()['text'] == 'No players on this page.'
+        finally:
+            event.remove(db_session.get_bind(), 'before_cursor_execute', count_versions)
+        assert len(versions) == 1
+
+        with get_session() as db:  # a match reported through another worker
+            team = get_team(db, slack_team_id='team_1', slack_team_domain='some-team')
+            channel = get_channel(db, team_id=team.id, slack_channel_id='channel_1', slack_channel_name='some-channel')
+            a, b = [get_app_user(db, team_id=team.id, slack_user_id=f'{x}_id', slack_user_name=x) for x in 'ab']
+            insert_match(db, channel_id=channel.id, winner_id=a.id, loser_id=b.id)
+        wait_for(lambda: app.channel_listener.events == 1)
+        assert '| 1 | 0 |  1 |' in client.post('/leaderboard', data=data).get_json()['text']
+    finally:
+        app.channel_listener.stop()
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_pending_changes_are_not_memoized(client, monkeypatch):
+    monkeypatch.setattr(app.channel_listener, 'connected', True)  # versions are memoized
+    with client.application.app_context():
+        with get_session() as db:
+            team = get_team(db, slack_team_id='team_1', slack_team_domain='some-team')
+            channel = get_channel(db, team_id=team.id, slack_channel_id='channel_1', slack_channel_name='some-channel')
+            a, b = [get_app_user(db, team_id=team.id, slack_user_id=f'{x}_id', slack_user_name=x).id for x in 'ab']
+            channel_id = channel.id
+        with get_session() as db:
+            insert_match(db, channel_id=channel_id, winner_id=a, loser_id=b)
+            assert len(app.render_leaderboard(db, channel_id=channel_id)) > 1
+            assert len(app.channel_versions) == 0  # the version includes the uncommitted match
+            db.rollback()  # no change is published, nothing would evict a memoized version
+            assert len(app.render_leaderboard(db, channel_id=channel_id)) == 1  # just the header
+            assert len(app.channel_versions) == 1
+
+
+def test_leaderboard_lines_computed_across_a_change_are_not_cached(client, monkeypatch):
+    monkeypatch.setattr(app, 'get_channel_version', lambda db, channel_id: (1,))
+    monkeypatch.setattr(app, 'get_leaderboard', lambda db, channel_id, view: app.invalidate_leaderboard(2) or [])
+    monkeypatch.setattr(app, 'get_leaderboard_lines', lambda db, leaderboard: ['lines'])
+    assert app.render_leaderboard(None, channel_id=1) == ['lines']
+    assert len(app.leaderboard_cache) == 0
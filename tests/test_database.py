@@ -1,6 +1,14 @@
 import pytest
-from database import get_session, get_channel
-from models import Team
+import threading
+import database
+
+from functools import partial
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from database import get_session, get_channel, get_pool_stats, resolve_ids, remember_signature
+from datetime import datetime, timedelta
+from models import AppUser, Channel, SeenSignature, Team
 
 
 @pytest.mark.usefixtures('prepare_db')
@@ -12,3 +20,133 @@ def test_get_channel_rankings_reset_at_default_value():
         channel = get_channel(db, team_id=1, slack_channel_id='a', slack_channel_name='b')
         db.commit()
         assert str(channel.rankings_reset_at) == '2019-12-04 16:34:15'
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_get_session_reuses_pooled_engine():
+    with get_session() as db:
+        engine = db.get_bind()
+    before = get_pool_stats()
+    with get_session() as db:
+        assert db.get_bind() is engine
+        assert db.query(Team).count() == 0
+    stats = get_pool_stats()
+    assert stats['checkouts'] == before['checkouts'] + 1
+    assert stats['checked_out'] == before['checked_out']  # connection is returned to the pool
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_get_session_reuses_sessionmaker(monkeypatch):
+    with get_session() as db:
+        engine = db.get_bind()
+    monkeypatch.setattr(database, 'sessionmaker', None)  # only called when an engine is created
+    with get_session() as db:
+        assert db.get_bind() is engine
+    assert database._sessionmakers[engine].kw['bind'] is engine
+
+
+def test_pool_stats_counters_are_thread_safe(client):
+    with client.application.app_context():
+        before = get_pool_stats()['checkouts']
+        threads = [threading.Thread(target=lambda: [database._count('checkouts') for _ in range(20000)])
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert get_pool_stats()['checkouts'] == before + 80000
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_get_session_discards_connections_inherited_from_parent_process(monkeypatch):
+    with get_session() as db:
+        db.query(Team).count()
+    invalidated = get_pool_stats()['invalidated']
+    monkeypatch.setattr(database.os, 'getpid', lambda: -1)  # pretend to be a forked worker
+    with get_session() as db:
+        assert db.query(Team).count() == 0
+    assert get_pool_stats()['invalidated'] == invalidated + 1
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_resolve_ids_single_statement(db_session):
+    statements = []
+
+    def count_statements(*args):
+        statements.append(args[2])
+
+    event.listen(db_session.get_bind(), 'before_cursor_execute', count_statements)
+    try:
+        ids = resolve_ids(db_session, slack_team_id='T', slack_team_domain='t', slack_channel_id='C',
+                          slack_channel_name='c', slack_users={'U1': 'one', 'U2': 'two'})
+    finally:
+        event.remove(db_session.get_bind(), 'before_cursor_execute', count_statements)
+    assert len(statements) == 1
+
+    again = resolve_ids(db_session, slack_team_id='T', slack_team_domain='t-renamed', slack_channel_id='C',
+                        slack_channel_name='c-renamed', slack_users={'U2': 'two-renamed', 'U3': 'three'})
+    assert (again.team_id, again.channel_id) == (ids.team_id, ids.channel_id)
+    assert again.app_user_ids['U2'] == ids.app_user_ids['U2']
+    assert db_session.query(AppUser.slack_user_name).order_by(AppUser.id).all() == [
+        ('one',), ('two-renamed',), ('three',)
+    ]
+    assert db_session.query(Channel.slack_channel_name).scalar() == 'c-renamed'
+    assert db_session.query(Team.slack_team_domain).scalar() == 't-renamed'
+    assert resolve_ids(db_session, slack_team_id='T', slack_team_domain='t', slack_channel_id='C2',
+                       slack_channel_name='c2', slack_users={}).team_id == ids.team_id
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_resolve_ids_only_locks_changed_rows(client, db_session):
+    resolve = partial(resolve_ids, slack_team_id='T', slack_team_domain='t', slack_channel_id='C',
+                      slack_channel_name='c', slack_users={'U1': 'one'})
+    resolve(db_session)
+    db_session.commit()
+
+    def locked(table: str) -> bool:
+        with client.application.app_context():
+            with get_session() as other:
+                try:
+                    other.execute(f'SELECT id FROM {table} FOR UPDATE NOWAIT').fetchall()
+                    return False
+                except OperationalError:
+                    return True
+
+    assert resolve(db_session) == resolve(db_session)
+    assert not any(locked(x) for x in ['team', 'channel', 'app_user'])  # /leaderboard doesn't wait for /won
+    resolve(db_session, slack_users={'U1': 'one-renamed'})
+    assert [locked(x) for x in ['team', 'channel', 'app_user']] == [False, False, True]
+    db_session.rollback()
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_resolve_ids_concurrent_first_commands(client):
+    barrier = threading.Barrier(4)
+    results = []
+
+    def first_command():
+        with client.application.app_context():
+            with get_session() as db:
+                barrier.wait()
+                results.append(resolve_ids(db, slack_team_id='T', slack_team_domain='t', slack_channel_id='C',
+                                           slack_channel_name='c', slack_users={'U1': 'one', 'U2': 'two'}))
+
+    threads = [threading.Thread(target=first_command) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 4 and len(set(map(repr, results))) == 1
+    with client.application.app_context():
+        with get_session() as db:
+            assert (db.query(Team).count(), db.query(Channel).count(), db.query(AppUser).count()) == (1, 1, 2)
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_remember_signature(db_session):
+    now = datetime.utcnow()
+    assert remember_signature(db_session, signature='v0=a', expires_at=now - timedelta(seconds=1))
+    assert remember_signature(db_session, signature='v0=b', expires_at=now + timedelta(minutes=5))
+    assert not remember_signature(db_session, signature='v0=b', expires_at=now + timedelta(minutes=5))
+    assert remember_signature(db_session, signature='v0=c', expires_at=now + timedelta(minutes=5), sweep=True)
+    assert sorted(x for x, in db_session.query(SeenSignature.signature)) == ['v0=b', 'v0=c']  # expired one swept
@@ -0,0 +1,45 @@
+import threading
+
+from flask import Flask
+
+from deferred import DeferredResponder
+
+
+def test_deferred_responder_posts_result():
+    posted = []
+    responder = DeferredResponder(workers=2, queue_size=10, poster=lambda url, payload: posted.append((url, payload)))
+    for i in range(5):
+        assert responder.submit(Flask(__name__), response_url=f'http://local/{i}', build=lambda i=i: {'text': i})
+    responder.join()
+    assert sorted(posted, key=lambda x: x[1]['text']) == [(f'http://local/{i}', {'text': i}) for i in range(5)]
+
+
+def test_deferred_responder_retries_failed_posts():
+    attempts = []
+
+    def flaky_poster(url, payload):
+        attempts.append(payload)
+        if len(attempts) < 3:
+            raise ConnectionError()
+
+    responder = DeferredResponder(workers=1, queue_size=1, poster=flaky_poster, retries=2, backoff=0)
+    responder.submit(Flask(__name__), response_url='http://local', build=lambda: {'text': 'hi'})
+    responder.join()
+    assert attempts == [{'text': 'hi'}] * 3
+
+
+def test_deferred_responder_rejects_jobs_when_queue_is_full():
+    started, release = threading.Event(), threading.Event()
+
+    def blocking_build():
+        started.set()
+        release.wait()
+        return {}
+
+    responder = DeferredResponder(workers=1, queue_size=1, poster=lambda url, payload: None)
+    assert responder.submit(Flask(__name__), response_url='http://local', build=blocking_build)
+    started.wait()
+    assert responder.submit(Flask(__name__), response_url='http://local', build=dict)  # waits in the queue
+    assert not responder.submit(Flask(__name__), response_url='http://local', build=dict)
+    release.set()
+    responder.join()
@@ -0,0 +1,54 @@
+import pytest
+
+from app import render_leaderboard
+from database import get_session, get_team, get_channel, get_app_user, insert_matches
+from digest import render_leaderboards, render_team_leaderboard
+from elo import invalidate_standings, LeaderboardView
+
+
+def create_channels(db):
+    team = get_team(db, slack_team_id='team_1', slack_team_domain='some-team')
+    a, b, c, d = [get_app_user(db, team_id=team.id, slack_user_id=f'{x}_id', slack_user_name=x) for x in 'abcd']
+    channels = [get_channel(db, team_id=team.id, slack_channel_id=f'channel_{i}', slack_channel_name=f'channel-{i}')
+                for i in range(3)]
+    insert_matches(db, channel_id=channels[0].id, results=[(a.id, b.id), (a.id, c.id)])
+    insert_matches(db, channel_id=channels[1].id, results=[(d.id, a.id)])
+    insert_matches(db, channel_id=channels[1].id, results=[(b.id, a.id), (c.id, d.id)])
+    return team, channels
+
+
+@pytest.mark.usefixtures('prepare_db')
+@pytest.mark.parametrize('processes', [1, 2])
+def test_render_leaderboards_matches_render_leaderboard(client, processes):
+    with get_session() as db:
+        team, channels = create_channels(db)
+        invalidate_standings(db, channel_id=channels[1].id)  # replayed from the history
+        channel_ids = [x.id for x in channels]
+        views = [LeaderboardView(), LeaderboardView(size=2)]
+        leaderboards = [render_leaderboards(db, channel_ids=channel_ids, view=x, processes=processes) for x in views]
+        assert channels[1].standings_valid is False  # nothing is written
+        for view, expected in zip(views, leaderboards):
+            assert list(expected) == channel_ids
+            assert expected == {x: render_leaderboard(db, channel_id=x, view=view) for x in channel_ids}
+        assert len(leaderboards[0][channel_ids[2]]) == 1  # no players, only the header
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_render_team_leaderboard_replays_every_channel_as_one(client):
+    with get_session() as db:
+        team, channels = create_channels(db)
+        lines = render_team_leaderboard(db, team_id=team.id)
+        names = [line.split('. ')[1].split()[0] for line in lines[2::2]]
+        played = [int(line.split('|')[3]) for line in lines[2::2]]
+        assert sorted(zip(names, played)) == [('a', 4), ('b', 2), ('c', 2), ('d', 2)]
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_digest_command(client, db_session):
+    create_channels(db_session)
+    db_session.commit()
+    result = client.application.test_cli_runner().invoke(args=['digest', '--processes', '1', '--size', '1'])
+    assert result.exit_code == 0, result.output
+    titles = [line for line in result.output.splitlines() if line.startswith('some-team')]
+    assert titles == ['some-team #channel-0', 'some-team #channel-1', 'some-team team-wide']
+    assert len(result.output.splitlines()) == 3 * 5  # title, header, separator, the first row and a blank line
@@ -0,0 +1,295 @@
+import elo
+import random
+import pytest
+
+from datetime import timedelta
+from sqlalchemy import event
+
+from database import get_session, get_team, get_channel, get_app_user, insert_match, insert_matches
+from elo import (
+    get_leaderboard, get_player_stats, get_match_history, iter_match_history, replay, check_standings,
+    invalidate_standings, get_rank, select_player_stats, LeaderboardView, PlayerStats, STATE_FIELDS, get_standings,
+    get_standings_as_of, get_rating_timeline, rebuild_checkpoints, delete_checkpoints, revert_match, UNDO_FIELDS,
+    CHECKPOINT_FIELDS
+)
+from models import Checkpoint, Match, Standing
+
+
+def create_players(db, count: int):
+    team = get_team(db, slack_team_id='team_1', slack_team_domain='some-team')
+    channel = get_channel(db, team_id=team.id, slack_channel_id='channel_1', slack_channel_name='some-channel')
+    app_users = [
+        get_app_user(db, team_id=team.id, slack_user_id=f'user_{i}', slack_user_name=f'user {i}') for i in range(count)
+    ]
+    return channel, [x.id for x in app_users]
+
+
+def insert_random_matches(db, channel_id: int, app_user_ids, count: int, seed: int = 0):
+    rnd = random.Random(seed)
+    for _ in range(count):
+        winner_id, loser_id = rnd.sample(app_user_ids, 2)
+        insert_match(db, channel_id=channel_id, winner_id=winner_id, loser_id=loser_id)
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_standings_match_full_replay():
+    with get_session() as db:
+        channel, app_user_ids = create_players(db, count=8)
+        assert get_leaderboard(db, channel_id=channel.id) == []  # builds empty standings
+        insert_random_matches(db, channel_id=channel.id, app_user_ids=app_user_ids, count=50)
+
+        assert check_standings(db, channel_id=channel.id) == []
+        replayed = get_player_stats(replay(get_match_history(db, channel_id=channel.id)))
+        assert get_leaderboard(db, channel_id=channel.id) == replayed
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_check_standings_reports_differences():
+    with get_session() as db:
+        channel, app_user_ids = create_players(db, count=3)
+        get_leaderboard(db, channel_id=channel.id)
+        insert_random_matches(db, channel_id=channel.id, app_user_ids=app_user_ids, count=5)
+        standing = db.query(Standing).filter(Standing.app_user_id == app_user_ids[0]).one()
+        standing.won += 1
+        db.flush()
+        assert check_standings(db, channel_id=channel.id) == [
+            f'app_user {app_user_ids[0]}: won is {standing.won}, replay gives {standing.won - 1}'
+        ]
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_invalidate_standings_rebuilds_on_read():
+    with get_session() as db:
+        channel, app_user_ids = create_players(db, count=4)
+        get_leaderboard(db, channel_id=channel.id)
+        insert_random_matches(db, channel_id=channel.id, app_user_ids=app_user_ids, count=10)
+        before = get_leaderboard(db, channel_id=channel.id)
+
+        invalidate_standings(db, channel_id=channel.id)
+        assert not channel.standings_valid
+        assert db.query(Standing).count() == 0
+        insert_match(db, channel_id=channel.id, winner_id=app_user_ids[0], loser_id=app_user_ids[1])
+        assert db.query(Standing).count() == 0  # not applied incrementally while invalid
+
+        after = get_leaderboard(db, channel_id=channel.id)
+        assert channel.standings_valid
+        assert check_standings(db, channel_id=channel.id) == []
+        assert sum(x.played for x in after) == sum(x.played for x in before) + 2
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_rebuild_standings_with_numpy_engine(client, monkeypatch):
+    pytest.importorskip('numpy')
+    with get_session() as db:
+        channel, app_user_ids = create_players(db, count=5)
+        get_leaderboard(db, channel_id=channel.id)
+        insert_random_matches(db, channel_id=channel.id, app_user_ids=app_user_ids, count=30)
+        expected = get_leaderboard(db, channel_id=channel.id)
+
+        monkeypatch.setitem(client.application.config, 'ELO_ENGINE', 'numpy')
+        assert check_standings(db, channel_id=channel.id) == []
+        invalidate_standings(db, channel_id=channel.id)
+        assert get_leaderboard(db, channel_id=channel.id) == expected
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_iter_match_history_streams_in_batches():
+    with get_session() as db:
+        channel, app_user_ids = create_players(db, count=6)
+        insert_random_matches(db, channel_id=channel.id, app_user_ids=app_user_ids, count=25)
+        db.commit()
+        history = get_match_history(db, channel_id=channel.id)
+        streamed = iter_match_history(db, channel_id=channel.id, batch_size=4)
+        assert not isinstance(streamed, list)
+        assert list(streamed) == [(x.id, x.winner_id, x.loser_id, x.batched) for x in history]
+        streamed = iter_match_history(db, channel_id=channel.id, batch_size=4)
+        assert as_dicts(replay(streamed)) == as_dicts(replay(history))
+
+
+def as_dicts(standings):
+    return [{field: getattr(x, field) for field in STATE_FIELDS + ('app_user_id', 'previous_rank')} for x in standings]
+
+
+def test_player_stats_format():
+    stats = PlayerStats(rank=1, app_user_id=1, elo=1523, played=3, lost=1, won=2, move=-2, streak=2)
+    assert not hasattr(stats, '__dict__')
+    assert stats.format() == ('1523', '2↓', '2', '1', '3', '66.7%', '2 Won')
+    stats = PlayerStats(rank=1, app_user_id=1, elo=1480, played=3, lost=2, won=1, move=1, streak=-1)
+    assert stats.format() == ('1480', '1↑', '1', '2', '3', '33.3%', '')
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_select_player_stats_matches_full_leaderboard():
+    with get_session() as db:
+        channel, app_user_ids = create_players(db, count=12)
+        insert_random_matches(db, channel_id=channel.id, app_user_ids=app_user_ids, count=60)
+        full = get_leaderboard(db, channel_id=channel.id)
+        standings = get_standings(db, channel_id=channel.id)
+
+        assert select_player_stats(standings, LeaderboardView()) == full
+        assert select_player_stats(standings, LeaderboardView(size=3)) == full[:3]
+        assert select_player_stats(standings, LeaderboardView(start=4, size=3)) == full[3:6]
+        assert select_player_stats(standings, LeaderboardView(start=11, size=5)) == full[10:]
+        for stats in full:
+            assert get_rank(standings, app_user_id=stats.app_user_id) == stats.rank
+        around = full[6]
+        assert select_player_stats(standings, LeaderboardView(size=3, around=around.app_user_id)) == full[5:8]
+        assert select_player_stats(standings, LeaderboardView(size=3, include=(full[9].app_user_id,))) == \
+            full[:3] + [full[9]]
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_insert_matches_updates_standings_once_per_batch():
+    with get_session() as db:
+        channel, app_user_ids = create_players(db, count=5)
+        get_leaderboard(db, channel_id=channel.id)
+        insert_random_matches(db, channel_id=channel.id, app_user_ids=app_user_ids, count=10)
+        before = {x.app_user_id: x.rank for x in get_leaderboard(db, channel_id=channel.id)}
+        a, b, c = app_user_ids[:3]
+        insert_matches(db, channel_id=channel.id, results=[(a, b), (a, c), (c, b)])
+
+        history = get_match_history(db, channel_id=channel.id)
+        assert [x.batched for x in history[-4:]] == [False, False, True, True]
+        assert check_standings(db, channel_id=channel.id) == []  # replay agrees on the batch boundary
+        for stats in get_leaderboard(db, channel_id=channel.id):
+            assert stats.move == before[stats.app_user_id] - stats.rank  # moves span the whole batch
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_insert_match_writes_only_the_players_standings():
+    with get_session() as db:
+        channel, app_user_ids = create_players(db, count=10)
+        get_leaderboard(db, channel_id=channel.id)
+        insert_random_matches(db, channel_id=channel.id, app_user_ids=app_user_ids, count=30)
+        updated = []
+
+        def count_updates(conn, cursor, statement, parameters, *args):
+            if statement.startswith('UPDATE standing'):
+                updated.extend(parameters if isinstance(parameters, (list, tuple)) else [parameters])
+
+        event.listen(db.get_bind(), 'before_cursor_execute', count_updates)
+        try:
+            insert_match(db, channel_id=channel.id, winner_id=app_user_ids[0], loser_id=app_user_ids[1])
+        finally:
+            event.remove(db.get_bind(), 'before_cursor_execute', count_updates)
+        assert len(updated) == 2
+        assert channel.match_count == 31
+        assert check_standings(db, channel_id=channel.id) == []  # previous ranks derived from the last report
+        history = get_match_history(db, channel_id=channel.id)
+        assert get_leaderboard(db, channel_id=channel.id) == get_player_stats(replay(history))
+
+
+def undo_records(matches):
+    return {x.id: {f'{side}_{field}_before': getattr(x, f'{side}_{field}_before')
+                   for side in ['winner', 'loser'] for field in UNDO_FIELDS} for x in matches}
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_revert_match(monkeypatch):
+    replayed = []
+    monkeypatch.setattr(elo, 'record', lambda name, value: replayed.append(value))
+    with get_session() as db:
+        channel, app_user_ids = create_players(db, count=6)
+        get_leaderboard(db, channel_id=channel.id)
+        rnd = random.Random(1)
+        for i in range(40):
+            if i % 4 == 0:
+                insert_matches(db, channel_id=channel.id, results=[rnd.sample(app_user_ids, 2) for _ in range(3)])
+            else:
+                winner_id, loser_id = rnd.sample(app_user_ids, 2)
+                insert_match(db, channel_id=channel.id, winner_id=winner_id, loser_id=loser_id)
+        history = get_match_history(db, channel_id=channel.id)
+        undo = {}
+        replay(history, undo=undo)
+        assert undo_records(history) == undo  # recorded on insert
+
+        # the channel's last match, batched ones, the first one of a batch, a single one and the very first match
+        batched = [i for i, x in enumerate(history) if x.batched]
+        for i in [-1, batched[-1], batched[-2] - 1, -10, 0]:
+            match = history[i]
+            replayed.clear()
+            revert_match(db, match=match)
+            history = get_match_history(db, channel_id=channel.id)
+            assert match.id not in [x.id for x in history]
+            assert check_standings(db, channel_id=channel.id) == []
+            undo = {}
+            standings = db.query(Standing).filter(Standing.channel_id == channel.id).order_by(Standing.id)
+            assert [x.app_user_id for x in standings] == [x.app_user_id for x in replay(history, undo=undo)]
+            assert undo_records(history) == undo
+            if i == -1:
+                assert replayed[0] < 6  # the reports before and of the match only
+            if i == 0:
+                assert replayed[0] == len(history)
+            assert channel.match_count == len(history)
+        assert channel.standings_valid
+
+        invalidate_standings(db, channel_id=channel.id)
+        insert_match(db, channel_id=channel.id, winner_id=app_user_ids[0], loser_id=app_user_ids[1])
+        get_leaderboard(db, channel_id=channel.id)
+        revert_match(db, match=get_match_history(db, channel_id=channel.id)[-1])
+        assert not channel.standings_valid  # no undo record, rebuilt on the next read
+        get_leaderboard(db, channel_id=channel.id)
+        assert check_standings(db, channel_id=channel.id) == []
+
+
+def checkpoint_rows(db):
+    return [(x.match_id, x.standings) for x in db.query(Checkpoint).order_by(Checkpoint.match_id)]
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_checkpoints(client, monkeypatch):
+    monkeypatch.setitem(client.application.config, 'CHECKPOINT_INTERVAL', 5)
+    with get_session() as db:
+        channel, app_user_ids = create_players(db, count=6)
+        get_leaderboard(db, channel_id=channel.id)
+        insert_random_matches(db, channel_id=channel.id, app_user_ids=app_user_ids, count=13)
+        insert_matches(db, channel_id=channel.id, results=[(app_user_ids[0], app_user_ids[1])] * 4)  # crosses 15
+        insert_random_matches(db, channel_id=channel.id, app_user_ids=app_user_ids, count=6)
+        history = get_match_history(db, channel_id=channel.id)
+        taken = checkpoint_rows(db)
+        assert [match_id for match_id, _ in taken] == [history[i].id for i in [4, 9, 16, 19]]
+
+        # a replay takes the same checkpoints
+        assert rebuild_checkpoints(db, channel_id=channel.id) == 4
+        assert checkpoint_rows(db) == taken
+
+        for i, match in enumerate(history):
+            match.timestamp = channel.rankings_reset_at + timedelta(minutes=i)
+        db.flush()
+        for i in [0, 3, 4, 12, 13, 16, 20, 22]:
+            expected = replay(history[:i + 1], channel_id=channel.id)
+            actual = get_standings_as_of(db, channel_id=channel.id, as_of=history[i].timestamp + timedelta(seconds=30))
+            assert as_dicts(actual) == as_dicts(expected)
+        assert get_standings_as_of(db, channel_id=channel.id, as_of=channel.rankings_reset_at - timedelta(days=1)) == []
+
+        app_user_id = app_user_ids[2]
+        elo = []
+        for i, match in enumerate(history):
+            if app_user_id in (match.winner_id, match.loser_id):
+                before = {x.app_user_id: x.elo for x in replay(history[:i])}.get(app_user_id, 1500)
+                elo.append((match.id, before, {x.app_user_id: x.elo for x in replay(history[:i + 1])}[app_user_id]))
+        timeline = get_rating_timeline(db, channel_id=channel.id, app_user_id=app_user_id, count=3)
+        assert [(match.id, before, after) for match, before, after in timeline] == elo[-3:]
+
+        delete_checkpoints(db, channel_id=channel.id, since_match_id=history[16].id)
+        assert [match_id for match_id, _ in checkpoint_rows(db)] == [history[4].id, history[9].id]
+
+        revert_match(db, match=history[9])  # the checkpoint after it is dropped, one after the last match replaces it
+        history = get_match_history(db, channel_id=channel.id)
+        assert checkpoint_rows(db) == [
+            taken[0], (history[-1].id, [[getattr(x, field) for field in CHECKPOINT_FIELDS] for x in replay(history)])
+        ]
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_checkpoints_are_thinned_out(client, monkeypatch):
+    monkeypatch.setitem(client.application.config, 'CHECKPOINT_INTERVAL', 1)
+    monkeypatch.setitem(client.application.config, 'CHECKPOINT_MAX_COUNT', 4)
+    with get_session() as db:
+        channel, app_user_ids = create_players(db, count=4)
+        get_leaderboard(db, channel_id=channel.id)
+        insert_random_matches(db, channel_id=channel.id, app_user_ids=app_user_ids, count=20)
+        match_ids = [x.id for x in db.query(Match).order_by(Match.id)]
+        taken = [match_id for match_id, _ in checkpoint_rows(db)]
+        assert len(taken) <= 4
+        assert taken[-2:] == match_ids[-2:] and taken[0] < match_ids[10]  # the newest half is never thinned out
@@ -0,0 +1,47 @@
+import random
+import pytest
+
+from types import SimpleNamespace
+
+from elo import replay, get_player_stats, STATE_FIELDS
+
+elo_numpy = pytest.importorskip('elo_numpy')
+
+
+def random_history(seed: int):
+    rnd = random.Random(seed)
+    app_user_ids = rnd.sample(range(1, 1000), rnd.randint(2, 30))
+    matches = []
+    for _ in range(rnd.randint(1, 300)):
+        winner_id, loser_id = rnd.sample(app_user_ids, 2)
+        matches.append(SimpleNamespace(winner_id=winner_id, loser_id=loser_id, batched=rnd.random() < 0.2))
+    return matches
+
+
+def as_rows(standings):
+    return [(x.app_user_id, x.previous_rank) + tuple(getattr(x, field) for field in STATE_FIELDS) for x in standings]
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_numpy_replay_matches_python_replay(seed):
+    match_list = random_history(seed)
+    expected, actual = replay(match_list), elo_numpy.replay(match_list)
+    assert as_rows(actual) == as_rows(expected)
+    assert get_player_stats(actual) == get_player_stats(expected)
+
+
+def match(winner_id: int, loser_id: int, batched: bool = False):
+    return SimpleNamespace(winner_id=winner_id, loser_id=loser_id, batched=batched)
+
+
+@pytest.mark.parametrize('match_list', [
+    [],
+    [match(1, 2)],
+    [match(1, 2), match(3, 4)],
+    [match(1, 2)] * 3 + [match(2, 1)],
+    [match(1, 2), match(3, 4, batched=True)],
+    [match(1, 2), match(2, 3), match(3, 1, batched=True), match(4, 1, batched=True)],
+    [match(1, 2, batched=True), match(2, 1)],
+])
+def test_numpy_replay_edge_cases(match_list):
+    assert as_rows(elo_numpy.replay(match_list)) == as_rows(replay(match_list))
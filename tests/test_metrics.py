@@ -0,0 +1,52 @@
+import metrics
+
+from flask import Flask, g
+
+from metrics import span, Counter, Gauge, Histogram, Registry
+
+
+def test_histogram_exposition():
+    registry = Registry()
+    histogram = registry.register(Histogram('latency_seconds', 'Latency.', labelnames=('route',), buckets=(0.1, 1)))
+    histogram.observe(0.05, route='/won')
+    histogram.observe(0.5, route='/won')
+    histogram.observe(5, route='/won')
+    assert histogram.count(route='/won') == 3
+    assert registry.expose() == (
+        '# HELP latency_seconds Latency.\n'
+        '# TYPE latency_seconds histogram\n'
+        'latency_seconds_bucket{route="/won",le="0.1"} 1\n'
+        'latency_seconds_bucket{route="/won",le="1"} 2\n'
+        'latency_seconds_bucket{route="/won",le="+Inf"} 3\n'
+        'latency_seconds_sum{route="/won"} 5.55\n'
+        'latency_seconds_count{route="/won"} 3\n'
+    )
+
+
+def test_counter_and_gauge_exposition():
+    registry = Registry()
+    counter = registry.register(Counter('rejected_total', 'Rejected.', labelnames=('reason',)))
+    counter.inc(reason='stale')
+    counter.inc(2, reason='stale')
+    registry.register(Gauge('queue_depth', 'Depth.', lambda: {(): 4}))
+    assert counter.value(reason='stale') == 3
+    assert registry.expose() == (
+        '# HELP rejected_total Rejected.\n'
+        '# TYPE rejected_total counter\n'
+        'rejected_total{reason="stale"} 3\n'
+        '# HELP queue_depth Depth.\n'
+        '# TYPE queue_depth gauge\n'
+        'queue_depth 4\n'
+    )
+
+
+def test_nested_spans_are_exclusive(monkeypatch):
+    app = Flask(__name__)
+    clock = iter([0, 1, 3, 10])  # outer start, inner start, inner end, outer end
+    monkeypatch.setattr(metrics.time, 'perf_counter', lambda: next(clock))
+    with app.app_context():
+        g.phases = {}
+        with span('replay'):
+            with span('history'):
+                pass
+        assert g.phases == {'replay': 8, 'history': 2}
@@ -0,0 +1,163 @@
+import os
+import random
+import pytest
+
+from alembic import command
+from alembic.autogenerate import compare_metadata
+from alembic.config import Config
+from alembic.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from datetime import datetime, timedelta
+from sqlalchemy import event, text
+from typing import List
+
+from database import get_team, get_channel, get_app_user, get_last_match, get_leaderboard_version
+from elo import get_match_history
+from models import Base, AppUser, Channel, Match, Team
+
+
+def alembic_config(db):
+    config = Config(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'alembic.ini'))
+    config.set_main_option('sqlalchemy.url', str(db.get_bind().url))
+    return config
+
+
+def drop_everything(db):
+    Base.metadata.drop_all(bind=db.get_bind())
+    db.get_bind().execute('DROP TABLE IF EXISTS alembic_version')
+
+
+def test_migrations_create_the_schema_of_the_models(db_session):
+    db_session.close()
+    drop_everything(db_session)
+    config = alembic_config(db_session)
+    try:
+        command.upgrade(config, 'head')
+        command.downgrade(config, 'base')
+        command.upgrade(config, 'head')
+        with db_session.get_bind().connect() as connection:
+            assert compare_metadata(MigrationContext.configure(connection), Base.metadata) == []
+    finally:
+        drop_everything(db_session)
+
+
+def test_upgrade_stamps_databases_created_by_create_all(db_session):
+    db_session.close()
+    drop_everything(db_session)
+    config = alembic_config(db_session)
+    engine = db_session.get_bind()
+    try:
+        command.upgrade(config, '0001')
+        engine.execute('DROP TABLE alembic_version')  # as left by create_all before migrations were introduced
+        engine.execute("INSERT INTO team (id, slack_team_id, slack_team_domain) VALUES (1, 'T', 't')")
+        command.upgrade(config, 'head')
+        assert engine.execute('SELECT version_num FROM alembic_version').scalar() == \
+            ScriptDirectory.from_config(config).get_current_head()
+        assert engine.execute('SELECT count(*) FROM team').scalar() == 1
+        with engine.connect() as connection:
+            assert compare_metadata(MigrationContext.configure(connection), Base.metadata) == []
+    finally:
+        drop_everything(db_session)
+
+
+def test_migration_merges_duplicates(db_session):
+    db_session.close()
+    drop_everything(db_session)
+    config = alembic_config(db_session)
+    try:
+        command.upgrade(config, '0002')
+        engine = db_session.get_bind()
+        engine.execute("INSERT INTO team (id, slack_team_id, slack_team_domain) VALUES (1, 'T', 't')")
+        engine.execute("INSERT INTO app_user (id, team_id, slack_user_id, slack_user_name) "
+                       "VALUES (1, 1, 'U1', 'a'), (2, 1, 'U2', 'b'), (3, 1, 'U1', 'a')")
+        engine.execute("INSERT INTO channel (id, team_id, slack_channel_id, slack_channel_name, rankings_reset_at) "
+                       "VALUES (1, 1, 'C', 'c', '2019-01-01'), (2, 1, 'C', 'c', '2019-01-01')")
+        engine.execute("INSERT INTO match (channel_id, winner_id, loser_id, timestamp) "
+                       "VALUES (1, 1, 2, '2019-01-02'), (2, 3, 2, '2019-01-02'), (2, 2, 3, '2019-01-02')")
+        command.upgrade(config, 'head')
+        assert engine.execute('SELECT count(*) FROM app_user').scalar() == 2
+        assert engine.execute('SELECT count(*) FROM channel').scalar() == 1
+        assert engine.execute('SELECT channel_id, winner_id, loser_id FROM match ORDER BY id').fetchall() == [
+            (1, 1, 2), (1, 1, 2), (1, 2, 1)
+        ]
+    finally:
+        drop_everything(db_session)
+
+
+def populate(db, teams: int = 1000, channels_per_team: int = 3, users_per_team: int = 10, matches: int = 30000):
+    rnd = random.Random(0)
+    started_at = datetime(2019, 1, 1)
+    engine = db.get_bind()
+    engine.execute(Team.__table__.insert(), [
+        {'id': t, 'slack_team_id': f'T{t}', 'slack_team_domain': f't{t}', 'nickname_version': 0}
+        for t in range(1, teams + 1)
+    ])
+    engine.execute(Channel.__table__.insert(), [
+        {'team_id': t, 'slack_channel_id': f'C{c}', 'slack_channel_name': f'c{c}', 'rankings_reset_at': started_at,
+         'standings_valid': False} for t in range(1, teams + 1) for c in range(channels_per_team)
+    ])
+    engine.execute(AppUser.__table__.insert(), [
+        {'team_id': t, 'slack_user_id': f'U{u}', 'slack_user_name': f'u{u}'}
+        for t in range(1, teams + 1) for u in range(users_per_team)
+    ])
+    channels = engine.execute('SELECT id, team_id FROM channel').fetchall()
+    users = {}
+    for app_user_id, team_id in engine.execute('SELECT id, team_id FROM app_user'):
+        users.setdefault(team_id, []).append(app_user_id)
+    rows = []
+    for i in range(matches):
+        channel_id, team_id = rnd.choice(channels)
+        winner_id, loser_id = rnd.sample(users[team_id], 2)
+        rows.append({'channel_id': channel_id, 'winner_id': winner_id, 'loser_id': loser_id,
+                     'timestamp': started_at + timedelta(minutes=i)})
+    engine.execute(Match.__table__.insert(), rows)
+    engine.execute('ANALYZE')
+
+
+def explain_statements(db, function) -> List[str]:
+    """ Runs the function and returns the query plans of the statements it executed.
+    """
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(db.get_bind(), 'before_cursor_execute', capture)
+    try:
+        function()
+    finally:
+        event.remove(db.get_bind(), 'before_cursor_execute', capture)
+    plans = []
+    for statement, parameters in statements:
+        explain = text('EXPLAIN ' + statement.replace('%(', ':').replace(')s', ''))  # psycopg2 to bound parameters
+        plans.append('\n'.join(row[0] for row in db.execute(explain, parameters)))
+    return plans
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_hot_queries_use_indexes(db_session):
+    if db_session.get_bind().dialect.name != 'postgresql':
+        pytest.skip('query plans are checked on Postgres')
+    populate(db_session)
+    db_session.commit()
+    team = db_session.query(Team).filter(Team.slack_team_id == 'T7').one()
+    channel = db_session.query(Channel).filter(Channel.team_id == team.id, Channel.slack_channel_id == 'C2').one()
+    app_user = db_session.query(AppUser).filter(AppUser.team_id == team.id, AppUser.slack_user_id == 'U3').one()
+    db_session.expunge_all()
+
+    hot_queries = {
+        'team_slack_team_id_key': lambda: get_team(db_session, slack_team_id='T7', slack_team_domain='t7'),
+        'uq_channel_team_id_slack_channel_id': lambda: get_channel(
+            db_session, team_id=team.id, slack_channel_id='C2', slack_channel_name='c2'),
+        'uq_app_user_team_id_slack_user_id': lambda: get_app_user(
+            db_session, team_id=team.id, slack_user_id='U3', slack_user_name='u3'),
+        'ix_match_channel_id_winner_id_id': lambda: get_last_match(
+            db_session, channel_id=channel.id, winner_id=app_user.id),
+        'ix_match_channel_id_timestamp': lambda: get_match_history(db_session, channel_id=channel.id),
+        'ix_match_channel_id_id': lambda: get_leaderboard_version(db_session, channel_id=channel.id),
+    }
+    for index, function in hot_queries.items():
+        plans = explain_statements(db_session, function)
+        assert plans
+        for plan in plans:
+            assert f' using {index} ' in plan or f' on {index}' in plan, plan
@@ -0,0 +1,91 @@
+import app
+import base64
+import json
+import pytest
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+
+from database import get_installation
+from slack_api import SlackApiError, SlackClient
+
+
+OAUTH_ACCESS = {
+    'ok': True, 'access_token': 'xoxp-1', 'scope': 'commands,bot', 'user_id': 'U1', 'team_id': 'T1',
+    'team_name': 'Some Team', 'bot': {'bot_user_id': 'UBOT', 'bot_access_token': 'xoxb-1'}
+}
+
+
+@pytest.fixture
+def fake_slack(monkeypatch):
+    """ A local stand-in for the Slack Web API, answering with `responses[method]` after `delay` seconds, and the app's
+    Slack client pointed at it with 0.2 s timeouts.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keeps connections alive, like the real API
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+            server.calls.append((self.path, self.client_address, self.headers.get('Authorization'), parse_qs(body)))
+            time.sleep(server.delay)
+            data = json.dumps(server.responses[self.path.rsplit('/', 1)[-1]]).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True  # handlers blocked on kept-alive connections don't hold up shutdown
+
+        def handle_error(self, request, client_address):
+            pass  # clients that timed out are gone by the time the delayed response is written
+
+    server = Server(('127.0.0.1', 0), Handler)
+    server.calls, server.delay, server.responses = [], 0, {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    slack_client = SlackClient(base_url=f'http://127.0.0.1:{server.server_port}/api/', connect_timeout=0.2,
+                               read_timeout=0.2)
+    monkeypatch.setattr(app, 'slack_client', slack_client)
+    yield server
+    slack_client.session.close()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_oauth_stores_the_installation(client, db_session, fake_slack):
+    fake_slack.responses['oauth.access'] = OAUTH_ACCESS
+    assert client.get('/oauth').status_code == 500  # code missing
+    assert client.get('/oauth?code=c1').status_code == 200
+    fake_slack.responses['oauth.access'] = dict(OAUTH_ACCESS, access_token='xoxp-2', bot=None)
+    assert client.get('/oauth?code=c2').status_code == 200  # installed again, without the bot scope
+
+    (path, address, authorization, params), second = fake_slack.calls
+    assert path == '/api/oauth.access' and params == {'code': ['c1']}
+    assert authorization == 'Basic ' + base64.b64encode(b'-1:-1').decode()  # client id and secret of the test env
+    assert second[1] == address  # the pooled connection was reused
+    installation = get_installation(db_session, slack_team_id='T1')
+    assert (installation.access_token, installation.bot_access_token, installation.installed_by) == \
+        ('xoxp-2', None, 'U1')
+    assert get_installation(db_session, slack_team_id='T2') is None
+
+
+def test_oauth_fails_fast(client, fake_slack, caplog):
+    fake_slack.responses['oauth.access'] = {'ok': False, 'error': 'invalid_code'}
+    assert client.get('/oauth?code=c1').status_code == 502
+    assert 'oauth.access: invalid_code' in caplog.text
+
+    fake_slack.delay = 0.5
+    start = time.perf_counter()
+    assert client.get('/oauth?code=c1').status_code == 502
+    assert time.perf_counter() - start < 0.45
+    with pytest.raises(SlackApiError, match='ReadTimeout'):
+        app.slack_client.oauth_access(client_id='id', client_secret='secret', code='c1')
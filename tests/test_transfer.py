@@ -0,0 +1,133 @@
+import io
+import pytest
+import tracemalloc
+import transfer
+
+from datetime import datetime, timedelta
+
+from database import get_session, get_team, get_channel, get_app_user, insert_match, insert_matches
+from elo import get_leaderboard, get_match_history
+from models import AppUser, Channel
+
+
+def create_history(db):
+    team = get_team(db, slack_team_id='team_1', slack_team_domain='some-team')
+    channel = get_channel(db, team_id=team.id, slack_channel_id='channel_1', slack_channel_name='some-channel')
+    a, b, c = [get_app_user(db, team_id=team.id, slack_user_id=f'{x}_id', slack_user_name=f'{x}, "the" player')
+               for x in 'abc']
+    insert_match(db, channel_id=channel.id, winner_id=a.id, loser_id=b.id)
+    insert_matches(db, channel_id=channel.id, results=[(b.id, c.id), (c.id, a.id)])
+    get_match_history(db, channel_id=channel.id)[-1].timestamp += timedelta(microseconds=250000)
+    db.flush()
+    return channel
+
+
+def export(db, channel_id: int, format: str) -> str:
+    output = io.StringIO()
+    transfer.export_matches(db, channel_id=channel_id, file=output, format=format)
+    return output.getvalue()
+
+
+@pytest.mark.usefixtures('prepare_db')
+@pytest.mark.parametrize('format', transfer.FORMATS)
+def test_export_import_round_trip(client, monkeypatch, format):
+    with get_session() as db:
+        channel = create_history(db)
+        exported = export(db, channel_id=channel.id, format=format)
+        with monkeypatch.context() as m:  # the fallback writes the same file as COPY
+            m.setattr(transfer, 'use_copy', lambda db: False)
+            assert export(db, channel_id=channel.id, format=format) == exported
+        if format == 'csv':
+            history = get_match_history(db, channel_id=channel.id)
+            assert exported.splitlines()[:2] == [
+                'timestamp,winner,winner_name,loser,loser_name,batched',
+                f'{history[0].timestamp:%Y-%m-%dT%H:%M:%S}.000000,a_id,"a, ""the"" player",b_id,"b, ""the"" player",0'
+            ]
+            assert exported.splitlines()[-1].startswith(f'{history[-1].timestamp:%Y-%m-%dT%H:%M:%S}.250000,')
+
+        for slack_team_id, use_copy in [('team_2', True), ('team_3', False)]:
+            monkeypatch.setattr(transfer, 'use_copy', lambda db: use_copy)
+            team = get_team(db, slack_team_id=slack_team_id, slack_team_domain='other-team')
+            imported = get_channel(db, team_id=team.id, slack_channel_id='channel_1', slack_channel_name='imported')
+            imported.rankings_reset_at = datetime(2030, 1, 1)
+            count = transfer.import_matches(db, channel_id=imported.id, file=io.StringIO(exported), format=format,
+                                            batch_size=2)
+            assert count == 3
+            assert not imported.standings_valid
+            assert imported.rankings_reset_at < datetime(2030, 1, 1)
+            assert db.query(AppUser).filter(AppUser.team_id == team.id).count() == 3
+            monkeypatch.undo()
+            assert export(db, channel_id=imported.id, format=format) == exported
+            assert [(x.elo, x.move) for x in get_leaderboard(db, channel_id=imported.id)] == \
+                [(x.elo, x.move) for x in get_leaderboard(db, channel_id=channel.id)]
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_import_rejects_matches_out_of_order(db_session):
+    channel = create_history(db_session)
+    db_session.commit()
+    latest = get_match_history(db_session, channel_id=channel.id)[-1].timestamp
+    for timestamps in [[latest - timedelta(seconds=1)], [latest, latest + timedelta(seconds=2), latest]]:
+        file = io.StringIO('timestamp,winner,loser\n' + ''.join(f'{x.isoformat()},a_id,b_id\n' for x in timestamps))
+        with pytest.raises(ValueError, match=f'match {len(timestamps)} of the file'):
+            transfer.import_matches(db_session, channel_id=channel.id, file=file)
+        db_session.rollback()
+    assert len(get_match_history(db_session, channel_id=channel.id)) == 3
+
+
+def test_read_matches_defaults():
+    line = '{"timestamp": "2019-12-01 10:00:00", "winner": "a", "loser": "b"}\n'
+    rows = list(transfer.read_matches(io.StringIO(line), format='jsonl'))
+    assert rows == [{
+        'timestamp': datetime(2019, 12, 1, 10), 'winner': 'a', 'winner_name': 'a', 'loser': 'b', 'loser_name': 'b',
+        'batched': False
+    }]
+
+
+def test_parse_timestamp():
+    for value in ['2019-12-01T10:00:05', '2019-12-01 10:00:05']:
+        assert transfer.parse_timestamp(value) == datetime(2019, 12, 1, 10, 0, 5)
+    assert transfer.parse_timestamp('2019-12-01T10:00:05.250000') == datetime(2019, 12, 1, 10, 0, 5, 250000)
+    with pytest.raises(ValueError):
+        transfer.parse_timestamp('2019-12-01')
+
+
+@pytest.mark.usefixtures('prepare_db')
+@pytest.mark.parametrize('use_copy', [True, False])
+def test_import_memory_does_not_grow_with_the_file(monkeypatch, use_copy):
+    monkeypatch.setattr(transfer, 'use_copy', lambda db: use_copy)
+    peaks = []
+    with get_session() as db:
+        team = get_team(db, slack_team_id='team_1', slack_team_domain='some-team')
+        for count in [1000, 8000]:
+            channel = get_channel(db, team_id=team.id, slack_channel_id=f'channel_{count}', slack_channel_name='c')
+            file = io.StringIO('timestamp,winner,loser\n' + ''.join(
+                f'2019-12-01T10:00:00,u{i % 10},u{(i + 1) % 10}\n' for i in range(count)
+            ))
+            tracemalloc.start()
+            try:
+                assert transfer.import_matches(db, channel_id=channel.id, file=file, batch_size=250) == count
+                peaks.append(tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+    assert peaks[1] < peaks[0] * 1.5  # 8x the rows, about the same peak: one batch is held at a time
+
+
+@pytest.mark.usefixtures('prepare_db')
+def test_import_export_commands(client, db_session, tmp_path):
+    channel = create_history(db_session)
+    db_session.commit()
+    runner = client.application.test_cli_runner()
+    path = tmp_path / 'matches.csv'
+    assert runner.invoke(args=['export-matches', 'team_1', 'channel_1', str(path)]).exit_code == 0
+    assert len(path.read_text().splitlines()) == 4
+    result = runner.invoke(args=['import-matches', 'team_1', 'channel_1', str(path)])
+    assert result.exit_code == 1 and 'is older than the match before it' in result.output
+
+    result = runner.invoke(args=['import-matches', 'team_2', 'channel_1', str(path)])
+    assert result.exit_code == 1 and 'channel channel_1 of team team_2 not found' in result.output
+    result = runner.invoke(args=['import-matches', 'team_2', 'channel_1', str(path), '--team-domain', 'other-team',
+                                 '--channel-name', 'imported'])
+    assert result.exit_code == 0 and result.output == '3 match(es) imported\n'
+    imported = db_session.query(Channel).filter(Channel.id != channel.id).one()
+    assert len(get_match_history(db_session, channel_id=imported.id)) == 3
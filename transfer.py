@@ -0,0 +1,164 @@
+import csv
+import io
+import json
+
+from datetime import datetime
+from itertools import islice
+from sqlalchemy import func
+from sqlalchemy.orm import aliased
+from typing import Dict, IO, Iterable, Iterator
+
+from channel_events import publish_channel_changes
+from database import resolve_ids
+from elo import invalidate_standings, lock_channel
+from models import AppUser, Channel, Match, Team
+
+
+FIELDS = ('timestamp', 'winner', 'winner_name', 'loser', 'loser_name', 'batched')  # winner and loser are slack ids
+FORMATS = ('csv', 'jsonl')
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'  # always with microseconds, as written by EXPORT_COPY
+
+EXPORT_COPY = """
+COPY (
+    SELECT to_char(match.timestamp, 'YYYY-MM-DD"T"HH24:MI:SS.US') AS timestamp, winner.slack_user_id AS winner,
+           winner.slack_user_name AS winner_name, loser.slack_user_id AS loser, loser.slack_user_name AS loser_name,
+           CASE WHEN match.batched THEN 1 ELSE 0 END AS batched
+    FROM match
+    JOIN app_user AS winner ON winner.id = match.winner_id
+    JOIN app_user AS loser ON loser.id = match.loser_id
+    WHERE match.channel_id = %s
+    ORDER BY match.id
+) TO STDOUT WITH CSV HEADER
+"""
+
+IMPORT_COPY = 'COPY match (channel_id, winner_id, loser_id, timestamp, batched) FROM STDIN WITH CSV'
+
+
+def use_copy(db) -> bool:
+    return db.get_bind().dialect.name == 'postgresql'
+
+
+def parse_timestamp(value: str) -> datetime:
+    """ Parses an ISO 8601 timestamp with a T or a space between date and time, as written by isoformat and Postgres
+    (datetime.fromisoformat needs Python 3.7).
+    """
+    value = value.replace('T', ' ')
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f' if '.' in value else '%Y-%m-%d %H:%M:%S')
+
+
+def read_matches(file: IO[str], format: str) -> Iterator[dict]:
+    """ Streams matches of a CSV (with a header) or JSON lines file, only timestamp, winner and loser are required.
+    """
+    assert format in FORMATS, format
+    rows = csv.DictReader(file) if format == 'csv' else (json.loads(line) for line in file if line.strip())
+    for row in rows:
+        yield {
+            'timestamp': parse_timestamp(row['timestamp']),
+            'winner': row['winner'],
+            'winner_name': row.get('winner_name') or row['winner'],
+            'loser': row['loser'],
+            'loser_name': row.get('loser_name') or row['loser'],
+            'batched': str(row.get('batched', 0)).lower() in ('1', 'true')
+        }
+
+
+def write_matches(rows: Iterable[tuple], file: IO[str], format: str):
+    """ Writes rows of FIELDS values, in the same layout as Postgres' COPY ... WITH CSV HEADER for CSV.
+    """
+    assert format in FORMATS, format
+    if format == 'csv':
+        writer = csv.writer(file, lineterminator='\n')
+        writer.writerow(FIELDS)
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            file.write(json.dumps(dict(zip(FIELDS, row))) + '\n')
+
+
+def iter_export_rows(db, channel_id: int, batch_size: int = 10000) -> Iterator[tuple]:
+    winner, loser = aliased(AppUser), aliased(AppUser)
+    rows = db.query(
+        Match.timestamp, winner.slack_user_id, winner.slack_user_name, loser.slack_user_id, loser.slack_user_name,
+        Match.batched
+    ).join(winner, winner.id == Match.winner_id).join(loser, loser.id == Match.loser_id).filter(
+        Match.channel_id == channel_id
+    ).order_by(Match.id).yield_per(batch_size)
+    for timestamp, *players, batched in rows:
+        yield (timestamp.strftime(TIMESTAMP_FORMAT), *players, int(batched))
+
+
+def export_matches(db, channel_id: int, file: IO[str], format: str = 'csv', batch_size: int = 10000):
+    """ Streams the channel's whole match history to the file, CSV is written by COPY on Postgres.
+    """
+    if format == 'csv' and use_copy(db):
+        with db.connection().connection.cursor() as cursor:
+            cursor.copy_expert(cursor.mogrify(EXPORT_COPY, (channel_id,)).decode(), file)
+        return
+    write_matches(iter_export_rows(db, channel_id=channel_id, batch_size=batch_size), file, format=format)
+
+
+def import_matches(db, channel_id: int, file: IO[str], format: str = 'csv', batch_size: int = 10000) -> int:
+    """ Appends the file's matches to the channel's history in file order, returns how many were imported.
+
+    Match ids follow the reported order, so the file's timestamps must not decrease nor precede the channel's last
+    match, a ValueError is raised (and nothing should be committed) otherwise. Players are resolved by slack id within
+    the channel's team, unknown ones are created one batch at a time. Batches are loaded with COPY on Postgres and an
+    executemany insert otherwise, memory doesn't grow with the file. If the channel had no matches, its rankings reset
+    moves back to the earliest imported match so the history counts for the standings. Standings are invalidated, they
+    are rebuilt by replay on the next read.
+    """
+    channel = lock_channel(db, channel_id=channel_id)
+    team = db.query(Team).get(channel.team_id)
+    latest = db.query(func.max(Match.timestamp)).filter(Match.channel_id == channel_id).scalar()
+    had_matches = latest is not None
+    app_user_ids = dict(db.query(AppUser.slack_user_id, AppUser.id).filter(AppUser.team_id == team.id))
+    earliest = None
+    count = 0
+    rows = read_matches(file, format=format)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        for number, x in enumerate(batch, start=count + 1):
+            if latest is not None and x['timestamp'] < latest:
+                raise ValueError(f'match {number} of the file ({x["timestamp"]}) is older than the match before it')
+            latest = x['timestamp']
+        earliest = earliest or batch[0]['timestamp']
+        resolve_app_users(db, team=team, channel=channel, app_user_ids=app_user_ids, batch=batch)
+        values = [
+            (channel_id, app_user_ids[x['winner']], app_user_ids[x['loser']], x['timestamp'], x['batched'])
+            for x in batch
+        ]
+        if use_copy(db):
+            buffer = io.StringIO()
+            csv.writer(buffer, lineterminator='\n').writerows(
+                (*x[:3], x[3].isoformat(), 'true' if x[4] else 'false') for x in values
+            )
+            buffer.seek(0)
+            with db.connection().connection.cursor() as cursor:
+                cursor.copy_expert(IMPORT_COPY, buffer)
+        else:
+            db.execute(Match.__table__.insert(), [
+                dict(zip(('channel_id', 'winner_id', 'loser_id', 'timestamp', 'batched'), x)) for x in values
+            ])
+        count += len(batch)
+    if not had_matches and earliest is not None:
+        channel.rankings_reset_at = min(channel.rankings_reset_at, earliest)
+    invalidate_standings(db, channel_id=channel_id)
+    publish_channel_changes(db, channel_ids=[channel_id])
+    return count
+
+
+def resolve_app_users(db, team: Team, channel: Channel, app_user_ids: Dict[str, int], batch: Iterable[dict]):
+    """ Adds the ids of the batch's players missing from app_user_ids, creating the players with one upsert.
+    """
+    missing = {}
+    for x in batch:
+        for role in ('winner', 'loser'):
+            if x[role] not in app_user_ids:
+                missing[x[role]] = x[f'{role}_name']
+    if missing:
+        ids = resolve_ids(db, slack_team_id=team.slack_team_id, slack_team_domain=team.slack_team_domain,
+                          slack_channel_id=channel.slack_channel_id, slack_channel_name=channel.slack_channel_name,
+                          slack_users=missing)
+        app_user_ids.update(ids.app_user_ids)